@@ -0,0 +1,198 @@
+"""Compact, integer-backed aggregates for the streaming crawl analysis."""
+from array import array
+from collections import defaultdict
+
+# per site counters, stored as dense arrays indexed by site id
+SITE_COUNTERS = ["sv_num_requests", "sv_num_responses", "sv_num_javascript"]
+# per table row counters
+TABLE_COUNTERS = ["num_entries", "num_entries_without_visit_id"]
+# deduplicate the publishers of a third party when the list grows past
+# this many times its last deduplicated size
+PUBLISHERS_COMPACTION_FACTOR = 2
+MIN_PUBLISHERS_TO_COMPACT = 64
+# fall back to a dict if the visit ids are too sparse for a dense array
+MAX_VISIT_ID_SPARSENESS = 4
+MISSING_SITE_ID = -1
+
+
+class StringTable(object):
+    """Map strings to dense integer ids and back."""
+
+    def __init__(self, strings=()):
+        self.strings = []
+        self.ids = {}
+        for string in strings:
+            self.intern(string)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __getitem__(self, string_id):
+        return self.strings[string_id]
+
+    def intern(self, string):
+        try:
+            return self.ids[string]
+        except KeyError:
+            string_id = self.ids[string] = len(self.strings)
+            self.strings.append(string)
+            return string_id
+
+
+class AnalysisState(object):
+    """Aggregates of the streaming analysis.
+
+    Site URLs and third-party PS+1s are interned as integer ids. Per site
+    counters are arrays indexed by site id, and the site-third party
+    relation is stored once, as an array of site ids per third party.
+    """
+
+    def __init__(self, site_visits):
+        self.sites = StringTable()
+        visit_site_ids = [(visit_id, self.sites.intern(site_url))
+                          for visit_id, site_url in site_visits]
+        max_visit_id = max([visit_id for visit_id, _ in visit_site_ids] or
+                           [0])
+        if max_visit_id > MAX_VISIT_ID_SPARSENESS * len(visit_site_ids):
+            self.visit_site_ids = dict(visit_site_ids)
+        else:
+            self.visit_site_ids = array('i', [MISSING_SITE_ID]) * (
+                max_visit_id + 1)
+            for visit_id, site_id in visit_site_ids:
+                self.visit_site_ids[visit_id] = site_id
+        self.num_visits = len(visit_site_ids)
+        self.reset()
+
+    def reset(self):
+        num_sites = len(self.sites)
+        for name in SITE_COUNTERS:
+            setattr(self, name, array('I', [0]) * num_sites)
+        for name in TABLE_COUNTERS:
+            setattr(self, name, defaultdict(int))
+        self.third_parties = StringTable()
+        # site ids of the publishers, indexed by third party id
+        self.tp_publishers = []
+        self.tp_compacted_sizes = array('I')
+
+    def get_site_id(self, visit_id):
+        try:
+            site_id = self.visit_site_ids[visit_id]
+        except IndexError:
+            site_id = MISSING_SITE_ID
+        if site_id == MISSING_SITE_ID:
+            raise KeyError(visit_id)
+        return site_id
+
+    def add_third_party(self, site_id, tp_ps1):
+        tp_id = self.third_parties.intern(tp_ps1)
+        if tp_id == len(self.tp_publishers):
+            self.tp_publishers.append(array('I'))
+            self.tp_compacted_sizes.append(0)
+        publishers = self.tp_publishers[tp_id]
+        # rows of a visit are mostly consecutive, so this catches most
+        # of the duplicates. The rest is removed by the compaction.
+        if publishers and publishers[-1] == site_id:
+            return
+        publishers.append(site_id)
+        if len(publishers) > max(MIN_PUBLISHERS_TO_COMPACT,
+                                 PUBLISHERS_COMPACTION_FACTOR *
+                                 self.tp_compacted_sizes[tp_id]):
+            self.compact_publishers(tp_id)
+
+    def compact_publishers(self, tp_id):
+        publishers = array('I', sorted(set(self.tp_publishers[tp_id])))
+        self.tp_publishers[tp_id] = publishers
+        self.tp_compacted_sizes[tp_id] = len(publishers)
+        return publishers
+
+    def get_site_counts(self, name):
+        """Return a per site counter as a site URL -> count dict."""
+        return {self.sites[site_id]: count for site_id, count
+                in enumerate(getattr(self, name)) if count}
+
+    def get_num_third_parties_per_site(self):
+        num_third_parties = array('I', [0]) * len(self.sites)
+        for tp_id in xrange(len(self.tp_publishers)):
+            for site_id in self.compact_publishers(tp_id):
+                num_third_parties[site_id] += 1
+        return {self.sites[site_id]: count for site_id, count
+                in enumerate(num_third_parties) if count}
+
+    def get_num_publishers_per_group(self, get_group):
+        """Return the number of distinct sites that include a third party
+        of each group, e.g. an organization. `get_group(tp_ps1)` returns
+        the group of a third party PS+1, or None."""
+        group_tp_ids = defaultdict(list)
+        for tp_id, tp_ps1 in enumerate(self.third_parties.strings):
+            group = get_group(tp_ps1)
+            if group is not None:
+                group_tp_ids[group].append(tp_id)
+        num_publishers = {}
+        for group, tp_ids in group_tp_ids.iteritems():
+            site_ids = set()
+            for tp_id in tp_ids:
+                site_ids.update(self.compact_publishers(tp_id))
+            num_publishers[group] = len(site_ids)
+        return num_publishers
+
+    def iter_tp_to_publishers(self):
+        """Yield (third party PS+1, publisher site URLs) pairs."""
+        for tp_id, tp_ps1 in enumerate(self.third_parties.strings):
+            yield tp_ps1, [self.sites[site_id] for site_id
+                           in self.compact_publishers(tp_id)]
+
+    def get_aggregates(self):
+        """Return the aggregates in a form that can be sent to and merged
+        by another process that uses the same site ids."""
+        aggregates = {name: dict(getattr(self, name))
+                      for name in TABLE_COUNTERS}
+        for name in SITE_COUNTERS:
+            aggregates[name] = {site_id: count for site_id, count
+                                in enumerate(getattr(self, name)) if count}
+        aggregates["third_parties"] = self.third_parties.strings
+        aggregates["tp_publishers"] = [
+            self.compact_publishers(tp_id)
+            for tp_id in xrange(len(self.tp_publishers))]
+        return aggregates
+
+    def merge_aggregates(self, aggregates, site_ids=None):
+        """Merge aggregates computed by another process.
+
+        `site_ids` maps the site ids of the aggregates to ours, if they
+        were computed with a different site table.
+        """
+        for name in TABLE_COUNTERS:
+            counter = getattr(self, name)
+            for table_name, count in aggregates[name].iteritems():
+                counter[table_name] += count
+        for name in SITE_COUNTERS:
+            counter = getattr(self, name)
+            for site_id, count in aggregates[name].iteritems():
+                if site_ids is not None:
+                    site_id = site_ids[site_id]
+                counter[site_id] += count
+        for tp_ps1, publishers in zip(aggregates["third_parties"],
+                                      aggregates["tp_publishers"]):
+            for site_id in publishers:
+                if site_ids is not None:
+                    site_id = site_ids[site_id]
+                self.add_third_party(site_id, tp_ps1)
+
+    def get_checkpoint(self):
+        checkpoint = self.get_aggregates()
+        checkpoint["sites"] = self.sites.strings
+        return checkpoint
+
+    def restore_checkpoint(self, checkpoint):
+        """Merge the aggregates of a checkpoint into the current state.
+
+        Site ids are remapped by site URL, since the site_visits table may
+        have new visits since the checkpoint was taken.
+        """
+        try:
+            site_ids = array('I', [self.sites.ids[site_url]
+                                   for site_url in checkpoint["sites"]])
+        except KeyError as e:
+            raise ValueError("Checkpoint has a site that is missing from "
+                             "site_visits: %s" % e)
+        self.merge_aggregates(checkpoint, site_ids)
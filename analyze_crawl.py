@@ -1,45 +1,217 @@
 from __future__ import division
 import os
-import sys
 import sqlite3
+import argparse
+import cPickle
 from time import time
-from os.path import join, basename, sep, isdir
+from multiprocessing import Pool
+from os.path import join, basename, sep, isdir, isfile
+from glob import glob
 from collections import defaultdict
 import util
 from db_schema import (HTTP_REQUESTS_TABLE,
-                       HTTP_RESPONSES_TABLE,
+                       HTTP_RESPONSES_TABLE, HTTP_REDIRECTS_TABLE,
                        JAVASCRIPT_TABLE, OPENWPM_TABLES)
-from util import dump_as_json, get_table_and_column_names, get_crawl_dir,\
-    get_crawl_db_path
+from util import dump_as_json, get_crawl_dir, get_crawl_db_path,\
+    print_peak_memory, read_json, connect_read_only
+from db_catalog import get_db_catalog
+from analysis_state import AnalysisState
+from redirect_analysis import RedirectAnalysis
+from canvas_fingerprinting import CanvasFingerprintingAnalysis
+from domain_owners import load_domain_owners
+from columnar_output import write_columnar_analysis
+from telemetry import Telemetry, Stage, get_report_path, FETCH_TIME,\
+    PS1_TIME, AGGREGATE_TIME, CHECKPOINT_TIME
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# number of id ranges per worker, more shards balance the load better
+SHARDS_PER_WORKER = 4
+# save the aggregates and the last processed id at most this often (seconds)
+CHECKPOINT_INTERVAL = 10 * 60
+# check whether a checkpoint is due every this many rows
+CHECKPOINT_CHECK_EVERY = 10**5
+
+# stream rows into Python, or push the aggregation into SQLite
+STREAMING_ENGINE = "streaming"
+SQL_ENGINE = "sql"
+# stream rows in batches and process them column-wise with numpy
+BATCH_ENGINE = "batch"
+ANALYSIS_ENGINES = [STREAMING_ENGINE, SQL_ENGINE, BATCH_ENGINE]
+# number of rows to fetch at once in the batch engine
+BATCH_SIZE = 10**4
+# the sql engine joins the third parties of a visit with char(31), the
+# ASCII unit separator, which can't occur in a hostname
+SQL_LIST_SEPARATOR = chr(31)
+COLUMNAR_OUTPUT_SUFFIX = "analysis.col"
+# catalogs of read-only crawl DBs are cached in this subdir of the out dir
+CATALOGS_DIRNAME = "catalogs"
+# per site counter of each analyzed table
+TABLE_SITE_COUNTERS = {HTTP_REQUESTS_TABLE: "sv_num_requests",
+                       HTTP_RESPONSES_TABLE: "sv_num_responses",
+                       JAVASCRIPT_TABLE: "sv_num_javascript"}
+# the canvas fingerprinting stage is checkpointed like a table
+CANVAS_FINGERPRINTING_STAGE = "canvas_fingerprinting"
+CANVAS_FINGERPRINTING_COLUMNS = ["visit_id", "script_url", "symbol",
+                                 "operation", "arguments"]
+
+# the analysis object worker processes use to stream their shards.
+# Set by the parent before the pool is forked.
+_shard_analysis = None
+
+
+def get_checkpoint_path(out_dir, crawl_name):
+    return join(out_dir, "checkpoints",
+                "%s_analysis_checkpoint.pickle" % crawl_name)
+
+
+def _analyze_shard(shard):
+    table_name, min_id, max_id = shard
+    # don't reuse the parent's connection in the forked process. Workers
+    # only read, so they don't run optimize_db: the parent already set up
+    # the DB, and its 20 GB cache would be allocated once per worker
+    _shard_analysis.db_conn = connect_read_only(
+        _shard_analysis.crawl_db_path, _shard_analysis.immutable)
+    _shard_analysis.db_conn.row_factory = sqlite3.Row
+    _shard_analysis.state.reset()
+    # collect the time split of the shard, the parent adds it to its stage
+    stage = _shard_analysis.telemetry.current_stage = Stage(table_name)
+    _shard_analysis.analyze_table_rows(table_name, min_id, max_id)
+    return _shard_analysis.state.get_aggregates(), dict(stage.time_split)
 
 
 class CrawlDBAnalysis(object):
 
-    def __init__(self, crawl_dir, out_dir):
+    def __init__(self, crawl_dir, out_dir, num_workers=1, resume=False,
+                 incremental=False, engine=STREAMING_ENGINE,
+                 columnar_output=False, profile_interval=None,
+                 read_only=False, domain_owners_path=None,
+                 immutable=False, redirects=False,
+                 canvas_fingerprinting=False):
         self.crawl_dir = get_crawl_dir(crawl_dir)
         self.crawl_name = basename(crawl_dir.rstrip(sep))
         self.crawl_db_path = get_crawl_db_path(self.crawl_dir)
         self.command_fail_rate = {}
         self.command_timeout_rate = {}
+        # an immutable DB is also opened read-only
+        self.read_only = read_only or immutable
+        self.immutable = immutable
+        # don't write the catalog cache next to a DB we only read
+        self.catalog_dir = None
+        if self.read_only:
+            self.catalog_dir = join(out_dir, CATALOGS_DIRNAME)
         self.init_db()
+        self.telemetry = Telemetry(
+            self.crawl_name,
+            get_report_path(out_dir, self.crawl_name, "analysis"),
+            self.db_conn, profile_interval)
         self.out_dir = join(out_dir, "analysis")
         self.init_out_dir()
-        self.visit_id_site_urls = self.get_visit_id_site_url_mapping()
-        self.sv_num_requests = defaultdict(int)
-        self.sv_num_responses = defaultdict(int)
-        self.sv_num_javascript = defaultdict(int)
-        self.sv_num_third_parties = defaultdict(int)
-        self.num_entries_without_visit_id = defaultdict(int)
-        self.num_entries = defaultdict(int)
-        self.sv_third_parties = defaultdict(set)
-        self.tp_to_publishers = defaultdict(set)
-        self.rows_without_visit_id = 0
+        self.num_workers = num_workers
+        if engine == BATCH_ENGINE and np is None:
+            raise ImportError("The batch engine requires numpy")
+        if engine == SQL_ENGINE and num_workers > 1:
+            raise Exception("The sql engine doesn't support multiple "
+                            "workers")
+        self.engine = engine
+        self.columnar_output = columnar_output
+        # these read http_requests and javascript a second time
+        self.redirects = redirects
+        self.canvas_fingerprinting = canvas_fingerprinting
+        # domain -> organization, to count the sites of each organization
+        self.domain_owners = None
+        if domain_owners_path:
+            self.domain_owners = load_domain_owners(domain_owners_path)
+            print "Loaded the owners of %d domains" % len(self.domain_owners)
+        self.sql_functions_ready = False
+        # numpy views of the visit id -> site id map, and of the PS+1 of
+        # each site, used by the batch engine
+        self.visit_site_ids = None
+        self.site_ps1s = {}
+        # time spent on PS+1 parsing and saving checkpoints, for telemetry
+        self.ps1_time = 0.0
+        self.checkpoint_time = 0.0
+        with self.telemetry.stage("load_site_visits") as stage:
+            self.state = self.init_analysis_state()
+            stage.add_rows(self.state.num_visits)
+        self.scan_handlers = defaultdict(list)
+        self.scan_columns = defaultdict(list)
+        self.register_default_scan_handlers()
+        self.checkpoint_path = get_checkpoint_path(out_dir, self.crawl_name)
+        # last processed id of each table
+        self.watermarks = {}
+        self.completed_tables = set()
+        self.last_checkpoint_time = time()
+        if resume or incremental:
+            self.load_checkpoint(incremental)
+
+    def register_scan_handler(self, table_name, handler, columns=()):
+        """Call `handler(row, site_id)` for each row of the table that
+        has a visit id.
+
+        All handlers of a table are run in the same pass over the table.
+        `columns` that are missing from the table are not selected.
+        Handlers only run with the streaming engine: the sql and batch
+        engines compute the default counts themselves, so registering a
+        handler with them raises an Exception.
+        """
+        if self.engine != STREAMING_ENGINE:
+            raise Exception("Scan handlers only run with the %s engine, "
+                            "not %s" % (STREAMING_ENGINE, self.engine))
+        self.add_scan_handler(table_name, handler, columns)
+
+    def add_scan_handler(self, table_name, handler, columns=()):
+        self.scan_handlers[table_name].append(handler)
+        for column in columns:
+            if column not in self.scan_columns[table_name]:
+                self.scan_columns[table_name].append(column)
+
+    def register_default_scan_handlers(self):
+        # the other engines have their own versions of these
+        self.add_scan_handler(HTTP_REQUESTS_TABLE, self.count_request,
+                              ["url", "top_level_url"])
+        self.add_scan_handler(HTTP_RESPONSES_TABLE, self.count_response)
+        self.add_scan_handler(JAVASCRIPT_TABLE, self.count_javascript)
+
+    def count_request(self, row, site_id):
+        # use top_level_url, otherwise fall back to top_url
+        self.state.sv_num_requests[site_id] += 1
+        top_url = None
+        if "top_level_url" in row:
+            top_url = row["top_level_url"]
+        if top_url is None:
+            top_url = self.state.sites[site_id]
+        if top_url:
+            t0 = time()
+            is_tp, req_ps1, _ = util.is_third_party(row["url"], top_url)
+            self.ps1_time += time() - t0
+            if is_tp:
+                self.state.add_third_party(site_id, req_ps1)
+        else:
+            print "Warning, missing top_url", row
+
+    def count_response(self, row, site_id):
+        self.state.sv_num_responses[site_id] += 1
+
+    def count_javascript(self, row, site_id):
+        self.state.sv_num_javascript[site_id] += 1
 
     def init_db(self):
+        if self.read_only:
+            self.db_conn = connect_read_only(self.crawl_db_path,
+                                             self.immutable)
+            self.db_conn.row_factory = sqlite3.Row
+            return
         self.db_conn = sqlite3.connect(self.crawl_db_path)
         self.db_conn.row_factory = sqlite3.Row
         self.optimize_db()
 
+    def get_db_catalog(self):
+        return get_db_catalog(self.crawl_db_path,
+                              catalog_dir=self.catalog_dir)
+
     def init_out_dir(self):
         if not isdir(self.out_dir):
             os.makedirs(self.out_dir)
@@ -59,156 +231,608 @@ class CrawlDBAnalysis(object):
         self.run_streaming_analysis_for_table(HTTP_REQUESTS_TABLE)
         self.run_streaming_analysis_for_table(HTTP_RESPONSES_TABLE)
         self.run_streaming_analysis_for_table(JAVASCRIPT_TABLE)
+        if self.canvas_fingerprinting:
+            self.run_canvas_fingerprinting_analysis()
+        if self.redirects:
+            self.run_redirect_analysis()
+
+    def init_analysis_state(self):
+        state = AnalysisState(self.db_conn.execute(
+            "SELECT visit_id, site_url FROM site_visits"))
+        print state.num_visits, "mappings"
+        print "Distinct site urls", len(state.sites)
+        return state
 
-    def get_visit_id_site_url_mapping(self):
-        visit_id_site_urls = {}
-        for visit_id, site_url in self.db_conn.execute(
-                "SELECT visit_id, site_url FROM site_visits"):
-            visit_id_site_urls[visit_id] = site_url
-        print len(visit_id_site_urls), "mappings"
-        print "Distinct site urls", len(set(visit_id_site_urls.values()))
-        return visit_id_site_urls
+    def load_checkpoint(self, incremental=False):
+        """Restore the aggregates and watermarks of an earlier run.
+
+        When resuming, tables that were completed are skipped. In the
+        incremental mode all tables are analyzed again, starting after
+        their watermarks, to add the rows appended since the last run.
+        """
+        if not isfile(self.checkpoint_path):
+            print "No checkpoint at %s, will analyze all rows" % (
+                self.checkpoint_path)
+            return
+        with open(self.checkpoint_path, "rb") as f:
+            checkpoint = cPickle.load(f)
+        self.state.restore_checkpoint(checkpoint["state"])
+        self.watermarks = checkpoint["watermarks"]
+        if not incremental:
+            self.completed_tables = set(checkpoint["completed_tables"])
+        print "Loaded checkpoint. Watermarks: %s Completed tables: %s" % (
+            self.watermarks, sorted(self.completed_tables))
+
+    def save_checkpoint(self):
+        t0 = time()
+        checkpoint = {"crawl_name": self.crawl_name,
+                      "watermarks": self.watermarks,
+                      "completed_tables": sorted(self.completed_tables),
+                      "state": self.state.get_checkpoint()}
+        checkpoint_dir = os.path.dirname(self.checkpoint_path)
+        if not isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        # write to a temp file first so a crash can't corrupt the checkpoint
+        tmp_path = self.checkpoint_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            cPickle.dump(checkpoint, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.checkpoint_path)
+        self.last_checkpoint_time = time()
+        self.checkpoint_time += self.last_checkpoint_time - t0
+        self.telemetry.add_time(CHECKPOINT_TIME,
+                                self.last_checkpoint_time - t0)
+        print "Saved checkpoint. Watermarks: %s" % self.watermarks
+
+    def is_checkpoint_due(self):
+        return time() - self.last_checkpoint_time > CHECKPOINT_INTERVAL
 
     def run_streaming_analysis_for_table(self, table_name):
-        current_visit_ids = {}
-        processed = 0
-        cols_to_select = ["visit_id", "crawl_id"]
+        if table_name in self.completed_tables:
+            print "Skipping %s, analyzed before the checkpoint" % table_name
+            return
         print "Will analyze %s" % table_name
+        # empty tables should show up in the row counts too
+        self.state.num_entries.setdefault(table_name, 0)
+        self.state.num_entries_without_visit_id.setdefault(table_name, 0)
+        min_id = None
+        if table_name in self.watermarks:
+            min_id = self.watermarks[table_name] + 1
+            print "Will start after the watermark, id:", min_id - 1
+        num_entries = self.state.num_entries[table_name]
+        with self.telemetry.stage("analyze_%s" % table_name) as stage:
+            stage.info.update({"engine": self.engine,
+                               "num_workers": self.num_workers,
+                               "min_id": min_id})
+            if self.engine == SQL_ENGINE:
+                self.run_sql_analysis_for_table(table_name, min_id)
+            elif self.num_workers > 1:
+                self.run_parallel_analysis_for_table(table_name, min_id)
+            else:
+                self.analyze_table_rows(table_name, min_id, checkpoint=True)
+            stage.add_rows(self.state.num_entries[table_name] - num_entries)
+            if table_name == HTTP_REQUESTS_TABLE:
+                util.print_ps1_cache_stats()
+                # the workers have their own caches
+                if self.num_workers == 1:
+                    stage.info["ps1_cache"] = util.get_ps1_cache_stats()
+        print_peak_memory("after analyzing %s" % table_name)
+        with self.telemetry.stage("dump_%s" % table_name):
+            self.dump_crawl_data(table_name)
+        self.completed_tables.add(table_name)
+        self.save_checkpoint()
+
+    def run_canvas_fingerprinting_analysis(self):
+        """Detect the canvas fingerprinting scripts, see
+        canvas_fingerprinting.py. Only runs with --canvas-fingerprinting,
+        since it's another pass over javascript. Like the redirects, all
+        rows are read on each run, with any engine."""
+        if CANVAS_FINGERPRINTING_STAGE in self.completed_tables:
+            print "Skipping %s, analyzed before the checkpoint" % (
+                CANVAS_FINGERPRINTING_STAGE)
+            return
+        db_catalog = self.get_db_catalog()
+        if not all(db_catalog.has_column(JAVASCRIPT_TABLE, column)
+                   for column in CANVAS_FINGERPRINTING_COLUMNS):
+            print "Missing %s columns, will skip the canvas fingerprinting " \
+                "analysis" % JAVASCRIPT_TABLE
+            return
+        print "Will detect canvas fingerprinting"
+        canvas_fp = CanvasFingerprintingAnalysis(
+            self.db_conn, self.state.get_site_id, self.state.sites)
+        with self.telemetry.stage("analyze_%s" % CANVAS_FINGERPRINTING_STAGE)\
+                as stage:
+            canvas_fp.run()
+            stage.add_rows(canvas_fp.stats["num_canvas_calls"])
+            stage.info.update(canvas_fp.stats)
+        if canvas_fp.stats["num_late_calls"]:
+            print "Warning: %d canvas calls were out of the visit window " \
+                "and were ignored" % canvas_fp.stats["num_late_calls"]
+        print_peak_memory("after detecting canvas fingerprinting")
+        with self.telemetry.stage("dump_%s" % CANVAS_FINGERPRINTING_STAGE):
+            self.dump_json(canvas_fp.get_fingerprinters(),
+                           "canvas_fingerprinters.json")
+            self.dump_json(canvas_fp.get_fingerprinting_sites(),
+                           "canvas_fingerprinting_sites.json")
+            self.dump_json(canvas_fp.stats, "canvas_fingerprinting_stats.json")
+        self.completed_tables.add(CANVAS_FINGERPRINTING_STAGE)
+        self.save_checkpoint()
+
+    def run_redirect_analysis(self):
+        """Resolve the redirect chains, see redirect_analysis.py.
+
+        Only runs with --redirects, since it's another pass over
+        http_requests. The chains are resolved from all rows of each run,
+        with any engine, since a visit's redirects may span the watermark.
+        """
+        if HTTP_REDIRECTS_TABLE in self.completed_tables:
+            print "Skipping %s, analyzed before the checkpoint" % (
+                HTTP_REDIRECTS_TABLE)
+            return
+        db_catalog = self.get_db_catalog()
+        if not db_catalog.has_column(HTTP_REDIRECTS_TABLE, "visit_id"):
+            print "No visit ids in %s, will skip the redirect analysis" % (
+                HTTP_REDIRECTS_TABLE)
+            return
+        print "Will analyze %s" % HTTP_REDIRECTS_TABLE
+        redirects = RedirectAnalysis(self.db_conn, db_catalog,
+                                     self.state.get_site_id)
+        with self.telemetry.stage("analyze_%s" % HTTP_REDIRECTS_TABLE) \
+                as stage:
+            redirects.run()
+            stage.add_rows(redirects.stats["num_redirects"])
+            stage.info.update(redirects.stats)
+            self.telemetry.add_time(PS1_TIME, redirects.ps1_time)
+        if redirects.stats["num_late_redirects"] or \
+                redirects.stats["num_late_requests"]:
+            print "Warning: %d redirects and %d requests were out of the " \
+                "visit window and were ignored" % (
+                    redirects.stats["num_late_redirects"],
+                    redirects.stats["num_late_requests"])
+        print_peak_memory("after analyzing %s" % HTTP_REDIRECTS_TABLE)
+        with self.telemetry.stage("dump_%s" % HTTP_REDIRECTS_TABLE):
+            self.dump_json(redirects.get_ps1_pair_site_counts(),
+                           "redirect_ps1_pairs.json")
+            self.dump_json(redirects.get_ps1_pair_site_counts(chains=True),
+                           "redirect_chain_ps1_pairs.json")
+            self.dump_json(redirects.get_chain_lengths(),
+                           "redirect_chain_lengths.json")
+            self.dump_json(redirects.stats, "redirect_stats.json")
+        self.completed_tables.add(HTTP_REDIRECTS_TABLE)
+        self.save_checkpoint()
+
+    def get_id_shards(self, table_name, num_shards, min_id=None):
+        """Split the table into `num_shards` id ranges."""
+        query = "SELECT MIN(id), MAX(id) FROM %s" % table_name
+        params = ()
+        if min_id is not None:
+            query += " WHERE id >= ?"
+            params = (min_id,)
+        min_id, max_id = self.db_conn.execute(query, params).fetchone()
+        if max_id is None:
+            return []
+        shard_size = (max_id - min_id) // num_shards + 1
+        return [(table_name, start, min(start + shard_size - 1, max_id))
+                for start in xrange(min_id, max_id + 1, shard_size)]
+
+    def run_parallel_analysis_for_table(self, table_name, min_id=None):
+        global _shard_analysis
+        shards = self.get_id_shards(table_name,
+                                    self.num_workers * SHARDS_PER_WORKER,
+                                    min_id)
+        print "Will analyze %d shards with %d workers" % (len(shards),
+                                                         self.num_workers)
+        _shard_analysis = self
+        pool = Pool(self.num_workers)
+        try:
+            # merge the shards in order, so the merged aggregates always
+            # correspond to an id prefix we can checkpoint
+            for shard, (aggregates, time_split) in zip(
+                    shards, pool.imap(_analyze_shard, shards)):
+                self.state.merge_aggregates(aggregates)
+                # the time split is summed over the workers
+                self.telemetry.current_stage.merge_time_split(time_split)
+                self.watermarks[table_name] = shard[2]
+                if self.is_checkpoint_due():
+                    self.save_checkpoint()
+        finally:
+            pool.close()
+            pool.join()
+            _shard_analysis = None
+
+    def get_visit_site_ids(self, visit_ids):
+        """Map an array of visit ids to site ids."""
+        if self.visit_site_ids is None:
+            if isinstance(self.state.visit_site_ids, dict):
+                self.visit_site_ids = False
+            else:
+                self.visit_site_ids = np.frombuffer(
+                    self.state.visit_site_ids, dtype=np.int32)
+        if self.visit_site_ids is False:
+            # sparse visit ids, no dense array to index
+            return np.array([self.state.get_site_id(visit_id)
+                             for visit_id in visit_ids], dtype=np.int64)
+        in_range = visit_ids < len(self.visit_site_ids)
+        site_ids = np.full(len(visit_ids), -1, dtype=np.int64)
+        site_ids[in_range] = self.visit_site_ids[visit_ids[in_range]]
+        missing = site_ids < 0
+        if missing.any():
+            raise KeyError(int(visit_ids[missing][0]))
+        return site_ids
+
+    def get_site_ps1(self, site_id):
+        try:
+            return self.site_ps1s[site_id]
+        except KeyError:
+            site_url = self.state.sites[site_id]
+            if not site_url:
+                print "Warning, missing top_url", site_id
+                site_ps1 = None
+            else:
+                site_ps1 = util.get_tld_or_host(site_url)
+            self.site_ps1s[site_id] = site_ps1
+            return site_ps1
+
+    def check_visit_order(self, current_visit_ids, visit_ids, crawl_ids):
+        """Vectorized version of the out of order row check."""
+        for crawl_id in np.unique(crawl_ids):
+            crawl_visit_ids = visit_ids[crawl_ids == crawl_id]
+            current_visit_id = current_visit_ids.get(crawl_id,
+                                                     crawl_visit_ids[0])
+            # the current visit id before each row is the running max.
+            running_max = np.maximum.accumulate(
+                np.concatenate(([current_visit_id], crawl_visit_ids)))
+            out_of_order = (crawl_visit_ids < running_max[:-1]) & (
+                crawl_visit_ids > 0)
+            for current, visit_id in zip(running_max[:-1][out_of_order],
+                                         crawl_visit_ids[out_of_order]):
+                print ("Warning: Out of order row! Curr: %s Row: %s"
+                       " Crawl id: %s" % (current, visit_id, crawl_id))
+            current_visit_ids[crawl_id] = running_max[-1]
+
+    def analyze_table_batches(self, table_name, min_id=None, max_id=None,
+                              checkpoint=False):
+        """Batch engine version of `analyze_table_rows`.
+
+        Rows are fetched as tuples with fetchmany and processed
+        column-wise: visit and crawl ids as numpy arrays, per site counts
+        with bincount and the PS+1s of each distinct host once per batch.
+        """
+        counter = np.frombuffer(
+            getattr(self.state, TABLE_SITE_COUNTERS[table_name]),
+            dtype=np.uint32)
+        num_sites = len(self.state.sites)
+        current_visit_ids = {}
+        cols_to_select = ["id", "visit_id", "crawl_id"]
         if table_name == HTTP_REQUESTS_TABLE:
             cols_to_select.append("url")
-            # check whether top_level_url is here
-            # ultimately preprocesing will make sure all tables contain
-            # top_level_url
-            try:
-                self.db_conn.execute("SELECT top_level_url FROM %s LIMIT 1" %
-                                     table_name)
-                cols_to_select.append("top_level_url")
-            except Exception:
-                pass
+        query = "SELECT %s FROM %s WHERE id BETWEEN ? AND ? ORDER BY id" % (
+            ",".join(cols_to_select), table_name)
+        cursor = self.db_conn.cursor()
+        # plain tuples are much cheaper to build than sqlite3.Row objects
+        cursor.row_factory = None
+        ps1_time = self.ps1_time
+        checkpoint_time = self.checkpoint_time
+        t_start = time()
+        cursor.execute(query, (min_id or 0, max_id if max_id is not None
+                               else 2**63 - 1))
+        fetch_time = time() - t_start
+        while True:
+            t0 = time()
+            rows = cursor.fetchmany(BATCH_SIZE)
+            fetch_time += time() - t0
+            if not rows:
+                break
+            columns = zip(*rows)
+            visit_ids = np.array(columns[1], dtype=np.int64)
+            crawl_ids = np.array(columns[2], dtype=np.int64)
+            valid = visit_ids != -1
+            num_valid = int(valid.sum())
+            self.add_row_counts(table_name, len(rows), len(rows) - num_valid)
+            visit_ids = visit_ids[valid]
+            crawl_ids = crawl_ids[valid]
+            site_ids = self.get_visit_site_ids(visit_ids)
+            counter += np.bincount(site_ids, minlength=num_sites).astype(
+                np.uint32)
+            if table_name == HTTP_REQUESTS_TABLE and num_valid:
+                urls = [url for url, is_valid in zip(columns[3], valid)
+                        if is_valid]
+                self.add_third_parties(site_ids, urls)
+            if num_valid:
+                self.check_visit_order(current_visit_ids, visit_ids,
+                                       crawl_ids)
+            if checkpoint:
+                self.watermarks[table_name] = columns[0][-1]
+                if self.is_checkpoint_due():
+                    self.save_checkpoint()
+        self.add_time_split(time() - t_start, fetch_time,
+                            self.ps1_time - ps1_time,
+                            self.checkpoint_time - checkpoint_time)
+
+    def add_time_split(self, scan_time, fetch_time, ps1_time,
+                       checkpoint_time):
+        """Add the time split of a table scan to the running stage.
+
+        The time that isn't spent on fetching rows, PS+1 parsing or saving
+        checkpoints is counted as aggregation.
+        """
+        self.telemetry.add_time(FETCH_TIME, fetch_time)
+        self.telemetry.add_time(PS1_TIME, ps1_time)
+        self.telemetry.add_time(AGGREGATE_TIME, scan_time - fetch_time -
+                                ps1_time - checkpoint_time)
+
+    def add_third_parties(self, site_ids, urls):
+        third_parties = set()
+        t0 = time()
+        req_ps1s = util.get_tlds_or_hosts(urls)
+        self.ps1_time += time() - t0
+        for site_id, req_ps1 in zip(site_ids.tolist(), req_ps1s):
+            if req_ps1 is not None:
+                third_parties.add((site_id, req_ps1))
+        for site_id, req_ps1 in sorted(third_parties):
+            site_ps1 = self.get_site_ps1(site_id)
+            if site_ps1 is not None and req_ps1 != site_ps1:
+                self.state.add_third_party(site_id, req_ps1)
+
+    def init_sql_functions(self):
+        """Register ps1() and store the PS+1 of each site in a temp table."""
+        def ps1(url):
+            t0 = time()
+            req_ps1 = util.get_tld_or_host(url)
+            self.ps1_time += time() - t0
+            return req_ps1
+        self.db_conn.create_function("ps1", 1, ps1)
+        # the temp schema is private to this connection, so it can be
+        # written to even if the crawl DB is opened read-only
+        self.db_conn.execute("""CREATE TEMP TABLE IF NOT EXISTS site_ps1s (
+            visit_id INTEGER PRIMARY KEY, site_ps1 TEXT)""")
+        self.db_conn.execute("DELETE FROM temp.site_ps1s")
+        self.db_conn.execute("""INSERT INTO temp.site_ps1s
+            SELECT visit_id, ps1(site_url) FROM site_visits""")
+        # end the implicit transaction, so we don't hold a lock on the
+        # crawl DB between the queries
+        self.db_conn.commit()
+        self.sql_functions_ready = True
+
+    def run_sql_analysis_for_table(self, table_name, min_id=None):
+        """Compute the per site counts and third parties in SQLite.
+
+        Python only sees one row per visit: its number of rows and the
+        distinct third-party PS+1s. Third parties are determined by the
+        site URL, as in the streaming engine.
+        """
+        if not self.sql_functions_ready:
+            self.init_sql_functions()
+        counter = getattr(self.state, TABLE_SITE_COUNTERS[table_name])
+        get_site_id = self.state.get_site_id
+        num_entries = 0
+        num_entries_without_visit_id = 0
+        max_id = self.db_conn.execute(
+            "SELECT MAX(id) FROM %s" % table_name).fetchone()[0]
+        if max_id is None:
+            return
+        if table_name == HTTP_REQUESTS_TABLE:
+            # sites without a PS+1 have no third parties
+            third_party = """CASE WHEN s.site_ps1 IS NOT NULL
+                THEN NULLIF(ps1(t.url), s.site_ps1) END"""
+        else:
+            third_party = "NULL"
+        # group_concat(DISTINCT ...) only takes the default "," separator,
+        # so the distinct third parties are grouped in a subquery
+        query = """SELECT visit_id, SUM(num_rows),
+                group_concat(tp_ps1, char(31))
+            FROM (SELECT t.visit_id AS visit_id, COUNT(*) AS num_rows,
+                    %s AS tp_ps1
+                FROM %s t
+                LEFT JOIN temp.site_ps1s s ON s.visit_id = t.visit_id
+                WHERE t.id BETWEEN ? AND ?
+                GROUP BY t.visit_id, tp_ps1)
+            GROUP BY visit_id""" % (third_party, table_name)
+        ps1_time = self.ps1_time
+        t_start = time()
+        # SQLite runs the ps1() calls and the grouping while we fetch
+        cursor = self.db_conn.execute(query, (min_id or 0, max_id))
+        fetch_time = time() - t_start
+        while True:
+            t0 = time()
+            rows = cursor.fetchmany(BATCH_SIZE)
+            fetch_time += time() - t0
+            if not rows:
+                break
+            for visit_id, num_rows, tp_ps1s in rows:
+                num_entries += num_rows
+                visit_id = int(visit_id)
+                if visit_id == -1:
+                    num_entries_without_visit_id += num_rows
+                    continue
+                site_id = get_site_id(visit_id)
+                counter[site_id] += num_rows
+                if table_name == HTTP_REQUESTS_TABLE and \
+                        not self.state.sites[site_id]:
+                    print "Warning, missing top_url", visit_id
+                if tp_ps1s:
+                    for tp_ps1 in tp_ps1s.split(SQL_LIST_SEPARATOR):
+                        self.state.add_third_party(site_id, tp_ps1)
+        ps1_time = self.ps1_time - ps1_time
+        self.add_time_split(time() - t_start, fetch_time - ps1_time,
+                            ps1_time, 0)
+        self.add_row_counts(table_name, num_entries,
+                            num_entries_without_visit_id)
+        self.watermarks[table_name] = max_id
+
+    def add_row_counts(self, table_name, num_entries,
+                       num_entries_without_visit_id):
+        self.state.num_entries[table_name] += num_entries
+        self.state.num_entries_without_visit_id[table_name] += \
+            num_entries_without_visit_id
+
+    def analyze_table_rows(self, table_name, min_id=None, max_id=None,
+                           checkpoint=False):
+        """Stream the rows of a table, optionally limited to an id range.
+
+        If `checkpoint` is True, the aggregates are periodically saved
+        along with the id of the last processed row.
+        """
+        if self.engine == BATCH_ENGINE:
+            return self.analyze_table_batches(table_name, min_id, max_id,
+                                              checkpoint)
+        current_visit_ids = {}
+        processed = 0
+        num_entries = 0
+        num_entries_without_visit_id = 0
+        last_id = None
+        handlers = self.scan_handlers[table_name]
+        get_site_id = self.state.get_site_id
+        table_columns = self.get_db_catalog().get_columns(
+            table_name)
+        cols_to_select = ["id", "visit_id", "crawl_id"] + [
+            column for column in self.scan_columns[table_name]
+            if column in table_columns]
 
         query = "SELECT %s FROM %s" % (",".join(cols_to_select), table_name)
-        for row in self.db_conn.execute(query):
-            processed += 1
-            visit_id = int(row["visit_id"])
-            crawl_id = int(row["crawl_id"])
-            if visit_id == -1:
-                self.rows_without_visit_id += 1
-                continue
-
-            site_url = self.visit_id_site_urls[visit_id]
-            if table_name == HTTP_REQUESTS_TABLE:
-                # use top_level_url, otherwise fall back to top_url
-                self.sv_num_requests[site_url] += 1
-                top_url = None
-                if "top_level_url" in row:
-                    top_url = row["top_level_url"]
-                if top_url is None:
-                    top_url = self.visit_id_site_urls[visit_id]
-                if top_url:
-                    is_tp, req_ps1, _ = util.is_third_party(
-                        row["url"], top_url)
-                    if is_tp:
-                        self.sv_third_parties[site_url].add(req_ps1)
-                        self.sv_num_third_parties[site_url] = len(
-                            self.sv_third_parties[site_url])
-                        self.tp_to_publishers[req_ps1].add(site_url)
-                else:
-                    print "Warning, missing top_url", row
-
-            elif table_name == HTTP_RESPONSES_TABLE:
-                self.sv_num_responses[site_url] += 1
-            elif table_name == JAVASCRIPT_TABLE:
-                self.sv_num_javascript[site_url] += 1
-
-            if crawl_id not in current_visit_ids:
-                current_visit_ids[crawl_id] = visit_id
-            # end of the data from the current visit
-            elif visit_id > current_visit_ids[crawl_id]:
-                # self.process_visit_data(current_visit_data[crawl_id])
-                # if site_url in self.sv_third_parties:
-                #    del self.sv_third_parties[site_url]
-                current_visit_ids[crawl_id] = visit_id
-            elif visit_id < current_visit_ids[crawl_id] and visit_id > 0:
-                # raise Exception(
-                #    "Out of order row! Curr: %s Row: %s Crawl id: %s" %
-                #    (current_visit_ids[crawl_id], visit_id, crawl_id))
-                print ("Warning: Out of order row! Curr: %s Row: %s"
-                       " Crawl id: %s" % (
-                           current_visit_ids[crawl_id], visit_id, crawl_id))
+        conditions = []
+        params = []
+        if min_id is not None:
+            conditions.append("id >= ?")
+            params.append(min_id)
+        if max_id is not None:
+            conditions.append("id <= ?")
+            params.append(max_id)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY id"
+        ps1_time = self.ps1_time
+        checkpoint_time = self.checkpoint_time
+        t_start = time()
+        cursor = self.db_conn.execute(query, params)
+        fetch_time = time() - t_start
+        while True:
+            t0 = time()
+            rows = cursor.fetchmany(BATCH_SIZE)
+            fetch_time += time() - t0
+            if not rows:
+                break
+            for row in rows:
+                if checkpoint and processed and \
+                        processed % CHECKPOINT_CHECK_EVERY == 0 and \
+                        self.is_checkpoint_due():
+                    self.add_row_counts(table_name, num_entries,
+                                        num_entries_without_visit_id)
+                    num_entries = num_entries_without_visit_id = 0
+                    self.watermarks[table_name] = last_id
+                    self.save_checkpoint()
+                processed += 1
+                last_id = row["id"]
+                num_entries += 1
+                visit_id = int(row["visit_id"])
+                crawl_id = int(row["crawl_id"])
+                if visit_id == -1:
+                    num_entries_without_visit_id += 1
+                    continue
+
+                site_id = get_site_id(visit_id)
+                for handler in handlers:
+                    handler(row, site_id)
 
-        self.dump_crawl_data(table_name)
+                if crawl_id not in current_visit_ids:
+                    current_visit_ids[crawl_id] = visit_id
+                # end of the data from the current visit
+                elif visit_id > current_visit_ids[crawl_id]:
+                    # self.process_visit_data(current_visit_data[crawl_id])
+                    # if site_id in self.sv_third_parties:
+                    #    del self.sv_third_parties[site_id]
+                    current_visit_ids[crawl_id] = visit_id
+                elif visit_id < current_visit_ids[crawl_id] and visit_id > 0:
+                    # raise Exception(
+                    #    "Out of order row! Curr: %s Row: %s Crawl id: %s" %
+                    #    (current_visit_ids[crawl_id], visit_id, crawl_id))
+                    print ("Warning: Out of order row! Curr: %s Row: %s"
+                           " Crawl id: %s" % (current_visit_ids[crawl_id],
+                                              visit_id, crawl_id))
+
+        self.add_time_split(time() - t_start, fetch_time,
+                            self.ps1_time - ps1_time,
+                            self.checkpoint_time - checkpoint_time)
+        self.add_row_counts(table_name, num_entries,
+                            num_entries_without_visit_id)
+        if checkpoint and last_id is not None:
+            self.watermarks[table_name] = last_id
 
     def print_num_of_rows(self):
         print "Will print the number of rows"
-        db_schema_str = get_table_and_column_names(self.crawl_db_path)
+        db_catalog = self.get_db_catalog()
         for table_name in OPENWPM_TABLES:
-            # TODO: search in table names instead of the db schema
-            if table_name in db_schema_str:
-                try:
-                    num_rows = self.db_conn.execute(
-                        "SELECT MAX(id) FROM %s" % table_name).fetchone()[0]
-                except sqlite3.OperationalError:
+            if db_catalog.has_table(table_name):
+                num_rows = db_catalog.get_num_rows(table_name)
+                if num_rows is None:
                     num_rows = self.db_conn.execute(
                         "SELECT COUNT(*) FROM %s" % table_name).fetchone()[0]
-                if num_rows is None:
-                    num_rows = 0
                 print "Total rows", table_name, num_rows
 
     def dump_crawl_data(self, table_name):
+        state = self.state
         if table_name == HTTP_REQUESTS_TABLE:
-            self.dump_json(self.sv_num_requests, "sv_num_requests.json")
-            self.dump_json(self.sv_num_third_parties,
+            self.dump_json(state.get_site_counts("sv_num_requests"),
+                           "sv_num_requests.json")
+            self.dump_json(state.get_num_third_parties_per_site(),
                            "sv_num_third_parties.json")
-            # self.dump_json(self.sv_third_parties, "sv_third_parties.json")
             tp_to_publishers = {tp: "\t".join(publishers) for (tp, publishers)
-                                in self.tp_to_publishers.iteritems()}
+                                in state.iter_tp_to_publishers()}
             self.dump_json(tp_to_publishers, "tp_to_publishers.json")
+            if self.domain_owners is not None:
+                self.dump_org_num_sites()
         elif table_name == HTTP_RESPONSES_TABLE:
-            self.dump_json(self.sv_num_responses, "sv_num_responses.json")
+            self.dump_json(state.get_site_counts("sv_num_responses"),
+                           "sv_num_responses.json")
         elif table_name == JAVASCRIPT_TABLE:
-            self.dump_json(self.sv_num_javascript, "sv_num_javascript.json")
+            self.dump_json(state.get_site_counts("sv_num_javascript"),
+                           "sv_num_javascript.json")
+
+    def dump_org_num_sites(self):
+        """Dump the number of sites that include a third party of each
+        organization, and print the most common organizations."""
+        org_num_sites = self.state.get_num_publishers_per_group(
+            self.domain_owners.get)
+        self.dump_json(org_num_sites, "org_num_sites.json")
+        num_sites = sum(1 for num_requests in self.state.sv_num_requests
+                        if num_requests)
+        for org, org_sites in sorted(org_num_sites.iteritems(),
+                                     key=lambda item: -item[1])[:10]:
+            print "%s is on %d sites (%0.1f%%)" % (
+                org, org_sites, 100 * org_sites / max(num_sites, 1))
 
     def dump_json(self, obj, out_file):
         dump_as_json(obj, join(self.out_dir, "%s_%s" % (self.crawl_name,
                                                         out_file)))
 
     def start_analysis(self):
-        self.print_num_of_rows()
-        self.check_crawl_history()
+        with self.telemetry.stage("print_num_of_rows"):
+            self.print_num_of_rows()
+        with self.telemetry.stage("check_crawl_history"):
+            self.check_crawl_history()
+        print_peak_memory("before the streaming analysis")
         self.run_all_streaming_analysis()
-        self.dump_entries_without_visit_ids()
-
-    def get_num_entries_without_visit_id(self, table_name):
-        query = "SELECT count(*) FROM %s WHERE visit_id = -1;" % table_name
-        try:
-            return self.db_conn.execute(query).fetchone()[0]
-        except Exception:
-            return 0
+        with self.telemetry.stage("dump_entries_without_visit_ids"):
+            self.dump_entries_without_visit_ids()
+        if self.columnar_output:
+            with self.telemetry.stage("dump_columnar_output"):
+                self.dump_columnar_output()
+        self.telemetry.close()
 
-    def get_num_entries(self, table_name):
-        query = "SELECT count(*) FROM %s;" % table_name
-        return self.db_conn.execute(query).fetchone()[0]
+    def dump_columnar_output(self):
+        """Write the per site results and third party publishers in the
+        columnar format, see columnar_output.py."""
+        out_path = join(self.out_dir, "%s_%s" % (self.crawl_name,
+                                                 COLUMNAR_OUTPUT_SUFFIX))
+        t0 = time()
+        write_columnar_analysis(self.state, out_path)
+        print "Wrote columnar output to %s in %0.1f s" % (out_path,
+                                                          time() - t0)
 
     def dump_entries_without_visit_ids(self):
-        """All these metrics can be computed during the streaming analysis."""
-        self.num_entries[HTTP_REQUESTS_TABLE] = self.get_num_entries(
-            HTTP_REQUESTS_TABLE)
-        self.num_entries_without_visit_id[HTTP_REQUESTS_TABLE] = \
-            self.get_num_entries_without_visit_id(HTTP_REQUESTS_TABLE)
-
-        self.num_entries[HTTP_RESPONSES_TABLE] = self.get_num_entries(
-            HTTP_RESPONSES_TABLE)
-        self.num_entries_without_visit_id[HTTP_RESPONSES_TABLE] =\
-            self.get_num_entries_without_visit_id(HTTP_RESPONSES_TABLE)
-
-        self.num_entries[JAVASCRIPT_TABLE] = self.get_num_entries(
-            JAVASCRIPT_TABLE)
-        self.num_entries_without_visit_id[JAVASCRIPT_TABLE] =\
-            self.get_num_entries_without_visit_id(JAVASCRIPT_TABLE)
-
-        self.dump_json(self.num_entries_without_visit_id,
+        """Dump the row counts collected during the streaming analysis."""
+        self.dump_json(self.state.num_entries_without_visit_id,
                        "entries_without_visit_id.json")
-        self.dump_json(self.num_entries, "num_entries.json")
+        self.dump_json(self.state.num_entries, "num_entries.json")
 
     def check_crawl_history(self):
         """Compute failure and timeout rates for crawl_history table."""
@@ -248,8 +872,104 @@ class CrawlDBAnalysis(object):
                            "command_timeout_rate.json")
 
 
+def compare_outputs(out_dir_a, out_dir_b):
+    """Return the names of the JSON outputs that differ between two runs."""
+    different = []
+    for json_path in sorted(glob(join(out_dir_a, "analysis", "*.json"))):
+        other_json_path = join(out_dir_b, "analysis", basename(json_path))
+        if not isfile(other_json_path):
+            different.append(basename(json_path))
+            continue
+        output, other_output = read_json(json_path), read_json(
+            other_json_path)
+        if json_path.endswith("tp_to_publishers.json"):
+            # the order of the publishers is arbitrary
+            output = {tp: set(publishers.split("\t")) for (tp, publishers)
+                      in output.iteritems()}
+            other_output = {tp: set(publishers.split("\t")) for
+                            (tp, publishers) in other_output.iteritems()}
+        if output != other_output:
+            different.append(basename(json_path))
+    return different
+
+
+def compare_engines(crawl_dir, out_dir, engines=ANALYSIS_ENGINES):
+    """Run the analysis with each engine, print the durations and check
+    that the outputs match."""
+    durations = {}
+    for engine in engines:
+        t0 = time()
+        analysis = CrawlDBAnalysis(crawl_dir, join(out_dir, engine),
+                                   engine=engine)
+        analysis.start_analysis()
+        durations[engine] = time() - t0
+    for engine in engines:
+        print "Engine %s took %0.1f s" % (engine, durations[engine])
+    for engine in engines[1:]:
+        different = compare_outputs(join(out_dir, engines[0]),
+                                    join(out_dir, engine))
+        if different:
+            print "Outputs of %s and %s differ: %s" % (
+                engines[0], engine, ", ".join(different))
+        else:
+            print "Outputs of %s and %s match" % (engines[0], engine)
+    return durations
+
+
 if __name__ == '__main__':
     t0 = time()
-    crawl_db_check = CrawlDBAnalysis(sys.argv[1], sys.argv[2])
-    crawl_db_check.start_analysis()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("crawl_dir")
+    parser.add_argument("out_dir")
+    parser.add_argument("--num-workers", type=int, default=1,
+                        help="analyze id ranges of each table in parallel "
+                        "(streaming and batch engines)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the last checkpoint")
+    parser.add_argument("--incremental", action="store_true",
+                        help="only analyze rows added since the last run "
+                        "and merge them into the earlier results")
+    parser.add_argument("--engine", choices=ANALYSIS_ENGINES,
+                        default=STREAMING_ENGINE)
+    parser.add_argument("--compare-engines", action="store_true",
+                        help="benchmark the engines against each other")
+    parser.add_argument("--columnar", action="store_true",
+                        help="also write the results in the columnar "
+                        "format")
+    parser.add_argument("--profile-interval", type=float,
+                        help="sample the stack every this many seconds of "
+                        "CPU time and add the profile to the telemetry")
+    parser.add_argument("--read-only", action="store_true",
+                        help="open the crawl DB read-only and memory "
+                        "mapped, without changing its settings")
+    parser.add_argument("--immutable", action="store_true",
+                        help="like --read-only, and also skip SQLite's "
+                        "locking, for DBs nothing else writes to")
+    parser.add_argument("--domain-owners", metavar="DOMAIN_OWNERS_JSON",
+                        help="webXray domain ownership list, to count the "
+                        "sites of each organization")
+    parser.add_argument("--redirects", action="store_true",
+                        help="resolve the redirect chains, in another pass "
+                        "over http_requests")
+    parser.add_argument("--canvas-fingerprinting", action="store_true",
+                        help="detect the canvas fingerprinting scripts, in "
+                        "another pass over javascript")
+    args = parser.parse_args()
+    if args.engine == SQL_ENGINE and args.num_workers > 1:
+        # the queries of the sql engine run in a single connection
+        parser.error("--num-workers is not supported with --engine %s" %
+                     SQL_ENGINE)
+    if args.compare_engines:
+        compare_engines(args.crawl_dir, args.out_dir)
+    else:
+        crawl_db_check = CrawlDBAnalysis(
+            args.crawl_dir, args.out_dir, num_workers=args.num_workers,
+            resume=args.resume, incremental=args.incremental,
+            engine=args.engine, columnar_output=args.columnar,
+            profile_interval=args.profile_interval,
+            read_only=args.read_only, immutable=args.immutable,
+            domain_owners_path=args.domain_owners,
+            redirects=args.redirects,
+            canvas_fingerprinting=args.canvas_fingerprinting)
+        crawl_db_check.start_analysis()
     print "Analysis finished in %0.1f mins" % ((time() - t0) / 60)
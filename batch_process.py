@@ -0,0 +1,496 @@
+"""Process the compressed crawl archives of a dir in a pipeline.
+
+Each archive goes through the stages below. Stages of different archives
+run at the same time, e.g. an archive is extracted while the previous one
+is analyzed and the one before it is recompressed, within per stage
+concurrency limits and a scratch disk budget. Failed stages are retried.
+The finished stages of each archive are recorded in a state file, so an
+interrupted run can be resumed by running the same command.
+"""
+import os
+import sys
+import json
+import glob
+import shutil
+import argparse
+import threading
+import subprocess
+from time import time
+from Queue import Queue, Empty
+from os.path import join, isdir, isfile, islink, basename, dirname,\
+    abspath, getsize, realpath
+from util import get_crawl_dir, CRAWL_DB_EXT
+from db_catalog import CATALOG_SUFFIX
+from crawl_archive import extract_crawl_archive, repack_archive
+from analyze_crawl import get_checkpoint_path
+
+REPO_DIR = dirname(abspath(__file__))
+ARCHIVE_EXT = ".tar.lz4"
+STATE_FILENAME = "batch_process_state.json"
+LOGS_DIRNAME = "batch-logs"
+EXTRACTED_DIRNAME = "extracted"
+
+EXTRACT = "extract"
+PROCESS = "process"
+ANALYZE = "analyze"
+COMPRESS = "compress"
+SHIP = "ship"
+CLEANUP = "cleanup"
+# in the order they run for each archive
+STAGES = [EXTRACT, PROCESS, ANALYZE, COMPRESS, SHIP, CLEANUP]
+DEFAULT_CONCURRENCY = {EXTRACT: 1, PROCESS: 1, ANALYZE: 1, COMPRESS: 1,
+                       SHIP: 1, CLEANUP: 1}
+# archives that are extracted but not cleaned up yet
+DEFAULT_MAX_IN_FLIGHT = 3
+DEFAULT_MAX_RETRIES = 2
+RETRY_DELAY = 60
+# scratch space reserved per archive, in multiples of its size. Covers the
+# extracted crawl, the compacted copy of the DB and the new archive.
+DEFAULT_EXPANSION_FACTOR = 8
+# use this share of the free scratch space if no budget is given
+DEFAULT_SCRATCH_SHARE = 0.9
+DEFAULT_REMOTE_DIR = "odin:/mnt/10tb2/census-release-normalized"
+
+
+def run_commands(commands, log_path, cwd=None):
+    """Run a pipeline of commands, raise CalledProcessError if any fails.
+
+    stdout of each command is piped to the next one. stderr, and stdout
+    of the last command, go to the log.
+    """
+    with open(log_path, "a") as log:
+        log.write("Will run %s\n" % " | ".join(" ".join(cmd)
+                                                for cmd in commands))
+        log.flush()
+        procs = []
+        stdin = None
+        for i, cmd in enumerate(commands):
+            stdout = subprocess.PIPE if i < len(commands) - 1 else log
+            proc = subprocess.Popen(cmd, cwd=cwd, stdin=stdin, stdout=stdout,
+                                    stderr=log)
+            if stdin is not None:
+                # so the previous command gets SIGPIPE if this one exits
+                stdin.close()
+            stdin = proc.stdout
+            procs.append(proc)
+        for cmd, proc in zip(commands, procs):
+            if proc.wait():
+                raise subprocess.CalledProcessError(proc.returncode,
+                                                    " ".join(cmd))
+
+
+def run_script(script_name, args, log_path, cwd=None):
+    run_commands([[sys.executable, join(REPO_DIR, script_name + ".py")] +
+                  args], log_path, cwd)
+
+
+def get_free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+class LocalShipper(object):
+    """Copy the archives to a local dir, e.g. a mounted remote disk."""
+
+    def __init__(self, dest_dir):
+        self.dest_dir = dest_dir
+
+    def ship(self, archive_path, subdir, log_path):
+        dest_dir = join(self.dest_dir, subdir)
+        if not isdir(dest_dir):
+            os.makedirs(dest_dir)
+        dest_path = join(dest_dir, basename(archive_path))
+        with open(log_path, "a") as log:
+            log.write("Will copy %s to %s\n" % (archive_path, dest_path))
+        # copy to a temp name first, so the dest never has a partial file
+        shutil.copyfile(archive_path, dest_path + ".part")
+        os.rename(dest_path + ".part", dest_path)
+
+
+class ScpShipper(object):
+    """Copy the archives to a remote host:dir with scp."""
+
+    def __init__(self, remote_dir):
+        self.remote_dir = remote_dir
+
+    def ship(self, archive_path, subdir, log_path):
+        run_commands([["scp", "-q", archive_path, "%s/%s/" % (
+            self.remote_dir.rstrip("/"), subdir)]], log_path)
+
+
+SHIPPERS = {"local": LocalShipper, "scp": ScpShipper}
+
+
+class BatchProcess(object):
+
+    def __init__(self, archive_dir, out_dir, scratch_dir, shipper,
+                 concurrency=None, scratch_budget=None,
+                 max_in_flight=DEFAULT_MAX_IN_FLIGHT,
+                 max_retries=DEFAULT_MAX_RETRIES,
+                 expansion_factor=DEFAULT_EXPANSION_FACTOR,
+                 state_path=None, process_args=(), analyze_args=(),
+                 extract_all=False):
+        # the scripts run in the scratch dir of each archive
+        archive_dir, out_dir, scratch_dir = [
+            abspath(_dir) for _dir in (archive_dir, out_dir, scratch_dir)]
+        self.archive_paths = sorted(glob.glob(join(archive_dir,
+                                                   "*" + ARCHIVE_EXT)))
+        # shipped archives go to a subdir of the same name, e.g. 2018-06
+        self.ship_subdir = basename(archive_dir.rstrip(os.sep))
+        self.out_dir = out_dir
+        self.scratch_dir = scratch_dir
+        self.shipper = shipper
+        self.concurrency = dict(DEFAULT_CONCURRENCY)
+        self.concurrency.update(concurrency or {})
+        for _dir in [out_dir, scratch_dir]:
+            if not isdir(_dir):
+                os.makedirs(_dir)
+        if scratch_budget is None:
+            scratch_budget = int(get_free_space(scratch_dir) *
+                                 DEFAULT_SCRATCH_SHARE)
+        self.scratch_budget = scratch_budget
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.expansion_factor = expansion_factor
+        # extract the whole archive, rather than what's needed for the
+        # processing (see crawl_archive.py)
+        self.extract_all = extract_all
+        self.process_args = list(process_args)
+        self.analyze_args = list(analyze_args)
+        self.logs_dir = join(out_dir, LOGS_DIRNAME)
+        if not isdir(self.logs_dir):
+            os.makedirs(self.logs_dir)
+        self.state_path = abspath(state_path or join(out_dir,
+                                                     STATE_FILENAME))
+        self.state = self.load_state()
+        self.running = {stage: 0 for stage in STAGES}
+        self.busy = set()  # archives with a running stage
+        self.not_before = {}  # archive -> time of the next retry
+        self.events = Queue()
+
+    def get_crawl_name(self, archive_path):
+        return basename(archive_path)[:-len(ARCHIVE_EXT)]
+
+    def get_scratch_root(self, archive_path):
+        return join(self.scratch_dir, self.get_crawl_name(archive_path))
+
+    def get_extracted_dir(self, archive_path):
+        return join(self.get_scratch_root(archive_path), EXTRACTED_DIRNAME)
+
+    def get_crawl_dir(self, archive_path):
+        # the dir in the archive may not match the archive name
+        return get_crawl_dir(join(self.get_extracted_dir(archive_path),
+                                  self.get_crawl_name(archive_path)))
+
+    def remove_scratch_root(self, archive_path, ignore_errors=False):
+        """Remove the scratch dir of an archive, and the compacted DB its
+        crawl DB links to if it was compacted into another file system."""
+        scratch_root = self.get_scratch_root(archive_path)
+        for db_path in glob.glob(join(scratch_root, EXTRACTED_DIRNAME, "*",
+                                      "*" + CRAWL_DB_EXT)):
+            if islink(db_path) and isfile(realpath(db_path)):
+                os.remove(realpath(db_path))
+        shutil.rmtree(scratch_root, ignore_errors=ignore_errors)
+
+    def get_out_archive_path(self, archive_path):
+        return join(self.get_scratch_root(archive_path),
+                    basename(archive_path))
+
+    def get_log_path(self, archive_path, stage):
+        return join(self.logs_dir, "%s_%s.log" % (
+            self.get_crawl_name(archive_path), stage))
+
+    def load_state(self):
+        """Load the state of the previous run, if any.
+
+        Failed archives are retried. Unfinished archives whose scratch dir
+        is gone, or whose processing didn't finish, start over from the
+        extraction.
+        """
+        state = {}
+        if isfile(self.state_path):
+            state = json.load(open(self.state_path))
+            print "Will resume from", self.state_path
+        for archive_path in self.archive_paths:
+            name = basename(archive_path)
+            archive_state = state.setdefault(name, {
+                "finished": [], "attempts": {}, "times": {}, "failed": None})
+            if archive_state["failed"]:
+                print "Will retry %s, failed at %s" % (
+                    name, archive_state["failed"]["stage"])
+                archive_state["failed"] = None
+                archive_state["attempts"] = {}
+            if CLEANUP not in archive_state["finished"] and \
+                    not isdir(self.get_scratch_root(archive_path)):
+                archive_state["finished"] = []
+            elif PROCESS not in archive_state["finished"]:
+                # an interrupted process stage may have left the DB
+                # half-normalized, see restart_from_extract
+                archive_state["finished"] = []
+        return state
+
+    def save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.state_path)
+
+    def get_next_stage(self, archive_path):
+        archive_state = self.state[basename(archive_path)]
+        if archive_state["failed"]:
+            return None
+        for stage in STAGES:
+            if stage not in archive_state["finished"]:
+                return stage
+        return None
+
+    def is_in_flight(self, archive_path):
+        stage = self.get_next_stage(archive_path)
+        return archive_path in self.busy or \
+            (stage is not None and stage != EXTRACT)
+
+    def get_reserved_space(self, archive_path):
+        return getsize(archive_path) * self.expansion_factor
+
+    def can_extract(self, archive_path, in_flight):
+        if len(in_flight) >= self.max_in_flight:
+            return False
+        if not in_flight:
+            # always make progress, even if the archive is over the budget
+            return True
+        reserved = sum(self.get_reserved_space(path) for path in in_flight)
+        return reserved + self.get_reserved_space(archive_path) <= \
+            self.scratch_budget
+
+    def schedule(self):
+        """Start the next stage of the archives, earliest archives first so
+        they free their scratch space as soon as possible."""
+        in_flight = [path for path in self.archive_paths
+                     if self.is_in_flight(path)]
+        for archive_path in self.archive_paths:
+            if archive_path in self.busy or \
+                    self.not_before.get(archive_path, 0) > time():
+                continue
+            stage = self.get_next_stage(archive_path)
+            if stage is None or \
+                    self.running[stage] >= self.concurrency[stage]:
+                continue
+            if stage == EXTRACT:
+                if not self.can_extract(archive_path, in_flight):
+                    continue
+                in_flight.append(archive_path)
+            self.start_stage(archive_path, stage)
+
+    def start_stage(self, archive_path, stage):
+        archive_state = self.state[basename(archive_path)]
+        archive_state["attempts"][stage] = archive_state["attempts"].get(
+            stage, 0) + 1
+        print "Will %s %s (attempt %d)" % (stage, basename(archive_path),
+                                           archive_state["attempts"][stage])
+        self.running[stage] += 1
+        self.busy.add(archive_path)
+        worker = threading.Thread(target=self.run_stage,
+                                  args=(archive_path, stage))
+        worker.daemon = True
+        worker.start()
+
+    def run_stage(self, archive_path, stage):
+        t0 = time()
+        error = None
+        try:
+            getattr(self, stage)(archive_path,
+                                 self.get_log_path(archive_path, stage))
+        except Exception as e:
+            error = "%s: %s" % (type(e).__name__, e)
+        self.events.put((archive_path, stage, time() - t0, error))
+
+    def finish_stage(self, archive_path, stage, duration, error):
+        name = basename(archive_path)
+        archive_state = self.state[name]
+        self.running[stage] -= 1
+        self.busy.discard(archive_path)
+        if error is None:
+            print "Finished %s %s in %0.1f s" % (stage, name, duration)
+            archive_state["finished"].append(stage)
+            archive_state["times"][stage] = duration
+        elif archive_state["attempts"][stage] <= self.max_retries:
+            print "%s %s failed (%s), will retry in %d s" % (
+                stage, name, error, RETRY_DELAY)
+            self.not_before[archive_path] = time() + RETRY_DELAY
+            if stage == PROCESS:
+                self.restart_from_extract(archive_state)
+        else:
+            print "%s %s failed (%s), giving up. See %s" % (
+                stage, name, error, self.get_log_path(archive_path, stage))
+            archive_state["failed"] = {"stage": stage, "error": error}
+            # free the scratch space for the other archives
+            self.remove_scratch_root(archive_path, ignore_errors=True)
+        self.save_state()
+
+    def restart_from_extract(self, archive_state):
+        """Retry the process stage on a fresh copy of the crawl DB.
+
+        process_crawl_data.py changes the DB in place with the journal
+        turned off, so a failed attempt may leave it half-normalized or
+        corrupt.
+        """
+        archive_state["finished"] = []
+        archive_state["attempts"].pop(EXTRACT, None)
+
+    def run(self):
+        t0 = time()
+        print "Will process %d archives, scratch budget %0.1f GB" % (
+            len(self.archive_paths), self.scratch_budget / 1e9)
+        self.save_state()
+        while True:
+            self.schedule()
+            if not self.busy and not self.not_before:
+                break
+            try:
+                # wake up periodically for the retries
+                event = self.events.get(timeout=1)
+            except Empty:
+                for archive_path, retry_time in self.not_before.items():
+                    if retry_time <= time():
+                        del self.not_before[archive_path]
+                continue
+            self.finish_stage(*event)
+        failed = [name for name, archive_state in self.state.iteritems()
+                  if archive_state["failed"]]
+        print "Processed %d archives in %0.1f mins, %d failed: %s" % (
+            len(self.archive_paths), (time() - t0) / 60, len(failed),
+            " ".join(sorted(failed)))
+        return not failed
+
+    def extract(self, archive_path, log_path):
+        extracted_dir = self.get_extracted_dir(archive_path)
+        # remove what an interrupted extraction left
+        self.remove_scratch_root(archive_path, ignore_errors=True)
+        os.makedirs(extracted_dir)
+        if self.extract_all:
+            run_commands([["lz4", "-qdc", "--no-sparse", archive_path],
+                          ["tar", "xf", "-", "-C", extracted_dir]], log_path)
+        else:
+            # the logs and the top list go straight to the out dir
+            extract_crawl_archive(archive_path, extracted_dir,
+                                  backup_out_dir=self.out_dir)
+        # the checkpoint of an earlier analysis is for the old copy
+        checkpoint_path = get_checkpoint_path(
+            self.out_dir, basename(self.get_crawl_dir(archive_path)))
+        if isfile(checkpoint_path):
+            os.remove(checkpoint_path)
+
+    def process(self, archive_path, log_path):
+        # fix_alexa_ranks downloads the top list to the working dir
+        run_script("process_crawl_data",
+                   [self.get_crawl_dir(archive_path), self.out_dir] +
+                   self.process_args, log_path,
+                   cwd=self.get_scratch_root(archive_path))
+
+    def analyze(self, archive_path, log_path):
+        # a retry continues from the checkpoint of the failed attempt, if
+        # it saved one
+        run_script("analyze_crawl",
+                   [self.get_crawl_dir(archive_path), self.out_dir,
+                    "--resume"] + self.analyze_args, log_path,
+                   cwd=self.get_scratch_root(archive_path))
+
+    def compress(self, archive_path, log_path):
+        if not self.extract_all:
+            # copy the members we didn't extract from the original archive
+            repack_archive(archive_path, self.get_extracted_dir(archive_path),
+                           self.get_out_archive_path(archive_path))
+            return
+        # -h archives the compacted DB, not the symlink to it
+        run_commands([["tar", "ch", "--exclude=*" + CATALOG_SUFFIX,
+                       basename(self.get_crawl_dir(archive_path))],
+                      ["lz4", "-9zqf", "-",
+                       self.get_out_archive_path(archive_path)]],
+                     log_path, cwd=self.get_extracted_dir(archive_path))
+
+    def ship(self, archive_path, log_path):
+        self.shipper.ship(self.get_out_archive_path(archive_path),
+                          self.ship_subdir, log_path)
+
+    def cleanup(self, archive_path, log_path):
+        self.remove_scratch_root(archive_path)
+
+
+def parse_concurrency(concurrency_args):
+    concurrency = {}
+    for arg in concurrency_args:
+        stage, _, limit = arg.partition("=")
+        if stage not in STAGES or not limit.isdigit():
+            raise ValueError("Expected STAGE=N with a stage in %s: %s" % (
+                ",".join(STAGES), arg))
+        concurrency[stage] = int(limit)
+    return concurrency
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("archive_dir", help="dir of the .tar.lz4 archives")
+    parser.add_argument("out_dir")
+    parser.add_argument("scratch_dir",
+                        help="dir to extract and recompress the archives in")
+    parser.add_argument("--shipper", choices=sorted(SHIPPERS), default="scp")
+    parser.add_argument("--ship-to", default=DEFAULT_REMOTE_DIR,
+                        help="host:dir for scp, or a local dir")
+    parser.add_argument("--concurrency", action="append", default=[],
+                        metavar="STAGE=N",
+                        help="max. number of archives in a stage at once")
+    parser.add_argument("--scratch-budget-gb", type=float,
+                        help="default: %d%%%% of the free scratch space" % (
+                            DEFAULT_SCRATCH_SHARE * 100))
+    parser.add_argument("--expansion-factor", type=float,
+                        default=DEFAULT_EXPANSION_FACTOR,
+                        help="scratch space per archive, in multiples of "
+                        "the archive size")
+    parser.add_argument("--max-in-flight", type=int,
+                        default=DEFAULT_MAX_IN_FLIGHT)
+    parser.add_argument("--max-retries", type=int,
+                        default=DEFAULT_MAX_RETRIES)
+    parser.add_argument("--state-file",
+                        help="default: out_dir/%s" % STATE_FILENAME)
+    parser.add_argument("--compact-dir",
+                        help="passed to process_crawl_data.py")
+    parser.add_argument("--rank-store",
+                        help="passed to process_crawl_data.py")
+    parser.add_argument("--domain-owners",
+                        help="passed to analyze_crawl.py")
+    parser.add_argument("--redirects", action="store_true",
+                        help="passed to analyze_crawl.py")
+    parser.add_argument("--canvas-fingerprinting", action="store_true",
+                        help="passed to analyze_crawl.py")
+    parser.add_argument("--extract-all", action="store_true",
+                        help="extract the whole archive, including "
+                        "content.ldb")
+    args = parser.parse_args()
+    try:
+        concurrency = parse_concurrency(args.concurrency)
+    except ValueError as e:
+        parser.error(str(e))
+    scratch_budget = None
+    if args.scratch_budget_gb is not None:
+        scratch_budget = int(args.scratch_budget_gb * 1e9)
+    process_args = []
+    if args.compact_dir:
+        process_args += ["--compact-dir", abspath(args.compact_dir)]
+    if args.rank_store:
+        process_args += ["--rank-store", abspath(args.rank_store)]
+    analyze_args = []
+    if args.domain_owners:
+        analyze_args += ["--domain-owners", abspath(args.domain_owners)]
+    if args.redirects:
+        analyze_args.append("--redirects")
+    if args.canvas_fingerprinting:
+        analyze_args.append("--canvas-fingerprinting")
+    batch = BatchProcess(
+        args.archive_dir, args.out_dir, args.scratch_dir,
+        SHIPPERS[args.shipper](args.ship_to), concurrency=concurrency,
+        scratch_budget=scratch_budget, max_in_flight=args.max_in_flight,
+        max_retries=args.max_retries, expansion_factor=args.expansion_factor,
+        state_path=args.state_file, process_args=process_args,
+        analyze_args=analyze_args,
+        extract_all=args.extract_all)
+    sys.exit(0 if batch.run() else 1)
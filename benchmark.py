@@ -0,0 +1,364 @@
+"""Benchmark the processing scripts on synthetic crawls of several scales.
+
+For each scale a crawl is generated with generate_crawl_db.py, copied to a
+run dir and processed by the pipeline scripts, each in its own process.
+The wall time, CPU time and peak RSS of each script are recorded along
+with the stage timings from the telemetry reports. The outputs are
+compared to a golden copy, and the results are appended to a JSONL file
+for regression tracking.
+"""
+from __future__ import division
+import os
+import sys
+import json
+import shutil
+import socket
+import sqlite3
+import hashlib
+import argparse
+import subprocess
+from time import time
+from datetime import datetime
+from glob import glob
+from os.path import join, isdir, isfile, dirname, abspath, basename, \
+    relpath
+from generate_crawl_db import (CrawlDBGenerator, DEFAULT_REQUESTS_PER_SITE,
+                               DEFAULT_TP_ZIPF_EXPONENT,
+                               DEFAULT_MISSING_VISIT_ID_RATE,
+                               DEFAULT_CRAWL_DATE)
+from fix_alexa_ranks import get_alexa_csv_name
+from process_crawl_data import ALEXA_TOP1M_CSV_FILENAME
+from analyze_crawl import compare_outputs, STREAMING_ENGINE, \
+    ANALYSIS_ENGINES
+from telemetry import TELEMETRY_DIRNAME
+from rank_store import RankStore
+from crawl_archive import create_lz4_tar
+
+REPO_DIR = dirname(abspath(__file__))
+DEFAULT_SCALES = [1000, 10000]
+DEFAULT_RESULTS_FILENAME = "benchmark_results.jsonl"
+SAMPLE_DB_FILENAME = "sample.sqlite"
+DIGEST_FILENAME = "digest.json"
+PROCESS_CRAWL_DATA = "process_crawl_data"
+ANALYZE_CRAWL = "analyze_crawl"
+CREATE_SAMPLE_DBS = "create_sample_dbs"
+FIX_ALEXA_RANKS = "fix_alexa_ranks"
+BATCH_PROCESS = "batch_process"
+BATCH_DIRNAME = "batch"
+# in the order they run in the pipeline
+BENCHMARK_STEPS = [PROCESS_CRAWL_DATA, ANALYZE_CRAWL, CREATE_SAMPLE_DBS,
+                   FIX_ALEXA_RANKS, BATCH_PROCESS]
+
+
+def get_git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=REPO_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_script(script_name, args, cwd, log_path):
+    """Run a script of the repo and return its exit status and resources.
+
+    The resource usage of each child is collected with wait4, so the peak
+    RSS is measured per script.
+    """
+    cmd = [sys.executable, join(REPO_DIR, script_name + ".py")] + args
+    print "Will run", " ".join(cmd)
+    t0 = time()
+    with open(log_path, "w") as log:
+        proc = subprocess.Popen(cmd, cwd=cwd, stdout=log,
+                                stderr=subprocess.STDOUT)
+        _, status, rusage = os.wait4(proc.pid, 0)
+    wall_time = time() - t0
+    returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else \
+        -os.WTERMSIG(status)
+    return {"returncode": returncode,
+            "wall_time": wall_time,
+            "cpu_time": rusage.ru_utime + rusage.ru_stime,
+            # ru_maxrss is in KB on Linux
+            "peak_rss_mb": rusage.ru_maxrss / 1024,
+            "log": log_path}
+
+
+def get_table_digests(db_path, full_tables=()):
+    """Return the row count of each table, and a hash of the rows of the
+    `full_tables`."""
+    digests = {}
+    conn = sqlite3.connect(db_path)
+    for (table_name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'").fetchall():
+        if table_name == "sqlite_sequence":
+            continue
+        digest = {"rows": conn.execute(
+            "SELECT COUNT(*) FROM %s" % table_name).fetchone()[0]}
+        if table_name in full_tables:
+            md5 = hashlib.md5()
+            for row in conn.execute(
+                    "SELECT * FROM %s ORDER BY rowid" % table_name):
+                md5.update(repr(tuple(row)))
+            digest["md5"] = md5.hexdigest()
+        digests[table_name] = digest
+    conn.close()
+    return digests
+
+
+def read_stage_timings(out_dir):
+    """Return the stage wall times from the telemetry reports."""
+    timings = {}
+    for report_path in glob(join(out_dir, TELEMETRY_DIRNAME, "*.json")):
+        with open(report_path) as f:
+            report = json.load(f)
+        for stage in report["stages"]:
+            timings[stage["name"]] = stage["wall_time"]
+    return timings
+
+
+class Benchmark(object):
+
+    def __init__(self, work_dir, scales=DEFAULT_SCALES,
+                 steps=BENCHMARK_STEPS, golden_dir=None, update_golden=False,
+                 results_path=None, engine=STREAMING_ENGINE,
+                 generator_params=None):
+        self.work_dir = abspath(work_dir)
+        self.scales = scales
+        self.steps = steps
+        self.golden_dir = golden_dir and abspath(golden_dir)
+        self.update_golden = update_golden
+        self.results_path = results_path or join(self.work_dir,
+                                                 DEFAULT_RESULTS_FILENAME)
+        self.engine = engine
+        self.generator_params = generator_params or {}
+        self.crawl_date = self.generator_params.get("crawl_date",
+                                                    DEFAULT_CRAWL_DATE)
+        year, month, _ = self.crawl_date.split("-")
+        self.crawl_name = "%s-%s_synthetic" % (year, month)
+
+    def run(self):
+        results = []
+        for num_sites in self.scales:
+            results.append(self.run_scale(num_sites))
+        return results
+
+    def get_generated_crawl_dir(self, num_sites):
+        return join(self.work_dir, "generated", "sites-%d" % num_sites,
+                    self.crawl_name)
+
+    def generate_crawl(self, num_sites):
+        """Generate the crawl of a scale, unless it is already there."""
+        generator = CrawlDBGenerator(self.get_generated_crawl_dir(num_sites),
+                                     num_sites=num_sites,
+                                     **self.generator_params)
+        if generator.is_up_to_date():
+            print "Will reuse the crawl at", generator.crawl_dir
+        else:
+            generator.generate()
+        return generator
+
+    def copy_crawl(self, generator, run_dir):
+        if isdir(run_dir):
+            shutil.rmtree(run_dir)
+        crawl_dir = join(run_dir, self.crawl_name)
+        shutil.copytree(generator.crawl_dir, crawl_dir)
+        # FixAlexaRanks reads the top list of the crawl date from the
+        # working dir, this keeps it from downloading the list
+        year, month, day = [int(x) for x in self.crawl_date.split("-")]
+        shutil.copy(join(crawl_dir, ALEXA_TOP1M_CSV_FILENAME),
+                    join(run_dir, get_alexa_csv_name(year, month, day)))
+        return crawl_dir
+
+    def run_scale(self, num_sites):
+        scale_name = "sites-%d" % num_sites
+        print "Will benchmark", scale_name
+        generator = self.generate_crawl(num_sites)
+        run_dir = join(self.work_dir, "runs", scale_name)
+        crawl_dir = self.copy_crawl(generator, run_dir)
+        out_dir = join(run_dir, "out")
+        crawl_db_path = join(crawl_dir, self.crawl_name + ".sqlite")
+        step_args = {
+            PROCESS_CRAWL_DATA: [crawl_dir, out_dir],
+            ANALYZE_CRAWL: [crawl_dir, out_dir, "--engine", self.engine,
+                            "--redirects", "--canvas-fingerprinting"],
+            CREATE_SAMPLE_DBS: [crawl_db_path,
+                                join(run_dir, SAMPLE_DB_FILENAME)],
+        }
+        steps = {}
+        for step in self.steps:
+            log_path = join(run_dir, "%s.log" % step)
+            if step == FIX_ALEXA_RANKS:
+                # fix_alexa_ranks expects the crawled ranks that
+                # normalize_db adds, run it on a fresh copy
+                fix_crawl_dir = self.copy_crawl(generator,
+                                                join(run_dir, "fix-ranks"))
+                self.add_crawled_ranks(fix_crawl_dir)
+                steps[step] = run_script(step, [fix_crawl_dir],
+                                         join(run_dir, "fix-ranks"),
+                                         log_path)
+            elif step == BATCH_PROCESS:
+                steps[step] = self.run_batch_process(generator, run_dir,
+                                                     log_path)
+            else:
+                steps[step] = run_script(step, step_args[step], run_dir,
+                                         log_path)
+            print "%s finished in %0.1f s with status %d" % (
+                step, steps[step]["wall_time"], steps[step]["returncode"])
+        result = {"scale": scale_name,
+                  "num_sites": num_sites,
+                  "timestamp": datetime.now().isoformat(),
+                  "git_commit": get_git_commit(),
+                  "hostname": socket.gethostname(),
+                  "engine": self.engine,
+                  "generator_params": generator.params,
+                  "db_size_mb": os.path.getsize(join(
+                      generator.crawl_dir, self.crawl_name + ".sqlite")) /
+                  10**6,
+                  "steps": steps,
+                  "stages": read_stage_timings(out_dir)}
+        if self.golden_dir:
+            result["golden"] = self.check_golden(scale_name, run_dir,
+                                                 generator.params)
+        self.save_result(result)
+        return result
+
+    def run_batch_process(self, generator, run_dir, log_path):
+        """Run batch_process.py on an archive of the generated crawl, with
+        the relative paths of the README, from run_dir/batch."""
+        batch_dir = join(run_dir, BATCH_DIRNAME)
+        archive_dir = join(batch_dir, "archives", self.crawl_date[:7])
+        os.makedirs(archive_dir)
+        with create_lz4_tar(join(archive_dir,
+                                 self.crawl_name + ".tar.lz4")) as tar:
+            tar.add(generator.crawl_dir, arcname=self.crawl_name)
+        # keeps fix_alexa_ranks from downloading the top list
+        RankStore(join(batch_dir, "ranks")).ingest(
+            join(generator.crawl_dir, ALEXA_TOP1M_CSV_FILENAME),
+            date=self.crawl_date)
+        return run_script(BATCH_PROCESS,
+                          [relpath(archive_dir, batch_dir), "out", "scratch",
+                           "--shipper", "local", "--ship-to", "shipped",
+                           "--rank-store", "ranks"],
+                          batch_dir, log_path)
+
+    def add_crawled_ranks(self, crawl_dir):
+        """Add the site_rank column that normalize_db adds."""
+        conn = sqlite3.connect(join(crawl_dir, self.crawl_name + ".sqlite"))
+        columns = [row[1] for row in conn.execute(
+            "PRAGMA table_info(site_visits)")]
+        if columns and "site_rank" not in columns:
+            conn.execute("ALTER TABLE site_visits ADD COLUMN site_rank "
+                         "INTEGER")
+            conn.commit()
+        conn.close()
+
+    def get_digest(self, run_dir, params):
+        """Summarize the outputs that aren't in the analysis dir."""
+        digest = {"generator_params": params}
+        crawl_dir = join(run_dir, self.crawl_name)
+        db_paths = {PROCESS_CRAWL_DATA: join(crawl_dir,
+                                             self.crawl_name + ".sqlite"),
+                    CREATE_SAMPLE_DBS: join(run_dir, SAMPLE_DB_FILENAME),
+                    FIX_ALEXA_RANKS: join(run_dir, "fix-ranks",
+                                          self.crawl_name,
+                                          self.crawl_name + ".sqlite")}
+        for step, db_path in db_paths.iteritems():
+            if step in self.steps and isfile(db_path):
+                digest[step] = get_table_digests(db_path, ["site_visits"])
+        for schema_path in glob(join(run_dir, "out", "db-schemas", "*")):
+            with open(schema_path) as f:
+                digest[basename(schema_path)] = f.read()
+        return digest
+
+    def check_golden(self, scale_name, run_dir, params):
+        """Compare the outputs to the golden copy, or update it."""
+        golden_dir = join(self.golden_dir, scale_name)
+        digest = self.get_digest(run_dir, params)
+        if self.update_golden:
+            if isdir(golden_dir):
+                shutil.rmtree(golden_dir)
+            os.makedirs(golden_dir)
+            if isdir(join(run_dir, "out", "analysis")):
+                shutil.copytree(join(run_dir, "out", "analysis"),
+                                join(golden_dir, "analysis"))
+            with open(join(golden_dir, DIGEST_FILENAME), "w") as f:
+                json.dump(digest, f, indent=2, sort_keys=True)
+            print "Updated the golden copy at", golden_dir
+            return {"status": "updated"}
+        if not isfile(join(golden_dir, DIGEST_FILENAME)):
+            print "Missing golden copy at", golden_dir
+            return {"status": "missing"}
+        with open(join(golden_dir, DIGEST_FILENAME)) as f:
+            golden_digest = json.load(f)
+        if golden_digest["generator_params"] != params:
+            print "The golden copy was generated with different parameters"
+            return {"status": "params_differ"}
+        # round trip the digest through JSON to compare like with like
+        digest = json.loads(json.dumps(digest))
+        skipped_steps = set(BENCHMARK_STEPS) - set(self.steps)
+        different = sorted(key for key in set(digest) | set(golden_digest)
+                           if key not in skipped_steps and
+                           digest.get(key) != golden_digest.get(key))
+        different += compare_outputs(golden_dir, join(run_dir, "out"))
+        if different:
+            print "Outputs differ from the golden copy:", different
+            return {"status": "differ", "different": different}
+        print "Outputs match the golden copy"
+        return {"status": "match"}
+
+    def save_result(self, result):
+        results_dir = dirname(self.results_path)
+        if not isdir(results_dir):
+            os.makedirs(results_dir)
+        with open(self.results_path, "a") as f:
+            f.write(json.dumps(result, sort_keys=True) + "\n")
+        print "Appended the results to", self.results_path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("work_dir",
+                        help="dir for the generated crawls and the runs")
+    parser.add_argument("--scales", default=",".join(
+        str(scale) for scale in DEFAULT_SCALES),
+        help="comma separated numbers of sites")
+    parser.add_argument("--steps", default=",".join(BENCHMARK_STEPS),
+                        help="comma separated subset of %s" % ",".join(
+                            BENCHMARK_STEPS))
+    parser.add_argument("--golden-dir",
+                        help="compare the outputs to the golden copy here")
+    parser.add_argument("--update-golden", action="store_true",
+                        help="replace the golden copy with these outputs")
+    parser.add_argument("--results",
+                        help="JSONL file to append the results to")
+    parser.add_argument("--engine", choices=ANALYSIS_ENGINES,
+                        default=STREAMING_ENGINE)
+    parser.add_argument("--requests-per-site", type=int,
+                        default=DEFAULT_REQUESTS_PER_SITE)
+    parser.add_argument("--tp-zipf-exponent", type=float,
+                        default=DEFAULT_TP_ZIPF_EXPONENT)
+    parser.add_argument("--missing-visit-id-rate", type=float,
+                        default=DEFAULT_MISSING_VISIT_ID_RATE)
+    parser.add_argument("--legacy", action="store_true",
+                        help="benchmark crawls with the legacy schema")
+    args = parser.parse_args()
+    steps = args.steps.split(",")
+    for step in steps:
+        if step not in BENCHMARK_STEPS:
+            parser.error("Unknown step: %s" % step)
+    benchmark = Benchmark(
+        args.work_dir, scales=[int(x) for x in args.scales.split(",")],
+        steps=steps, golden_dir=args.golden_dir,
+        update_golden=args.update_golden, results_path=args.results,
+        engine=args.engine,
+        generator_params={"requests_per_site": args.requests_per_site,
+                          "tp_zipf_exponent": args.tp_zipf_exponent,
+                          "missing_visit_id_rate":
+                          args.missing_visit_id_rate,
+                          "legacy": args.legacy})
+    failed = ["%s %s" % (result["scale"], step)
+              for result in benchmark.run()
+              for step, step_result in sorted(result["steps"].iteritems())
+              if step_result["returncode"]]
+    if failed:
+        print "Failed steps:", ", ".join(failed)
+        sys.exit(1)
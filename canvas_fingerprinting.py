@@ -0,0 +1,213 @@
+"""Detect canvas fingerprinting scripts in one pass over javascript.
+
+The criteria are those of the Canvas-Fingerprinting notebook (taken from
+https://github.com/sensor-js/OpenWPM-mobile): on the same visit, a script
+reads the canvas (toDataURL, or getImageData of at least 16x16 pixels),
+writes a text of at least 10 ASCII characters onto it, and doesn't call
+the save, restore or addEventListener methods.
+
+The notebook keeps the visits of each script for all visits of the crawl.
+Here the state of a (script URL, visit) pair is a few flags, and it is
+dropped once the rows have moved `slack` visit ids past the visit, as in
+redirect_analysis.py. SQLite skips the rows of the other symbols, and the
+arguments are only read and parsed for the symbols that need them, and
+only until the pair has the flag they can set.
+"""
+import json
+import heapq
+from collections import defaultdict
+from db_schema import JAVASCRIPT_TABLE
+from redirect_analysis import iter_rows, DEFAULT_VISIT_ID_SLACK
+
+CANVAS_READ_FUNCS = [
+    "HTMLCanvasElement.toDataURL",
+    "CanvasRenderingContext2D.getImageData"
+    ]
+
+CANVAS_WRITE_FUNCS = [
+    "CanvasRenderingContext2D.fillText",
+    "CanvasRenderingContext2D.strokeText"
+    ]
+
+# Criteria 3 from Englehardt & Narayanan, 2016. addEventListener is only
+# called for HTMLCanvasElement.
+CANVAS_FP_DO_NOT_CALL_LIST = ["CanvasRenderingContext2D.save",
+                              "CanvasRenderingContext2D.restore",
+                              "HTMLCanvasElement.addEventListener"]
+GET_IMAGE_DATA = "CanvasRenderingContext2D.getImageData"
+# symbols whose arguments are checked
+ARGUMENT_FUNCS = CANVAS_WRITE_FUNCS + [GET_IMAGE_DATA]
+
+MIN_CANVAS_TEXT_LEN = 10
+MIN_CANVAS_IMAGE_WIDTH = 16
+MIN_CANVAS_IMAGE_HEIGHT = 16
+
+# flags of a (script URL, visit) pair
+CANVAS_READ = 1
+CANVAS_WRITE = 2
+CANVAS_BANNED_CALL = 4
+
+STAT_NAMES = ["num_canvas_calls", "num_canvas_scripts_per_visit",
+              "num_fingerprinting_scripts_per_visit", "num_excluded",
+              "num_bad_arguments", "num_late_calls", "max_pending_visits"]
+
+
+def get_canvas_text(arguments):
+    """Return the string that is written onto canvas from the arguments."""
+    if not arguments:
+        return u""
+    try:
+        # cast numbers etc. to a unicode string
+        return unicode(json.loads(arguments)["0"])
+    except Exception:
+        return u""
+
+
+def is_canvas_text_long_enough(arguments):
+    # Python 2 counts surrogate pairs such as emojis as two characters,
+    # which WordPress writes to check emoji support, so only count ASCII
+    text = get_canvas_text(arguments)
+    return len(text.encode("ascii", "ignore")) >= MIN_CANVAS_TEXT_LEN
+
+
+def are_get_image_data_dimensions_too_small(arguments):
+    """Check if the retrieved pixel data is smaller than min. dimensions.
+
+    Raises ValueError if the arguments can't be parsed."""
+    # https://developer.mozilla.org/en-US/docs/Web/API/CanvasRenderingContext2D/getImageData#Parameters  # noqa
+    try:
+        get_image_data_args = json.loads(arguments)
+        sw = int(get_image_data_args["2"])
+        sh = int(get_image_data_args["3"])
+    except (TypeError, KeyError, ValueError):
+        raise ValueError("Bad getImageData arguments: %r" % arguments)
+    return (sw < MIN_CANVAS_IMAGE_WIDTH) or (sh < MIN_CANVAS_IMAGE_HEIGHT)
+
+
+class CanvasFingerprintingAnalysis(object):
+
+    def __init__(self, db_conn, get_site_id, sites,
+                 visit_id_slack=DEFAULT_VISIT_ID_SLACK):
+        self.db_conn = db_conn
+        self.get_site_id = get_site_id
+        self.sites = sites
+        self.visit_id_slack = visit_id_slack
+        # visit id -> script URL -> flags
+        self.pending_visits = {}
+        self.pending_visit_ids = []
+        # calls of visits up to this id were resolved
+        self.resolved_up_to = 0
+        # fingerprinting script URL -> site ids
+        self.fingerprinter_site_ids = defaultdict(set)
+        self.stats = dict.fromkeys(STAT_NAMES, 0)
+
+    def iter_canvas_calls(self):
+        symbols = CANVAS_READ_FUNCS + CANVAS_WRITE_FUNCS + \
+            CANVAS_FP_DO_NOT_CALL_LIST
+        cursor = self.db_conn.cursor()
+        # plain tuples are much cheaper to build than sqlite3.Row objects
+        cursor.row_factory = None
+        cursor.execute("""SELECT visit_id, script_url, symbol, operation,
+            CASE WHEN symbol IN (%s) THEN arguments END
+            FROM %s WHERE symbol IN (%s) AND visit_id != -1
+            ORDER BY id""" % (
+                ",".join("?" * len(ARGUMENT_FUNCS)), JAVASCRIPT_TABLE,
+                ",".join("?" * len(symbols))),
+            ARGUMENT_FUNCS + symbols)
+        return iter_rows(cursor)
+
+    def get_pending_visit(self, visit_id):
+        try:
+            return self.pending_visits[visit_id]
+        except KeyError:
+            scripts = self.pending_visits[visit_id] = {}
+            heapq.heappush(self.pending_visit_ids, visit_id)
+            self.stats["max_pending_visits"] = max(
+                self.stats["max_pending_visits"], len(self.pending_visits))
+            return scripts
+
+    def get_flag(self, symbol, operation, arguments):
+        """Return the flag a call sets, 0 if none."""
+        if symbol in CANVAS_WRITE_FUNCS:
+            # writes count with any operation, as in the notebook
+            if is_canvas_text_long_enough(arguments):
+                return CANVAS_WRITE
+        elif operation != "call":
+            return 0
+        elif symbol in CANVAS_READ_FUNCS:
+            if symbol == GET_IMAGE_DATA:
+                try:
+                    if are_get_image_data_dimensions_too_small(arguments):
+                        return 0
+                except ValueError:
+                    self.stats["num_bad_arguments"] += 1
+                    return 0
+            return CANVAS_READ
+        elif symbol in CANVAS_FP_DO_NOT_CALL_LIST:
+            return CANVAS_BANNED_CALL
+        return 0
+
+    def run(self):
+        max_visit_id = 0
+        for visit_id, script_url, symbol, operation, arguments in \
+                self.iter_canvas_calls():
+            self.stats["num_canvas_calls"] += 1
+            # exclude relative URLs, data urls, blobs
+            if not script_url or not (script_url.startswith("http://") or
+                                      script_url.startswith("https://")):
+                continue
+            if visit_id <= self.resolved_up_to:
+                self.stats["num_late_calls"] += 1
+                continue
+            if visit_id > max_visit_id:
+                max_visit_id = visit_id
+                if max_visit_id - self.visit_id_slack > self.resolved_up_to:
+                    self.resolve_visits(max_visit_id - self.visit_id_slack)
+            scripts = self.get_pending_visit(visit_id)
+            flags = scripts.get(script_url, 0)
+            if symbol in CANVAS_WRITE_FUNCS and flags & CANVAS_WRITE or \
+                    symbol in CANVAS_READ_FUNCS and flags & CANVAS_READ:
+                # the flag is set, no need to parse the arguments again
+                continue
+            scripts[script_url] = flags | self.get_flag(symbol, operation,
+                                                        arguments)
+        self.resolve_visits(float("inf"))
+
+    def resolve_visits(self, resolved_up_to):
+        """Resolve the pending visits with ids up to resolved_up_to."""
+        self.resolved_up_to = resolved_up_to
+        while self.pending_visit_ids and \
+                self.pending_visit_ids[0] <= resolved_up_to:
+            visit_id = heapq.heappop(self.pending_visit_ids)
+            self.resolve_visit(visit_id, self.pending_visits.pop(visit_id))
+
+    def resolve_visit(self, visit_id, scripts):
+        site_id = None
+        for script_url, flags in scripts.iteritems():
+            self.stats["num_canvas_scripts_per_visit"] += 1
+            if flags & (CANVAS_READ | CANVAS_WRITE) != \
+                    CANVAS_READ | CANVAS_WRITE:
+                continue
+            # exclude scripts that call save, restore or addEventListener
+            # to eliminate false positives
+            if flags & CANVAS_BANNED_CALL:
+                self.stats["num_excluded"] += 1
+                continue
+            self.stats["num_fingerprinting_scripts_per_visit"] += 1
+            if site_id is None:
+                site_id = self.get_site_id(visit_id)
+            self.fingerprinter_site_ids[script_url].add(site_id)
+
+    def get_fingerprinters(self):
+        """Return the number of sites each fingerprinting script ran on."""
+        return {script_url: len(site_ids) for script_url, site_ids
+                in self.fingerprinter_site_ids.iteritems()}
+
+    def get_fingerprinting_sites(self):
+        """Return the fingerprinting scripts of each site, tab separated."""
+        site_scripts = defaultdict(list)
+        for script_url, site_ids in self.fingerprinter_site_ids.iteritems():
+            for site_id in site_ids:
+                site_scripts[self.sites[site_id]].append(script_url)
+        return {site_url: "\t".join(sorted(script_urls)) for
+                site_url, script_urls in site_scripts.iteritems()}
@@ -0,0 +1,243 @@
+"""Columnar, memory-mappable output format for the analysis results.
+
+Site URLs and third-party PS+1s are dictionary encoded: each is stored
+once, sorted, and referred to by its index. The publishers of each third
+party are stored in CSR form, i.e. a flat array of site ids and an array
+of offsets into it. All integers are little-endian.
+
+File layout:
+    header: magic, version, number of sections
+    section table: name, type code, offset and number of items of each
+    section data, each section aligned to 8 bytes
+"""
+import sys
+import mmap
+import struct
+from array import array
+from bisect import bisect_left
+from analysis_state import SITE_COUNTERS
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+MAGIC = "OWPMCOL1"
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<8sII")
+MAX_SECTION_NAME_LENGTH = 32
+SECTION_HEADER = struct.Struct("<%ds4sQQ" % MAX_SECTION_NAME_LENGTH)
+SECTION_ALIGNMENT = 8
+# type codes used in the section table, their array typecodes, sizes and
+# struct formats
+TYPE_CODES = {"u1": "B", "u4": "I", "u8": "L"}
+TYPE_SIZES = {"u1": 1, "u4": 4, "u8": 8}
+STRUCT_FORMATS = {"u1": "<B", "u4": "<I", "u8": "<Q"}
+
+SITE_OFFSETS = "site_offsets"
+SITE_STRINGS = "site_strings"
+TP_OFFSETS = "tp_offsets"
+TP_STRINGS = "tp_strings"
+PUBLISHER_OFFSETS = "pub_offsets"
+PUBLISHER_SITE_IDS = "pub_site_ids"
+NUM_THIRD_PARTIES = "sv_num_third_parties"
+# per site columns, aligned with the site ids
+SITE_COLUMNS = SITE_COUNTERS + [NUM_THIRD_PARTIES]
+
+
+def _to_le_bytes(values, type_code):
+    values = array(TYPE_CODES[type_code], values)
+    assert values.itemsize == TYPE_SIZES[type_code]
+    if sys.byteorder == "big":
+        values.byteswap()
+    return values.tostring()
+
+
+def _encode_strings(strings):
+    """Return the offsets and the concatenated UTF-8 bytes of strings."""
+    offsets = [0]
+    encoded = []
+    for string in strings:
+        encoded.append(string)
+        offsets.append(offsets[-1] + len(string))
+    return offsets, "".join(encoded)
+
+
+def _utf8(string):
+    if isinstance(string, unicode):
+        return string.encode("utf-8")
+    return string
+
+
+def write_columnar_analysis(state, out_path):
+    """Write the aggregates of an `AnalysisState` to `out_path`."""
+    site_strings = [_utf8(site_url) for site_url in state.sites.strings]
+    site_order = sorted(xrange(len(site_strings)),
+                        key=site_strings.__getitem__)
+    new_site_ids = array("I", [0]) * len(site_order)
+    for new_site_id, site_id in enumerate(site_order):
+        new_site_ids[site_id] = new_site_id
+
+    tp_strings = [_utf8(tp_ps1) for tp_ps1 in state.third_parties.strings]
+    tp_order = sorted(xrange(len(tp_strings)), key=tp_strings.__getitem__)
+    publisher_offsets = [0]
+    publisher_site_ids = array("I")
+    num_third_parties = array("I", [0]) * len(site_order)
+    for tp_id in tp_order:
+        publishers = sorted(new_site_ids[site_id] for site_id
+                            in state.compact_publishers(tp_id))
+        for site_id in publishers:
+            num_third_parties[site_id] += 1
+        publisher_site_ids.extend(publishers)
+        publisher_offsets.append(len(publisher_site_ids))
+
+    sections = []
+    offsets, strings = _encode_strings(site_strings[site_id]
+                                       for site_id in site_order)
+    sections.append((SITE_OFFSETS, "u8", offsets))
+    sections.append((SITE_STRINGS, "u1", strings))
+    offsets, strings = _encode_strings(tp_strings[tp_id]
+                                       for tp_id in tp_order)
+    sections.append((TP_OFFSETS, "u8", offsets))
+    sections.append((TP_STRINGS, "u1", strings))
+    sections.append((PUBLISHER_OFFSETS, "u8", publisher_offsets))
+    sections.append((PUBLISHER_SITE_IDS, "u4", publisher_site_ids))
+    for name in SITE_COUNTERS:
+        counter = getattr(state, name)
+        sections.append((name, "u4", [counter[site_id]
+                                      for site_id in site_order]))
+    sections.append((NUM_THIRD_PARTIES, "u4", num_third_parties))
+
+    data_offset = HEADER.size + SECTION_HEADER.size * len(sections)
+    section_table = []
+    section_data = []
+    for name, type_code, values in sections:
+        assert len(name) <= MAX_SECTION_NAME_LENGTH, name
+        data_offset += -data_offset % SECTION_ALIGNMENT
+        if type_code == "u1":
+            data = values
+        else:
+            data = _to_le_bytes(values, type_code)
+        section_table.append(SECTION_HEADER.pack(
+            name, type_code, data_offset, len(data) // TYPE_SIZES[type_code]))
+        section_data.append((data_offset, data))
+        data_offset += len(data)
+
+    with open(out_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(sections)))
+        f.write("".join(section_table))
+        for offset, data in section_data:
+            f.write("\0" * (offset - f.tell()))
+            f.write(data)
+
+
+class ColumnarAnalysisReader(object):
+    """Read a columnar analysis file without loading it into memory."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        magic, version, num_sections = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError("Not a columnar analysis file: %s" % path)
+        self.sections = {}
+        for i in xrange(num_sections):
+            name, type_code, offset, length = SECTION_HEADER.unpack_from(
+                self._mmap, HEADER.size + i * SECTION_HEADER.size)
+            self.sections[name.rstrip("\0")] = (type_code.rstrip("\0"),
+                                                 offset, length)
+        self.num_sites = self.sections[SITE_OFFSETS][2] - 1
+        self.num_third_parties = self.sections[TP_OFFSETS][2] - 1
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def _get_item(self, name, index):
+        type_code, offset, length = self.sections[name]
+        if not 0 <= index < length:
+            raise IndexError(index)
+        return struct.unpack_from(STRUCT_FORMATS[type_code], self._mmap,
+                                  offset + index * TYPE_SIZES[type_code])[0]
+
+    def _get_slice(self, name, start, stop):
+        type_code, offset, _ = self.sections[name]
+        item_size = TYPE_SIZES[type_code]
+        values = array(TYPE_CODES[type_code], self._mmap[
+            offset + start * item_size:offset + stop * item_size])
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def _get_string(self, offsets_name, strings_name, index):
+        start = self._get_item(offsets_name, index)
+        stop = self._get_item(offsets_name, index + 1)
+        offset = self.sections[strings_name][1]
+        return self._mmap[offset + start:offset + stop].decode("utf-8")
+
+    def column(self, name):
+        """Return a per site column (e.g. sv_num_requests) or any other
+        section. A zero-copy numpy view if numpy is available."""
+        type_code, offset, length = self.sections[name]
+        if np is not None:
+            return np.frombuffer(self._mmap, dtype="<" + type_code,
+                                 count=length, offset=offset)
+        return self._get_slice(name, 0, length)
+
+    def site(self, site_id):
+        return self._get_string(SITE_OFFSETS, SITE_STRINGS, site_id)
+
+    def third_party(self, tp_id):
+        return self._get_string(TP_OFFSETS, TP_STRINGS, tp_id)
+
+    def _find(self, get_string, num_strings, string):
+        if isinstance(string, str):
+            string = string.decode("utf-8")
+        # the strings are sorted by their UTF-8 bytes, which is the same
+        # as the order of the code points
+        index = bisect_left(_LazySequence(get_string, num_strings), string)
+        if index < num_strings and get_string(index) == string:
+            return index
+        raise KeyError(string)
+
+    def site_id(self, site_url):
+        return self._find(self.site, self.num_sites, site_url)
+
+    def third_party_id(self, tp_ps1):
+        return self._find(self.third_party, self.num_third_parties, tp_ps1)
+
+    def publisher_ids(self, tp_id):
+        start = self._get_item(PUBLISHER_OFFSETS, tp_id)
+        stop = self._get_item(PUBLISHER_OFFSETS, tp_id + 1)
+        return self._get_slice(PUBLISHER_SITE_IDS, start, stop)
+
+    def publishers(self, tp_ps1):
+        """Return the site URLs that embed the third party."""
+        return [self.site(site_id) for site_id
+                in self.publisher_ids(self.third_party_id(tp_ps1))]
+
+    def site_counts(self, name):
+        """Return a per site column as a site URL -> count dict, as in the
+        JSON outputs."""
+        return {self.site(site_id): count for site_id, count
+                in enumerate(self.column(name)) if count}
+
+    def iter_tp_to_publishers(self):
+        for tp_id in xrange(self.num_third_parties):
+            yield self.third_party(tp_id), [
+                self.site(site_id) for site_id in self.publisher_ids(tp_id)]
+
+
+class _LazySequence(object):
+    """Sequence view for bisecting strings stored in the file."""
+
+    def __init__(self, get_item, length):
+        self.get_item = get_item
+        self.length = length
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        return self.get_item(index)
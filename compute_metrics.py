@@ -1,13 +1,22 @@
 from __future__ import division
-import sys
-
+import os
+import json
+import sqlite3
+import hashlib
+import argparse
+from time import time
 from glob import glob
-from os.path import join, basename
+from multiprocessing import Pool
+from os.path import join, basename, isfile
 
 from util import read_json
 from db_schema import (HTTP_REQUESTS_TABLE,
                        HTTP_RESPONSES_TABLE,
                        JAVASCRIPT_TABLE)
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
 
 
 CMD_FAIL_RATES_JSON = "_command_fail_rate.json"
@@ -20,6 +29,13 @@ NUM_ENTRIES_JSON = "_num_entries.json"
 ANALYSIS_DIR = "analysis"
 DB_SCHEMAS_DIR = "db-schemas"
 LOG_FILES_DIR = "log-files"
+# per crawl JSONs the metrics are computed from
+INPUT_JSON_SUFFIXES = [CMD_FAIL_RATES_JSON, CMD_TIMEOUT_RATES_JSON,
+                       NUM_REQUESTS_JSON, NUM_RESPONSES_JSON,
+                       NUM_ENTRIES_WITHOUT_VISIT_ID_JSON, NUM_ENTRIES_JSON]
+METRICS_STORE_FILENAME = "crawl_metrics.sqlite"
+METRICS_TABLE = "crawl_metrics"
+HASH_BUFFER_SIZE = 2**20
 
 
 class CrawlMetrics(object):
@@ -37,6 +53,32 @@ class CrawlMetrics(object):
     rate_cmd_timeout_dmp_flash_cookies = 0
     rate_visits_without_responses = 0
 
+    def to_dict(self):
+        return {name: getattr(self, name) for name in METRIC_NAMES}
+
+    @classmethod
+    def from_dict(cls, metrics_dict):
+        metrics = cls()
+        for name in METRIC_NAMES:
+            setattr(metrics, name, metrics_dict[name])
+        return metrics
+
+
+METRIC_NAMES = [
+    "num_requests",
+    "num_responses",
+    "num_javascript",
+    "rate_requests_without_visit_id",
+    "rate_responses_without_visit_id",
+    "rate_javascript_without_visit_id",
+    "rate_cmd_failure_get",
+    "rate_cmd_failure_browse",
+    "rate_cmd_failure_dmp_flash_cookies",
+    "rate_cmd_timeout_get",
+    "rate_cmd_timeout_browse",
+    "rate_cmd_timeout_dmp_flash_cookies",
+    "rate_visits_without_responses"]
+
 
 class CrawlJsonCheck(object):
     """Analyze the JSON files generated by the DB processing step."""
@@ -147,24 +189,195 @@ class CrawlJsonCheck(object):
         #       self.metrics.rate_cmd_timeout_dmp_flash_cookies)
 
 
-def check_jsons_in_dir(root_json_dir):
+def get_crawl_names(root_json_dir):
     root_analysis_dir = join(root_json_dir, ANALYSIS_DIR)
     # we get the crawl names by iterating over cmd failrate json files
-    metrics = {}
     pattern = join(root_analysis_dir, "*%s" % CMD_FAIL_RATES_JSON)
-    for json_path in sorted(glob(pattern)):
-        json_basename = basename(json_path)
-        crawl_name = json_basename.replace(CMD_FAIL_RATES_JSON, "")
-        json_check = CrawlJsonCheck(root_json_dir, crawl_name)
-        try:
-            json_check.run_checks()
-            metrics[crawl_name] = json_check.metrics
-            # Results will be in json_check.metrics
-        except Exception as e:
-            print "Exception", e
+    return [basename(json_path).replace(CMD_FAIL_RATES_JSON, "")
+            for json_path in sorted(glob(pattern))]
+
+
+def get_input_paths(root_json_dir, crawl_name):
+    return [join(root_json_dir, ANALYSIS_DIR, crawl_name + suffix)
+            for suffix in INPUT_JSON_SUFFIXES]
+
+
+def get_input_stats(input_paths):
+    """Return the size and mtime of the input files, a cheap check for
+    changes before we hash them."""
+    stats = []
+    for path in input_paths:
+        if isfile(path):
+            st = os.stat(path)
+            stats.append([st.st_size, st.st_mtime])
+        else:
+            stats.append(None)
+    return json.dumps(stats)
+
+
+def get_input_checksum(input_paths):
+    md5 = hashlib.md5()
+    for path in input_paths:
+        md5.update(basename(path))
+        if not isfile(path):
+            continue
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b""):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+
+def compute_crawl_metrics(args):
+    """Compute the metrics of a crawl, in a worker process."""
+    root_json_dir, crawl_name = args
+    json_check = CrawlJsonCheck(root_json_dir, crawl_name)
+    try:
+        json_check.run_checks()
+    except Exception as e:
+        return crawl_name, None, "%s: %s" % (type(e).__name__, e)
+    return crawl_name, json_check.metrics.to_dict(), None
+
+
+class MetricsStore(object):
+    """Metrics of all crawls in a SQLite DB, one row per crawl.
+
+    Each row is keyed by the crawl name and the checksum of its input
+    JSONs, so update only recomputes new and changed crawls.
+    """
+
+    def __init__(self, store_path):
+        self.store_path = store_path
+        self.db_conn = sqlite3.connect(store_path)
+        # return the crawl names as str, as in the JSON filenames
+        self.db_conn.text_factory = str
+        self.db_conn.execute("""CREATE TABLE IF NOT EXISTS %s (
+            crawl_name TEXT PRIMARY KEY,
+            input_stats TEXT,
+            input_checksum TEXT,
+            error TEXT,
+            updated REAL,
+            %s)""" % (METRICS_TABLE, ",\n".join(
+            name for name in METRIC_NAMES)))
+        self.db_conn.commit()
+
+    def close(self):
+        self.db_conn.close()
+
+    def get_stale_crawls(self, root_json_dir, crawl_names):
+        """Return the crawls whose inputs changed since they were stored.
+
+        Crawls whose files were touched but not changed only get their
+        stats updated.
+        """
+        stored = {crawl_name: (input_stats, input_checksum) for
+                  (crawl_name, input_stats, input_checksum) in
+                  self.db_conn.execute(
+                      "SELECT crawl_name, input_stats, input_checksum "
+                      "FROM %s" % METRICS_TABLE)}
+        stale_crawls = []
+        for crawl_name in crawl_names:
+            input_paths = get_input_paths(root_json_dir, crawl_name)
+            input_stats = get_input_stats(input_paths)
+            if crawl_name in stored and \
+                    stored[crawl_name][0] == input_stats:
+                continue
+            input_checksum = get_input_checksum(input_paths)
+            if crawl_name in stored and \
+                    stored[crawl_name][1] == input_checksum:
+                self.db_conn.execute(
+                    "UPDATE %s SET input_stats = ? WHERE crawl_name = ?" %
+                    METRICS_TABLE, (input_stats, crawl_name))
+                continue
+            stale_crawls.append((crawl_name, input_stats, input_checksum))
+        self.db_conn.commit()
+        return stale_crawls
+
+    def update(self, root_json_dir, num_workers=1):
+        """Recompute the metrics of the new and changed crawls, and drop
+        the crawls that are no longer in the dir."""
+        t0 = time()
+        crawl_names = get_crawl_names(root_json_dir)
+        stale_crawls = self.get_stale_crawls(root_json_dir, crawl_names)
+        print "Will compute the metrics of %d of %d crawls" % (
+            len(stale_crawls), len(crawl_names))
+        inputs = {crawl_name: (input_stats, input_checksum) for
+                  (crawl_name, input_stats, input_checksum) in stale_crawls}
+        args = [(root_json_dir, crawl_name) for crawl_name in inputs]
+        if num_workers > 1 and len(args) > 1:
+            pool = Pool(num_workers)
+            results = pool.imap_unordered(compute_crawl_metrics, args)
+        else:
+            pool = None
+            results = (compute_crawl_metrics(arg) for arg in args)
+        columns = ["crawl_name", "input_stats", "input_checksum", "error",
+                   "updated"] + METRIC_NAMES
+        insert_query = "INSERT OR REPLACE INTO %s (%s) VALUES (%s)" % (
+            METRICS_TABLE, ",".join(columns), ",".join("?" * len(columns)))
+        for crawl_name, metrics_dict, error in results:
+            if error is not None:
+                print "Exception", crawl_name, error
+                metrics_dict = {}
+            self.db_conn.execute(insert_query, [
+                crawl_name, inputs[crawl_name][0], inputs[crawl_name][1],
+                error, time()] + [metrics_dict.get(name)
+                                  for name in METRIC_NAMES])
+        if pool is not None:
+            pool.close()
+            pool.join()
+        self.db_conn.execute(
+            "CREATE TEMP TABLE current_crawls (crawl_name TEXT)")
+        self.db_conn.executemany("INSERT INTO current_crawls VALUES (?)",
+                                 [(crawl_name,) for crawl_name
+                                  in crawl_names])
+        self.db_conn.execute(
+            "DELETE FROM %s WHERE crawl_name NOT IN "
+            "(SELECT crawl_name FROM temp.current_crawls)" % METRICS_TABLE)
+        self.db_conn.execute("DROP TABLE temp.current_crawls")
+        self.db_conn.commit()
+        print "Updated the metrics store in %0.1f s" % (time() - t0)
+
+    def get_rows(self):
+        """Return (crawl_name, metric1, metric2, ...) tuples of the crawls
+        without errors, sorted by crawl name."""
+        return self.db_conn.execute(
+            "SELECT crawl_name, %s FROM %s WHERE error IS NULL "
+            "ORDER BY crawl_name" % (",".join(METRIC_NAMES),
+                                     METRICS_TABLE)).fetchall()
+
+    def get_all_metrics(self):
+        """Return a crawl name -> CrawlMetrics dict."""
+        return {row[0]: CrawlMetrics.from_dict(dict(zip(METRIC_NAMES,
+                                                        row[1:])))
+                for row in self.get_rows()}
+
+    def to_dataframe(self):
+        """Return the metrics as a DataFrame indexed by crawl name."""
+        if pd is None:
+            raise ImportError("to_dataframe needs pandas")
+        return pd.DataFrame.from_records(
+            self.get_rows(), columns=["crawl_name"] + METRIC_NAMES,
+            index="crawl_name")
+
 
+def check_jsons_in_dir(root_json_dir, num_workers=1, store_path=None):
+    """Return the metrics of all crawls, computing only those of the new
+    and changed crawls since the last call."""
+    store = MetricsStore(store_path or join(root_json_dir,
+                                            METRICS_STORE_FILENAME))
+    store.update(root_json_dir, num_workers)
+    metrics = store.get_all_metrics()
+    store.close()
     return metrics
 
 
 if __name__ == '__main__':
-    check_jsons_in_dir(sys.argv[1])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("root_json_dir")
+    parser.add_argument("--num-workers", type=int, default=1)
+    parser.add_argument("--store",
+                        help="default: root_json_dir/%s" %
+                        METRICS_STORE_FILENAME)
+    args = parser.parse_args()
+    metrics = check_jsons_in_dir(args.root_json_dir, args.num_workers,
+                                 args.store)
+    print "Metrics for %s crawls are loaded" % len(metrics)
@@ -0,0 +1,262 @@
+"""Deduplicated store of the response bodies of many crawls.
+
+The content.ldb of each crawl is read with leveldb_reader.py, one table
+or log file per worker process. Each body is stored once, keyed by its
+content hash (http_responses.content_hash): the zlib compressed bodies are
+appended to a blob file, and an SQLite index maps each hash to the offset
+and length of its blob and the first crawl it was seen in. Bodies of
+popular scripts are shared by most crawls, so each new crawl mostly adds
+index lookups.
+
+The index can be attached to a crawl DB to join the responses to their
+bodies, see attach_content_index.
+"""
+import os
+import sys
+import zlib
+import shutil
+import sqlite3
+import argparse
+from time import time
+from multiprocessing import Pool
+from os.path import join, isdir, isfile, basename
+from leveldb_reader import get_data_files, iter_file_entries, TYPE_VALUE
+from util import connect_read_only
+from process_crawl_data import JAVASCRIPT_SRC_DIRNAME
+
+INDEX_FILENAME = "content_index.sqlite"
+BLOBS_FILENAME = "blobs.dat"
+SEGMENTS_DIRNAME = "segments"
+BLOB_COMPRESSION_LEVEL = 6
+INDEX_ALIAS = "content_index"
+# offset of the entries that aren't written to a segment
+NOT_WRITTEN = -1
+
+
+def _index_data_file(args):
+    """Read a table or log file of a store, in a worker process.
+
+    Bodies that aren't in the index yet are compressed and appended to a
+    segment file. Returns (key, seq, type, segment offset, compressed
+    length, length) of each entry, the offset is NOT_WRITTEN for known
+    hashes and deletions.
+    """
+    data_path, segment_path, index_path = args
+    index_conn = connect_read_only(index_path)
+    index_conn.text_factory = str
+    entries = []
+    with open(segment_path, "wb") as segment:
+        for key, seq, entry_type, value in iter_file_entries(data_path):
+            if entry_type != TYPE_VALUE or index_conn.execute(
+                    "SELECT 1 FROM blobs WHERE content_hash = ?",
+                    (key,)).fetchone():
+                entries.append((key, seq, entry_type, NOT_WRITTEN, 0, 0))
+                continue
+            blob = zlib.compress(value, BLOB_COMPRESSION_LEVEL)
+            entries.append((key, seq, entry_type, segment.tell(), len(blob),
+                            len(value)))
+            segment.write(blob)
+    index_conn.close()
+    return data_path, segment_path, entries
+
+
+class ContentIndex(object):
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        if not isdir(index_dir):
+            os.makedirs(index_dir)
+        self.index_path = join(index_dir, INDEX_FILENAME)
+        self.blobs_path = join(index_dir, BLOBS_FILENAME)
+        self.db_conn = sqlite3.connect(self.index_path)
+        # keys are the content hashes as they were stored by OpenWPM
+        self.db_conn.text_factory = str
+        self.db_conn.execute("""CREATE TABLE IF NOT EXISTS blobs (
+            content_hash TEXT PRIMARY KEY,
+            offset INTEGER,
+            length INTEGER,
+            raw_length INTEGER,
+            first_crawl TEXT) WITHOUT ROWID""")
+        self.db_conn.execute("""CREATE TABLE IF NOT EXISTS crawls (
+            crawl_name TEXT PRIMARY KEY,
+            num_bodies INTEGER,
+            num_new_bodies INTEGER,
+            new_raw_size INTEGER,
+            new_blobs_size INTEGER,
+            index_time REAL)""")
+        self.db_conn.commit()
+        self._blobs_file = None
+
+    def close(self):
+        if self._blobs_file is not None:
+            self._blobs_file.close()
+        self.db_conn.close()
+
+    def is_indexed(self, crawl_name):
+        return self.db_conn.execute(
+            "SELECT 1 FROM crawls WHERE crawl_name = ?",
+            (crawl_name,)).fetchone() is not None
+
+    def add_crawl(self, crawl_name, ldb_dir, num_workers=1):
+        """Add the bodies in the content.ldb of a crawl that aren't in the
+        index yet. Returns the stats of the crawl."""
+        t0 = time()
+        segments_dir = join(self.index_dir, SEGMENTS_DIRNAME, crawl_name)
+        if not isdir(segments_dir):
+            os.makedirs(segments_dir)
+        args = [(data_path, join(segments_dir, "%d.seg" % i),
+                 self.index_path)
+                for i, data_path in enumerate(get_data_files(ldb_dir))]
+        print "Will index %d files of %s" % (len(args), ldb_dir)
+        # the last entry of each key, with the segment it was written to
+        latest = {}
+        pool = Pool(num_workers) if num_workers > 1 else None
+        if pool is not None:
+            results = pool.imap_unordered(_index_data_file, args)
+        else:
+            results = (_index_data_file(arg) for arg in args)
+        for data_path, segment_path, entries in results:
+            for entry in entries:
+                key = entry[0]
+                if key not in latest or entry[1] > latest[key][1]:
+                    latest[key] = entry + (segment_path,)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        stats = self.add_blobs(crawl_name, latest)
+        shutil.rmtree(segments_dir)
+        stats["index_time"] = time() - t0
+        self.db_conn.execute(
+            "INSERT OR REPLACE INTO crawls VALUES (?, ?, ?, ?, ?, ?)",
+            (crawl_name, stats["num_bodies"], stats["num_new_bodies"],
+             stats["new_raw_size"], stats["new_blobs_size"],
+             stats["index_time"]))
+        self.db_conn.commit()
+        print "Indexed %d bodies of %s (%d new, %0.1f MB) in %0.1f s" % (
+            stats["num_bodies"], crawl_name, stats["num_new_bodies"],
+            stats["new_blobs_size"] / 1e6, stats["index_time"])
+        return stats
+
+    def add_blobs(self, crawl_name, latest):
+        """Copy the new blobs from the segments to the blob file, in
+        segment order, and add them to the index."""
+        stats = {"num_bodies": 0, "num_new_bodies": 0, "new_raw_size": 0,
+                 "new_blobs_size": 0}
+        new_entries = []
+        for entry in latest.itervalues():
+            if entry[2] != TYPE_VALUE:
+                continue
+            stats["num_bodies"] += 1
+            if entry[3] != NOT_WRITTEN:
+                new_entries.append(entry)
+        new_entries.sort(key=lambda entry: (entry[6], entry[3]))
+        blobs_file = self.get_blobs_file()
+        blobs_file.seek(0, os.SEEK_END)
+        rows = []
+        segment = None
+        for key, _, _, segment_offset, length, raw_length, segment_path \
+                in new_entries:
+            if segment is None or segment.name != segment_path:
+                if segment is not None:
+                    segment.close()
+                segment = open(segment_path, "rb")
+            segment.seek(segment_offset)
+            rows.append((key, blobs_file.tell(), length, raw_length,
+                         crawl_name))
+            blobs_file.write(segment.read(length))
+            stats["new_raw_size"] += raw_length
+            stats["new_blobs_size"] += length
+        if segment is not None:
+            segment.close()
+        # the index must only point to blobs that are on disk
+        blobs_file.flush()
+        os.fsync(blobs_file.fileno())
+        self.db_conn.executemany(
+            "INSERT OR IGNORE INTO blobs VALUES (?, ?, ?, ?, ?)", rows)
+        stats["num_new_bodies"] = len(rows)
+        return stats
+
+    def get_blobs_file(self):
+        if self._blobs_file is None:
+            # a+ would ignore seeks for the reads
+            mode = "r+b" if isfile(self.blobs_path) else "w+b"
+            self._blobs_file = open(self.blobs_path, mode)
+        return self._blobs_file
+
+    def get(self, content_hash):
+        """Return the body with a content hash, None if it's not stored."""
+        row = self.db_conn.execute(
+            "SELECT offset, length FROM blobs WHERE content_hash = ?",
+            (content_hash,)).fetchone()
+        if row is None:
+            return None
+        blobs_file = self.get_blobs_file()
+        blobs_file.seek(row[0])
+        return zlib.decompress(blobs_file.read(row[1]))
+
+    def get_stats(self):
+        num_blobs, raw_size, blobs_size = self.db_conn.execute(
+            "SELECT COUNT(*), SUM(raw_length), SUM(length) FROM blobs"
+        ).fetchone()
+        num_crawls, num_bodies = self.db_conn.execute(
+            "SELECT COUNT(*), SUM(num_bodies) FROM crawls").fetchone()
+        return {"num_blobs": num_blobs,
+                "num_crawls": num_crawls,
+                "num_bodies": num_bodies or 0,
+                "raw_size": raw_size or 0,
+                "blobs_size": blobs_size or 0}
+
+
+def attach_content_index(db_conn, index_dir, alias=INDEX_ALIAS):
+    """Attach the index to a crawl DB connection, so the responses can be
+    joined to the offsets of their bodies, e.g.
+
+    SELECT r.url, b.offset, b.length FROM http_responses r
+    JOIN content_index.blobs b ON b.content_hash = r.content_hash
+    """
+    db_conn.execute("ATTACH DATABASE ? AS %s" % alias,
+                    (join(index_dir, INDEX_FILENAME),))
+
+
+def get_ldb_dir(path):
+    """Return the content.ldb dir of a crawl dir, or path itself."""
+    if basename(path.rstrip(os.sep)) != JAVASCRIPT_SRC_DIRNAME and \
+            isdir(join(path, JAVASCRIPT_SRC_DIRNAME)):
+        return join(path, JAVASCRIPT_SRC_DIRNAME)
+    return path
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index_dir")
+    parser.add_argument("crawl_dirs", nargs="*",
+                        help="crawl dirs or their content.ldb dirs")
+    parser.add_argument("--num-workers", type=int, default=1)
+    parser.add_argument("--reindex", action="store_true",
+                        help="index the crawls that are already indexed")
+    parser.add_argument("--get", metavar="CONTENT_HASH",
+                        help="print the body with this hash")
+    args = parser.parse_args()
+    content_index = ContentIndex(args.index_dir)
+    if args.get:
+        body = content_index.get(args.get)
+        if body is None:
+            parser.exit(1, "Not in the index: %s\n" % args.get)
+        sys.stdout.write(body)
+    for crawl_dir in args.crawl_dirs:
+        ldb_dir = get_ldb_dir(crawl_dir)
+        crawl_name = basename(crawl_dir.rstrip(os.sep))
+        if crawl_name == JAVASCRIPT_SRC_DIRNAME:
+            crawl_name = basename(os.path.dirname(crawl_dir.rstrip(os.sep)))
+        if content_index.is_indexed(crawl_name) and not args.reindex:
+            print "Already indexed", crawl_name
+            continue
+        content_index.add_crawl(crawl_name, ldb_dir, args.num_workers)
+    if args.crawl_dirs:
+        stats = content_index.get_stats()
+        print "%d bodies of %d crawls are stored as %d blobs, %0.1f MB " \
+            "(%0.1f MB uncompressed)" % (
+                stats["num_bodies"], stats["num_crawls"],
+                stats["num_blobs"], stats["blobs_size"] / 1e6,
+                stats["raw_size"] / 1e6)
+    content_index.close()
@@ -0,0 +1,245 @@
+"""Read and repack the .tar.lz4 crawl archives in a single pass.
+
+Preprocessing only needs the crawl DB and a few small files, while most
+of an archive is the content.ldb dir of JavaScript sources. We stream the
+archive through `lz4 -dc` and extract the crawl DB, the logs and the top
+list, and only record the number and size of the content.ldb files from
+their tar headers. The logs and the top list can go straight to their
+backup paths in the out dir. A manifest of the archive is written to the
+crawl dir.
+
+repack_archive streams the original archive again and writes a new one
+with the processed crawl DB, so the members that weren't extracted
+never touch the scratch disk.
+"""
+import os
+import copy
+import json
+import errno
+import shutil
+import tarfile
+import argparse
+import subprocess
+import ctypes
+import ctypes.util
+from contextlib import contextmanager
+from os.path import join, isdir, isfile, basename, dirname, getsize,\
+    getmtime, isabs, normpath
+from util import CRAWL_DB_EXT
+from process_crawl_data import OPENWPM_LOG_FILENAME, CRONTAB_LOG_FILENAME,\
+    ALEXA_TOP1M_CSV_FILENAME, JAVASCRIPT_SRC_DIRNAME,\
+    ARCHIVE_MANIFEST_FILENAME, get_backup_paths
+
+# files of the crawl dir needed for preprocessing, besides the crawl DB
+CRAWL_FILENAMES = [OPENWPM_LOG_FILENAME, CRONTAB_LOG_FILENAME,
+                   ALEXA_TOP1M_CSV_FILENAME]
+COPY_BUFFER_SIZE = 2**20
+REPACK_COMPRESSION_LEVEL = 9
+
+_libc = None
+
+
+def preallocate(f, size):
+    """Reserve the disk space of a file before writing it, so it's laid out
+    contiguously and a full disk fails early rather than midway."""
+    global _libc
+    if size <= 0:
+        return
+    if hasattr(os, "posix_fallocate"):
+        os.posix_fallocate(f.fileno(), 0, size)
+        return
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    ret = _libc.posix_fallocate(f.fileno(), ctypes.c_int64(0),
+                                ctypes.c_int64(size))
+    # file systems that don't support it return EINVAL or EOPNOTSUPP
+    if ret == errno.ENOSPC:
+        raise OSError(ret, os.strerror(ret), f.name)
+
+
+@contextmanager
+def open_lz4_tar(archive_path):
+    """Open a .tar.lz4 archive for reading its members in order."""
+    proc = subprocess.Popen(["lz4", "-qdc", archive_path],
+                            stdout=subprocess.PIPE, bufsize=COPY_BUFFER_SIZE)
+    tar = tarfile.open(fileobj=proc.stdout, mode="r|",
+                       bufsize=COPY_BUFFER_SIZE)
+    try:
+        yield tar
+        # read the rest, e.g. the end of archive blocks
+        while proc.stdout.read(COPY_BUFFER_SIZE):
+            pass
+    finally:
+        tar.close()
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, "lz4 -qdc %s" %
+                                            archive_path)
+
+
+@contextmanager
+def create_lz4_tar(out_path, compression_level=REPACK_COMPRESSION_LEVEL):
+    """Open a .tar.lz4 archive for writing."""
+    proc = subprocess.Popen(["lz4", "-%dzqf" % compression_level, "-",
+                             out_path], stdin=subprocess.PIPE,
+                            bufsize=COPY_BUFFER_SIZE)
+    tar = tarfile.open(fileobj=proc.stdin, mode="w|",
+                       bufsize=COPY_BUFFER_SIZE, format=tarfile.GNU_FORMAT)
+    finished = False
+    try:
+        yield tar
+        # writes the end of archive blocks, which a failed repack must not
+        tar.close()
+        finished = True
+    finally:
+        proc.stdin.close()
+        returncode = proc.wait()
+        if not finished and isfile(out_path):
+            os.remove(out_path)
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, "lz4 -%dzq - %s" % (
+            compression_level, out_path))
+
+
+def split_member_name(name):
+    """Return the path components of a member, None if it points outside
+    the extraction dir."""
+    name = normpath(name)
+    if isabs(name) or name.startswith(".."):
+        return None
+    if name == ".":
+        return []
+    return name.split(os.sep)
+
+
+def copy_member(tar, member, dest_path):
+    """Write the data of a member to dest_path, with its mtime and mode."""
+    dest_dir = dirname(dest_path)
+    if not isdir(dest_dir):
+        os.makedirs(dest_dir)
+    src = tar.extractfile(member)
+    with open(dest_path, "wb") as f:
+        preallocate(f, member.size)
+        shutil.copyfileobj(src, f, COPY_BUFFER_SIZE)
+    os.chmod(dest_path, member.mode & 0o777)
+    os.utime(dest_path, (member.mtime, member.mtime))
+
+
+def extract_crawl_archive(archive_path, dest_dir, backup_out_dir=None):
+    """Extract the files needed for preprocessing to dest_dir.
+
+    Only the files at the top of the crawl dir are considered: the crawl
+    DB and CRAWL_FILENAMES. If backup_out_dir is given, the latter are
+    written to their backup paths in it (see process_crawl_data.py)
+    instead of dest_dir. Returns the manifest, which is also written to
+    the crawl dir.
+    """
+    manifest = {"archive": archive_path,
+                "crawl_name": None,
+                "extracted": {},
+                "backed_up": {},
+                "content_ldb": {"present": False, "num_files": 0,
+                                "size": 0},
+                "num_members": 0,
+                "size": 0,
+                "skipped_size": 0}
+    with open_lz4_tar(archive_path) as tar:
+        for member in tar:
+            manifest["num_members"] += 1
+            manifest["size"] += member.size
+            parts = split_member_name(member.name)
+            if parts is None:
+                print "Skipping member outside the crawl dir", member.name
+                continue
+            if not parts:
+                continue
+            if manifest["crawl_name"] is None:
+                manifest["crawl_name"] = parts[0]
+            if len(parts) > 1 and parts[1] == JAVASCRIPT_SRC_DIRNAME:
+                content_ldb = manifest["content_ldb"]
+                content_ldb["present"] = True
+                if member.isfile():
+                    content_ldb["num_files"] += 1
+                    content_ldb["size"] += member.size
+            if not member.isfile() or len(parts) != 2:
+                manifest["skipped_size"] += member.size
+                continue
+            filename = parts[1]
+            if filename in CRAWL_FILENAMES and backup_out_dir is not None:
+                dest_path = get_backup_paths(backup_out_dir,
+                                             parts[0])[filename]
+                manifest["backed_up"][filename] = dest_path
+            elif filename in CRAWL_FILENAMES or \
+                    filename.endswith(CRAWL_DB_EXT):
+                dest_path = join(dest_dir, *parts)
+                manifest["extracted"][member.name] = member.size
+            else:
+                manifest["skipped_size"] += member.size
+                continue
+            copy_member(tar, member, dest_path)
+    crawl_dir = join(dest_dir, manifest["crawl_name"])
+    if not isdir(crawl_dir):
+        os.makedirs(crawl_dir)
+    with open(join(crawl_dir, ARCHIVE_MANIFEST_FILENAME), "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    print "Extracted %d of %d members of %s, skipped %0.1f MB" % (
+        len(manifest["extracted"]) + len(manifest["backed_up"]),
+        manifest["num_members"], basename(archive_path),
+        manifest["skipped_size"] / 1e6)
+    return manifest
+
+
+def repack_archive(archive_path, extracted_dir, out_path,
+                   compression_level=REPACK_COMPRESSION_LEVEL):
+    """Write a copy of the archive with the files of extracted_dir.
+
+    The members that exist in extracted_dir (e.g. the processed crawl DB)
+    are replaced with those files, all others are copied from the original
+    archive. Returns the names of the replaced members.
+    """
+    replaced = []
+    with open_lz4_tar(archive_path) as tar, \
+            create_lz4_tar(out_path, compression_level) as out_tar:
+        for member in tar:
+            parts = split_member_name(member.name)
+            local_path = None
+            if parts:
+                local_path = join(extracted_dir, *parts)
+            if member.isfile() and local_path and isfile(local_path):
+                new_member = copy.copy(member)
+                new_member.size = getsize(local_path)
+                new_member.mtime = int(getmtime(local_path))
+                with open(local_path, "rb") as f:
+                    out_tar.addfile(new_member, f)
+                replaced.append(member.name)
+            elif member.isfile():
+                out_tar.addfile(member, tar.extractfile(member))
+            else:
+                out_tar.addfile(member)
+    print "Repacked %s to %s, replaced %s" % (basename(archive_path),
+                                              out_path, " ".join(replaced))
+    return replaced
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command")
+    extract_parser = subparsers.add_parser(
+        "extract", help="extract the files needed for preprocessing")
+    extract_parser.add_argument("archive_path")
+    extract_parser.add_argument("dest_dir")
+    extract_parser.add_argument(
+        "--backup-out-dir", help="write the logs and the top list to their "
+        "backup paths in this out dir")
+    repack_parser = subparsers.add_parser(
+        "repack", help="replace the extracted files in a copy of the archive")
+    repack_parser.add_argument("archive_path")
+    repack_parser.add_argument("extracted_dir")
+    repack_parser.add_argument("out_path")
+    args = parser.parse_args()
+    if args.command == "extract":
+        extract_crawl_archive(args.archive_path, args.dest_dir,
+                              args.backup_out_dir)
+    else:
+        repack_archive(args.archive_path, args.extracted_dir, args.out_path)
@@ -1,57 +1,354 @@
+"""Create small sample DBs of crawl DBs, e.g. for the notebooks.
+
+A sample has the rows of a set of visits: by default the first
+MAX_VISITS_TO_COPY_TO_SAMPLE_DB visits, or a random sample of the visits
+in each Alexa rank bucket (RANK_BUCKET_LIMITS). Tables without a visit_id
+column (crawl, task...) are copied whole.
+
+The crawl DBs have no index on visit_id, but their rows are written
+while the visits run, so visit_id grows with the rowid, give or take the
+visits that run in parallel. Rather than scanning each table, we binary
+search the rowid range of the sampled visits and only read that range,
+widened by visit_id_slack visits. Visits spread over the whole crawl
+would need most of the table anyway; then we scan it, or use a visit_id
+index, built in the crawl DB if mode is "index".
+"""
 import os
-import sys
+import random
 import sqlite3
-import subprocess
-from util import get_column_names
+import argparse
+from bisect import bisect_left
+from time import time
+from multiprocessing import Pool
+from os.path import join, basename, getsize, isfile
+from util import CRAWL_DB_EXT, READ_ONLY_MMAP_SIZE, READ_ONLY_CACHE_SIZE_MB
+from db_catalog import get_db_catalog
 
 MAX_VISITS_TO_COPY_TO_SAMPLE_DB = 1000
+SAMPLE_DB_PREFIX = "sample_"
+CRAWL_ALIAS = "crawl"
+# sampled visits with rows this far apart in the table can be out of order
+DEFAULT_VISIT_ID_SLACK = 1000
+# scan the table if the rowid ranges cover more than this fraction of it
+MAX_SEEK_FRACTION = 0.5
+# upper limits of the Alexa rank buckets of the stratified samples
+RANK_BUCKET_LIMITS = [100, 1000, 10000, 100000, 1000000]
+DEFAULT_SEED = 0
+VISIT_ID_INDEX_PREFIX = "sample_visit_id_"
+SAMPLE_MODES = ["auto", "seek", "index", "scan"]
+
+
+def get_sample_db_path(crawl_db_path, out_dir):
+    crawl_name = basename(crawl_db_path).replace(CRAWL_DB_EXT, "")
+    return join(out_dir, SAMPLE_DB_PREFIX + crawl_name + CRAWL_DB_EXT)
 
 
-def get_table_names_from_db(cursor):
-    table_names = []
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    for row in cursor.fetchall():
-        if row[0] == "sqlite_sequence":
+def get_stratified_visit_ids(db_conn, visits_per_bucket, seed=DEFAULT_SEED):
+    """Return a random sample of visits_per_bucket visits of each Alexa
+    rank bucket. Visits without a rank are left out."""
+    buckets = [[] for _ in xrange(len(RANK_BUCKET_LIMITS) + 1)]
+    for visit_id, rank in db_conn.execute(
+            "SELECT visit_id, alexa_rank FROM %s.site_visits "
+            "WHERE alexa_rank IS NOT NULL" % CRAWL_ALIAS):
+        buckets[bisect_left(RANK_BUCKET_LIMITS, rank)].append(visit_id)
+    rng = random.Random(seed)
+    visit_ids = []
+    for limit, bucket in zip(RANK_BUCKET_LIMITS + [None], buckets):
+        if not bucket:
             continue
-        table_names.append(row[0])
-    return table_names
-
-
-def create_empty_db_from_existing_db(in_db, out_db):
-    schema = subprocess.check_output(["sqlite3", in_db, '.schema'])
-    # filter `sqlite_sequence` table
-    schema = ''.join([line for line in schema.split("\n")
-                      if "sqlite_sequence" not in line])
-    conn = sqlite3.connect(out_db)
-    conn.executescript(schema)
-    conn.commit()
-    conn.close()
-
-
-def copy_rows_to_sample_db(in_db, out_db,
-                           max_visits_to_copy=MAX_VISITS_TO_COPY_TO_SAMPLE_DB):
-    conn = sqlite3.connect(in_db)
-    cursor = conn.cursor()
-    cursor.execute('ATTACH DATABASE "%s" AS db_sample' % out_db)
-    table_names = get_table_names_from_db(cursor)
-
-    visit_id_condition = "WHERE visit_id <= %s" % max_visits_to_copy
-    for table_name in table_names:
-        column_names = get_column_names(table_name, cursor)
-        if "visit_id" in column_names:
-            condition = visit_id_condition
+        sample = rng.sample(sorted(bucket),
+                            min(visits_per_bucket, len(bucket)))
+        print "Sampled %d of %d visits with rank <= %s" % (
+            len(sample), len(bucket), limit or "inf")
+        visit_ids += sample
+    return sorted(visit_ids)
+
+
+def get_visit_id_ranges(visit_ids, max_gap):
+    """Group sorted visit ids to (first, last) ranges with gaps of at most
+    max_gap."""
+    ranges = []
+    for visit_id in visit_ids:
+        if ranges and visit_id - ranges[-1][1] <= max_gap:
+            ranges[-1][1] = visit_id
         else:
-            condition = ""
-        cursor.execute('INSERT INTO db_sample.%s SELECT * FROM %s %s' %
-                       (table_name, table_name, condition))
-    conn.commit()
+            ranges.append([visit_id, visit_id])
+    return ranges
+
+
+def seek_visit_id(db_conn, table_name, visit_id, min_rowid, max_rowid):
+    """Return the first rowid of the rows of visit_id or a later visit,
+    assuming the rows are ordered by visit_id. Rows without a visit
+    (visit_id -1) are skipped."""
+    lo, hi = min_rowid, max_rowid + 1
+    while lo < hi:
+        mid = (lo + hi) // 2
+        row = db_conn.execute(
+            'SELECT rowid, visit_id FROM %s."%s" WHERE rowid >= ? AND '
+            'rowid < ? AND visit_id > 0 ORDER BY rowid LIMIT 1' % (
+                CRAWL_ALIAS, table_name), (mid, hi)).fetchone()
+        if row is None or row[1] >= visit_id:
+            hi = mid
+        else:
+            lo = row[0] + 1
+    return lo
+
+
+def get_rowid_ranges(db_conn, table_name, visit_id_ranges, slack):
+    """Return the merged [start, end) rowid ranges of the visit ranges."""
+    # SQLite only looks up MIN or MAX alone in a query, without a scan
+    min_rowid, max_rowid = [db_conn.execute(
+        'SELECT %s(rowid) FROM %s."%s"' % (func, CRAWL_ALIAS,
+                                            table_name)).fetchone()[0]
+        for func in ("MIN", "MAX")]
+    if min_rowid is None:
+        return []
+    rowid_ranges = []
+    for first, last in visit_id_ranges:
+        start = seek_visit_id(db_conn, table_name, first - slack,
+                              min_rowid, max_rowid)
+        end = seek_visit_id(db_conn, table_name, last + slack + 1,
+                            start, max_rowid)
+        if rowid_ranges and start <= rowid_ranges[-1][1]:
+            rowid_ranges[-1][1] = max(end, rowid_ranges[-1][1])
+        elif start < end:
+            rowid_ranges.append([start, end])
+    return rowid_ranges
+
+
+def has_visit_id_index(db_conn, table_name):
+    for index in db_conn.execute('PRAGMA %s.index_list("%s")' % (
+            CRAWL_ALIAS, table_name)).fetchall():
+        columns = db_conn.execute('PRAGMA %s.index_info("%s")' % (
+            CRAWL_ALIAS, index[1])).fetchall()
+        if columns and columns[0][2] == "visit_id":
+            return True
+    return False
+
+
+def copy_schema(db_conn, object_types):
+    """Create the tables, indices... of the crawl DB in the sample DB."""
+    for (sql,) in db_conn.execute(
+            "SELECT sql FROM %s.sqlite_master WHERE type IN (%s) AND "
+            "sql IS NOT NULL AND name NOT LIKE 'sqlite_%%' AND "
+            "name NOT LIKE '%s%%' ORDER BY rowid" % (
+                CRAWL_ALIAS, ",".join("'%s'" % t for t in object_types),
+                VISIT_ID_INDEX_PREFIX)).fetchall():
+        db_conn.execute(sql)
+
+
+class SampleDB(object):
+    """Copy the rows of a sample of visits from a crawl DB to a new DB."""
+
+    def __init__(self, crawl_db_path, sample_db_path, mode="auto",
+                 visit_id_slack=DEFAULT_VISIT_ID_SLACK, keep_indices=False):
+        self.crawl_db_path = crawl_db_path
+        self.sample_db_path = sample_db_path
+        self.mode = mode
+        self.visit_id_slack = visit_id_slack
+        self.keep_indices = keep_indices
+        self.catalog = get_db_catalog(crawl_db_path)
+        self.added_indices = []
+
+    def create(self, max_visits=MAX_VISITS_TO_COPY_TO_SAMPLE_DB,
+               visits_per_bucket=None, seed=DEFAULT_SEED):
+        t0 = time()
+        if visits_per_bucket is not None and \
+                not self.catalog.has_column("site_visits", "alexa_rank"):
+            raise Exception("No Alexa ranks in %s, run process_crawl_data.py"
+                            " first" % self.crawl_db_path)
+        tmp_path = self.sample_db_path + ".tmp"
+        if isfile(tmp_path):
+            os.remove(tmp_path)
+        # autocommit, we start the transactions
+        db_conn = sqlite3.connect(tmp_path, isolation_level=None)
+        db_conn.text_factory = str
+        # a failed sample is deleted, so it needs no journal
+        db_conn.execute("PRAGMA journal_mode = OFF")
+        db_conn.execute("PRAGMA synchronous = OFF")
+        db_conn.execute("PRAGMA temp_store = 2")
+        db_conn.execute("ATTACH DATABASE ? AS %s" % CRAWL_ALIAS,
+                        (self.crawl_db_path,))
+        db_conn.execute("PRAGMA %s.mmap_size = %d" % (CRAWL_ALIAS,
+                                                      READ_ONLY_MMAP_SIZE))
+        db_conn.execute("PRAGMA %s.cache_size = -%d" % (
+            CRAWL_ALIAS, READ_ONLY_CACHE_SIZE_MB * 1000))
+        finished = False
+        try:
+            if visits_per_bucket is None:
+                visit_ids = range(1, max_visits + 1)
+            else:
+                visit_ids = get_stratified_visit_ids(
+                    db_conn, visits_per_bucket, seed)
+            db_conn.execute("CREATE TEMP TABLE sample_visits "
+                            "(visit_id INTEGER PRIMARY KEY)")
+            db_conn.executemany("INSERT INTO temp.sample_visits VALUES (?)",
+                                ((visit_id,) for visit_id in visit_ids))
+            if self.mode == "index":
+                self.add_visit_id_indices(db_conn)
+            copy_schema(db_conn, ["table"])
+            db_conn.execute("BEGIN")
+            for table_name in self.catalog.table_names():
+                if table_name.startswith("sqlite_"):
+                    continue
+                self.copy_table(db_conn, table_name, visit_ids)
+            db_conn.execute("COMMIT")
+            # indices are faster to build after the rows are in
+            copy_schema(db_conn, ["index", "view", "trigger"])
+            finished = True
+        finally:
+            if not finished:
+                db_conn.rollback()
+            if not self.keep_indices:
+                for index_name in self.added_indices:
+                    db_conn.execute('DROP INDEX %s."%s"' % (CRAWL_ALIAS,
+                                                            index_name))
+            db_conn.close()
+            if not finished:
+                os.remove(tmp_path)
+        os.rename(tmp_path, self.sample_db_path)
+        print "Sampled %d visits of %s in %0.1f s. In, out DB sizes %d %d" % (
+            len(visit_ids), self.crawl_db_path, time() - t0,
+            getsize(self.crawl_db_path), getsize(self.sample_db_path))
+
+    def add_visit_id_indices(self, db_conn):
+        """Index the visit_id columns of the crawl DB that aren't indexed
+        yet. The indices are dropped after sampling, unless keep_indices."""
+        for table_name in self.catalog.table_names():
+            if not self.catalog.has_column(table_name, "visit_id") or \
+                    has_visit_id_index(db_conn, table_name):
+                continue
+            index_name = VISIT_ID_INDEX_PREFIX + table_name
+            print "Building a visit_id index on", table_name
+            db_conn.execute('CREATE INDEX %s."%s" ON "%s" (visit_id)' % (
+                CRAWL_ALIAS, index_name, table_name))
+            self.added_indices.append(index_name)
+
+    def copy_table(self, db_conn, table_name, visit_ids):
+        insert_query = 'INSERT INTO main."%s" SELECT * FROM %s."%s"' % (
+            table_name, CRAWL_ALIAS, table_name)
+        if not self.catalog.has_column(table_name, "visit_id"):
+            db_conn.execute(insert_query)
+            print "Copied all rows of", table_name
+            return
+        in_sample = " visit_id IN (SELECT visit_id FROM temp.sample_visits)"
+        has_rowid = self.catalog.tables[table_name]["max_rowid"] is not None
+        if has_rowid:
+            # keep the order of the rows
+            order_by = " ORDER BY rowid"
+        else:
+            order_by = ""
+        mode = self.mode
+        if has_visit_id_index(db_conn, table_name) and mode != "scan":
+            mode = "index"
+        elif not has_rowid:
+            mode = "scan"
+        rowid_ranges = None
+        if mode in ("auto", "seek"):
+            rowid_ranges = get_rowid_ranges(
+                db_conn, table_name,
+                get_visit_id_ranges(visit_ids, 2 * self.visit_id_slack),
+                self.visit_id_slack)
+            num_rowids = self.catalog.get_num_rows(table_name) or 1
+            seek_size = sum(end - start for start, end in rowid_ranges)
+            if mode == "auto" and seek_size > MAX_SEEK_FRACTION * num_rowids:
+                mode = "scan"
+            else:
+                mode = "seek"
+        if mode == "seek":
+            for start, end in rowid_ranges:
+                db_conn.execute(
+                    insert_query + " WHERE rowid >= ? AND rowid < ? AND" +
+                    in_sample + order_by, (start, end))
+            print "Copied %s rows in %d rowid ranges" % (table_name,
+                                                        len(rowid_ranges))
+        else:
+            db_conn.execute(insert_query + " WHERE" + in_sample + order_by)
+            print "Copied %s rows with a %s" % (
+                table_name, "visit_id index" if mode == "index" else "scan")
+
+
+def create_sample_db(crawl_db_path, sample_db_path, max_visits=
+                     MAX_VISITS_TO_COPY_TO_SAMPLE_DB, visits_per_bucket=None,
+                     seed=DEFAULT_SEED, mode="auto",
+                     visit_id_slack=DEFAULT_VISIT_ID_SLACK,
+                     keep_indices=False):
+    sample_db = SampleDB(crawl_db_path, sample_db_path, mode, visit_id_slack,
+                         keep_indices)
+    sample_db.create(max_visits, visits_per_bucket, seed)
+
+
+def _create_sample_db(args):
+    crawl_db_path, sample_db_path, kwargs = args
+    try:
+        create_sample_db(crawl_db_path, sample_db_path, **kwargs)
+    except Exception as e:
+        return crawl_db_path, "%s: %s" % (type(e).__name__, e)
+    return crawl_db_path, None
+
+
+def create_sample_dbs(crawl_db_paths, out_dir, num_workers=1, **kwargs):
+    """Create the samples of many crawl DBs in parallel. Returns the
+    crawl DBs that failed, with their errors."""
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+    args = [(crawl_db_path, get_sample_db_path(crawl_db_path, out_dir),
+             kwargs) for crawl_db_path in crawl_db_paths]
+    if num_workers > 1 and len(args) > 1:
+        pool = Pool(num_workers)
+        results = pool.imap_unordered(_create_sample_db, args)
+    else:
+        pool = None
+        results = (_create_sample_db(arg) for arg in args)
+    failed = {}
+    for crawl_db_path, error in results:
+        if error is not None:
+            print "Failed to sample %s: %s" % (crawl_db_path, error)
+            failed[crawl_db_path] = error
+    if pool is not None:
+        pool.close()
+        pool.join()
+    return failed
 
 
 # USAGE:
-# python crawl_db_path sample_crawl_db_path
+# python create_sample_dbs.py crawl_db_path sample_crawl_db_path
+# python create_sample_dbs.py --out-dir OUT_DIR crawl_db_path...
 if __name__ == '__main__':
-    in_db = sys.argv[1]
-    out_db = sys.argv[2]
-    create_empty_db_from_existing_db(in_db, out_db)
-    copy_rows_to_sample_db(in_db, out_db)
-    print "In, out DB sizes", os.path.getsize(in_db), os.path.getsize(out_db)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("db_paths", nargs="+",
+                        help="crawl DB and sample DB, or crawl DBs with "
+                        "--out-dir")
+    parser.add_argument("--out-dir", help="write the samples of the crawl "
+                        "DBs to OUT_DIR/%s<crawl name>%s" % (
+                            SAMPLE_DB_PREFIX, CRAWL_DB_EXT))
+    parser.add_argument("--num-workers", type=int, default=1)
+    parser.add_argument("--max-visits", type=int,
+                        default=MAX_VISITS_TO_COPY_TO_SAMPLE_DB,
+                        help="sample the visits with visit_id <= MAX_VISITS")
+    parser.add_argument("--visits-per-bucket", type=int,
+                        help="sample this many random visits of each Alexa "
+                        "rank bucket instead")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--mode", choices=SAMPLE_MODES, default="auto",
+                        help="how to find the rows of the visits; index "
+                        "builds visit_id indices in the crawl DB")
+    parser.add_argument("--keep-indices", action="store_true",
+                        help="keep the visit_id indices for later samples")
+    parser.add_argument("--visit-id-slack", type=int,
+                        default=DEFAULT_VISIT_ID_SLACK)
+    args = parser.parse_args()
+    kwargs = {"max_visits": args.max_visits,
+              "visits_per_bucket": args.visits_per_bucket,
+              "seed": args.seed, "mode": args.mode,
+              "visit_id_slack": args.visit_id_slack,
+              "keep_indices": args.keep_indices}
+    if args.out_dir:
+        failed = create_sample_dbs(args.db_paths, args.out_dir,
+                                   args.num_workers, **kwargs)
+        if failed:
+            parser.exit(1, "Failed to sample %d crawl DBs\n" % len(failed))
+    elif len(args.db_paths) == 2:
+        create_sample_db(args.db_paths[0], args.db_paths[1], **kwargs)
+    else:
+        parser.error("pass a crawl DB and a sample DB, or --out-dir")
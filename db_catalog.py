@@ -0,0 +1,225 @@
+"""Schema and statistics catalog of a crawl DB.
+
+The catalog lists the tables of a DB with their columns, and the row and
+page counts SQLite can give without scanning the tables: MAX(rowid), the
+AUTOINCREMENT sequence, the row counts collected by ANALYZE and, if asked
+for, the page counts of the dbstat virtual table. It is cached in a JSON
+file next to the DB, or in another dir if the DB's dir can't be written
+to, keyed by the path, size and mtime of the DB file.
+"""
+import os
+import json
+import sqlite3
+import argparse
+from collections import OrderedDict
+from os.path import abspath, isfile, isdir, join, basename
+from util import connect_read_only
+
+CATALOG_VERSION = 1
+CATALOG_SUFFIX = ".catalog.json"
+# changes of WAL mode connections don't touch the DB file until a
+# checkpoint, so the WAL file is part of the cache key
+DB_FILE_SUFFIXES = ["", "-wal"]
+SQLITE_SEQUENCE_TABLE = "sqlite_sequence"
+SQLITE_STAT1_TABLE = "sqlite_stat1"
+
+
+def get_catalog_path(db_path, catalog_dir=None):
+    if catalog_dir is None:
+        return db_path + CATALOG_SUFFIX
+    return join(catalog_dir, basename(db_path) + CATALOG_SUFFIX)
+
+
+def get_db_file_key(db_path):
+    """Return the path, size and mtime of the DB (and WAL) file."""
+    files = []
+    for suffix in DB_FILE_SUFFIXES:
+        path = db_path + suffix
+        if isfile(path):
+            st = os.stat(path)
+            files.append([suffix, st.st_size, st.st_mtime])
+    return {"path": abspath(db_path), "version": CATALOG_VERSION,
+            "files": files}
+
+
+def get_db_catalog(db_path, with_sizes=False, use_cache=True,
+                   catalog_dir=None):
+    """Return the catalog of a DB, from the cache if the DB is unchanged.
+
+    The cache is kept in `catalog_dir` if given, e.g. for DBs that are
+    opened read-only. Only committed changes are seen, as with any other
+    connection.
+    """
+    catalog_path = get_catalog_path(db_path, catalog_dir)
+    key = get_db_file_key(db_path)
+    if use_cache and isfile(catalog_path):
+        try:
+            catalog = DBCatalog.from_dict(db_path, json.load(
+                open(catalog_path)))
+        except (ValueError, KeyError):
+            catalog = None
+        if catalog is not None and catalog.key == key and \
+                (catalog.has_sizes or not with_sizes):
+            return catalog
+    catalog = DBCatalog.build(db_path, with_sizes)
+    catalog.key = key
+    if use_cache:
+        if catalog_dir is not None and not isdir(catalog_dir):
+            os.makedirs(catalog_dir)
+        catalog.save(catalog_path)
+    return catalog
+
+
+def _get_table_sizes(db_conn, table_names):
+    """Return the number of pages and bytes of each table and its indices
+    from the dbstat virtual table, which reads all pages of the DB."""
+    index_tables = dict(db_conn.execute(
+        "SELECT name, tbl_name FROM sqlite_master WHERE type='index'"))
+    sizes = {table_name: [0, 0] for table_name in table_names}
+    for name, num_pages, num_bytes in db_conn.execute(
+            "SELECT name, COUNT(*), SUM(pgsize) FROM dbstat GROUP BY name"):
+        table_name = index_tables.get(name, name)
+        if table_name in sizes:
+            sizes[table_name][0] += num_pages
+            sizes[table_name][1] += num_bytes
+    return sizes
+
+
+class DBCatalog(object):
+    """Tables, columns and row counts of a DB."""
+
+    def __init__(self, db_path, tables, key=None, has_sizes=False):
+        self.db_path = db_path
+        # table name -> dict of columns, column_types, max_rowid,
+        # sequence, analyze_rows, num_pages and size_bytes
+        self.tables = tables
+        self.key = key
+        self.has_sizes = has_sizes
+
+    @classmethod
+    def build(cls, db_path, with_sizes=False):
+        db_conn = connect_read_only(db_path)
+        tables = OrderedDict()
+        table_names = [name for (name,) in db_conn.execute(
+            "SELECT name FROM sqlite_master WHERE type='table'")]
+        for table_name in table_names:
+            table_info = db_conn.execute(
+                'PRAGMA table_info("%s")' % table_name).fetchall()
+            try:
+                max_rowid = db_conn.execute(
+                    'SELECT MAX(rowid) FROM "%s"' % table_name).fetchone()[0]
+            except sqlite3.OperationalError:
+                # WITHOUT ROWID and virtual tables
+                max_rowid = None
+            else:
+                max_rowid = max_rowid or 0
+            tables[table_name] = {
+                "columns": [column[1] for column in table_info],
+                "column_types": [column[2] for column in table_info],
+                "max_rowid": max_rowid,
+                "sequence": None,
+                "analyze_rows": None,
+                "num_pages": None,
+                "size_bytes": None}
+        if SQLITE_SEQUENCE_TABLE in tables:
+            for table_name, seq in db_conn.execute(
+                    "SELECT name, seq FROM %s" % SQLITE_SEQUENCE_TABLE):
+                if table_name in tables:
+                    tables[table_name]["sequence"] = seq
+        if SQLITE_STAT1_TABLE in tables:
+            # the first number of each stat is the number of rows
+            for table_name, stat in db_conn.execute(
+                    "SELECT tbl, stat FROM %s" % SQLITE_STAT1_TABLE):
+                if table_name in tables and stat:
+                    tables[table_name]["analyze_rows"] = int(
+                        stat.split()[0])
+        has_sizes = False
+        if with_sizes:
+            try:
+                sizes = _get_table_sizes(db_conn, table_names)
+            except sqlite3.OperationalError as e:
+                print "Can't read the table sizes from dbstat:", e
+            else:
+                for table_name, (num_pages, size_bytes) in sizes.iteritems():
+                    tables[table_name]["num_pages"] = num_pages
+                    tables[table_name]["size_bytes"] = size_bytes
+                has_sizes = True
+        db_conn.close()
+        return cls(db_path, tables, has_sizes=has_sizes)
+
+    @classmethod
+    def from_dict(cls, db_path, catalog_dict):
+        return cls(db_path, OrderedDict(catalog_dict["tables"]),
+                   catalog_dict["key"], catalog_dict["has_sizes"])
+
+    def to_dict(self):
+        return {"key": self.key,
+                "has_sizes": self.has_sizes,
+                "tables": self.tables.items()}
+
+    def save(self, catalog_path):
+        tmp_path = catalog_path + ".tmp"
+        try:
+            with open(tmp_path, "w") as f:
+                json.dump(self.to_dict(), f)
+            os.rename(tmp_path, catalog_path)
+        except (IOError, OSError) as e:
+            print "Can't cache the DB catalog at %s: %s" % (catalog_path, e)
+
+    def table_names(self):
+        return self.tables.keys()
+
+    def has_table(self, table_name):
+        return table_name in self.tables
+
+    def get_columns(self, table_name):
+        try:
+            return self.tables[table_name]["columns"]
+        except KeyError:
+            raise Exception("Cannot find table %s in the DB" % table_name)
+
+    def has_column(self, table_name, column_name):
+        return self.has_table(table_name) and \
+            column_name in self.tables[table_name]["columns"]
+
+    def get_num_rows(self, table_name):
+        """Return the number of rows without counting them.
+
+        MAX(rowid) is exact unless rows were deleted, in which case it is
+        an upper bound. Returns None if SQLite doesn't know the count.
+        """
+        table = self.tables[table_name]
+        for stat in ("max_rowid", "sequence", "analyze_rows"):
+            if table[stat] is not None:
+                return table[stat]
+        return None
+
+    def get_size_bytes(self, table_name):
+        """Return the size of a table and its indices, if the catalog was
+        built with_sizes."""
+        return self.tables[table_name]["size_bytes"]
+
+    def get_schema_str(self):
+        """Return a `table column1 column2 ...` line per table."""
+        return "".join("%s %s\n" % (table_name, " ".join(table["columns"]))
+                       for table_name, table in self.tables.iteritems())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Print the tables of a DB with their row counts")
+    parser.add_argument("db_path")
+    parser.add_argument("--sizes", action="store_true",
+                        help="also read the table sizes from dbstat "
+                        "(reads the whole DB)")
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+    catalog = get_db_catalog(args.db_path, with_sizes=args.sizes,
+                             use_cache=not args.no_cache)
+    for table_name in catalog.table_names():
+        size_bytes = catalog.get_size_bytes(table_name)
+        print "%s rows: %s columns: %d%s" % (
+            table_name, catalog.get_num_rows(table_name),
+            len(catalog.get_columns(table_name)),
+            "" if size_bytes is None else " size: %0.1f MB" % (
+                size_bytes / 1e6))
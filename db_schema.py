@@ -129,8 +129,24 @@ DB_SCHEMA_PROFILE_COOKIES = """
     );
     """
 
+DB_SCHEMA_HTTP_REDIRECTS = """
+    CREATE TABLE IF NOT EXISTS http_redirects(
+        id INTEGER PRIMARY KEY,
+        crawl_id INTEGER NOT NULL,
+        old_channel_id TEXT,
+        new_channel_id TEXT,
+        is_temporary BOOLEAN NOT NULL,
+        is_permanent BOOLEAN NOT NULL,
+        is_internal BOOLEAN NOT NULL,
+        is_sts_upgrade BOOLEAN NOT NULL,
+        time_stamp TEXT NOT NULL,
+        visit_id INTEGER NOT NULL
+    );
+    """
+
 HTTP_REQUESTS_TABLE = "http_requests"
 HTTP_RESPONSES_TABLE = "http_responses"
+HTTP_REDIRECTS_TABLE = "http_redirects"
 JAVASCRIPT_TABLE = "javascript"
 JAVASCRIPT_COOKIES_TABLE = "javascript_cookies"
 SITE_VISITS_TABLE = "site_visits"
@@ -154,6 +170,7 @@ TABLE_SCHEMAS = {HTTP_REQUESTS_TABLE: DB_SCHEMA_HTTP_REQUESTS,
 OPENWPM_TABLES = [
     HTTP_REQUESTS_TABLE,
     HTTP_RESPONSES_TABLE,
+    HTTP_REDIRECTS_TABLE,
     JAVASCRIPT_TABLE,
     JAVASCRIPT_COOKIES_TABLE,
     SITE_VISITS_TABLE,
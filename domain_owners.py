@@ -0,0 +1,58 @@
+"""Map the third party domains to the organizations that own them.
+
+The ownership list is the webXray Domain Owner List
+(https://github.com/timlib/webXray_Domain_Owner_List, domain_owners.json),
+as in the Measuring-Third-Party-Inclusion notebook. It is flattened once
+into a domain -> topmost parent organization dict, which is looked up with
+the third party PS+1s of the analysis: the sites of an organization are
+the union of the publishers of its domains (see
+AnalysisState.get_num_publishers_per_group), so the requests don't need to
+be read again.
+"""
+import json
+import argparse
+
+# the notebook corrects the ownership of the Atlas domains
+DOMAIN_OWNER_CORRECTIONS = {"atdmt.com": "Facebook",
+                            "atlassbx.com": "Facebook"}
+
+
+def get_topmost_parent(org_id, parent_orgs):
+    """Walk up the parent organizations dict."""
+    seen = set()
+    while org_id in parent_orgs and org_id not in seen:
+        seen.add(org_id)
+        org_id = parent_orgs[org_id]  # get the parent's id
+    return org_id
+
+
+def load_domain_owners(domain_owners_path):
+    """Return a domain -> topmost parent organization name dict."""
+    with open(domain_owners_path) as f:
+        webxray_list = json.load(f)
+    domain_orgs = {}  # `domain name` to (org) `id` mapping
+    parent_orgs = {}  # (org) `id` to `parent_id` mapping
+    org_names = {}  # (org) `id` to `owner_name` mapping
+    for data in webxray_list:
+        org_names[data["id"]] = data["owner_name"]
+        if data["parent_id"]:
+            parent_orgs[data["id"]] = data["parent_id"]
+        for domain in data["domains"]:
+            domain_orgs[domain] = data["id"]
+    domain_owners = {}
+    for domain, org_id in domain_orgs.iteritems():
+        top_org_id = get_topmost_parent(org_id, parent_orgs)
+        # a parent that isn't in the list leaves the domain to its org
+        domain_owners[domain] = org_names.get(top_org_id, org_names[org_id])
+    domain_owners.update(DOMAIN_OWNER_CORRECTIONS)
+    return domain_owners
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("domain_owners_json")
+    parser.add_argument("domains", nargs="+")
+    args = parser.parse_args()
+    domain_owners = load_domain_owners(args.domain_owners_json)
+    for domain in args.domains:
+        print domain, domain_owners.get(domain)
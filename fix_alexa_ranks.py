@@ -1,29 +1,37 @@
 from __future__ import division
-import sys
+import shutil
 import sqlite3
+import argparse
+import tempfile
 from time import time
-from os.path import basename, sep
+from os.path import basename, sep, isfile, join
 from subprocess import call
-from util import get_crawl_dir, get_crawl_db_path
+from util import get_crawl_dir, get_crawl_db_path, iter_alexa_ranks
+from normalize_db import attach_ranks_to_site_visits
+from rank_store import RankStore
 
 
 ALEXA_ARCHIVE_BASE_URL = "https://toplists.net.in.tum.de/archive/alexa/"
 
 
-def read_alexa_csv(csv_path):
-    alexa_ranks = {}
-    for l in open(csv_path):
-        rank, domain = l.rstrip().split(",")
-        alexa_ranks[domain] = rank
-    return alexa_ranks
+def get_alexa_csv_name(year, month, day):
+    """Return the name of the top list archive CSV for a crawl date."""
+    crawl_date_ymd = "%04d-%02d-%02d" % (year, month, day)
+    # file name structure changes on 2018-05-24
+    if (year, month, day) < (2018, 5, 24):
+        return "alexa-top1m-%s.csv" % crawl_date_ymd
+    return "alexa-top1m-%s_0900_UTC.csv" % crawl_date_ymd
 
 
 class FixAlexaRanks(object):
 
-    def __init__(self, crawl_dir):
+    def __init__(self, crawl_dir, rank_store_dir=None):
         self.crawl_dir = get_crawl_dir(crawl_dir)
         self.crawl_name = basename(crawl_dir.rstrip(sep))
         self.crawl_db_path = get_crawl_db_path(self.crawl_dir)
+        self.rank_store = None
+        if rank_store_dir:
+            self.rank_store = RankStore(rank_store_dir)
         self.init_db()
         self.get_crawl_start_date()
 
@@ -46,16 +54,15 @@ class FixAlexaRanks(object):
         self.crawl_year, self.crawl_month, self.crawl_day = [
             int(x) for x in self.crawl_date_ymd.split("-")]
 
+    def get_alexa_csv_name(self):
+        return get_alexa_csv_name(self.crawl_year, self.crawl_month,
+                                  self.crawl_day)
+
     def download_alexa_ranks(self):
-        # file name structure changes on 2018-05-24
-        if (self.crawl_year < 2018 or
-                (self.crawl_year == 2018 and self.crawl_month < 5) or
-                (self.crawl_year == 2018 and self.crawl_month == 5 and
-                 self.crawl_day < 24)):
-            alexa_csv_name = "alexa-top1m-%s.csv" % self.crawl_date_ymd
-        else:
-            alexa_csv_name = "alexa-top1m-%s_0900_UTC.csv" % \
-                self.crawl_date_ymd
+        alexa_csv_name = self.get_alexa_csv_name()
+        if isfile(alexa_csv_name):
+            print "Will use the existing top list", alexa_csv_name
+            return alexa_csv_name
 
         alexa_xz_archive_name = "%s.xz" % alexa_csv_name
         alexa_xz_archive_url = ALEXA_ARCHIVE_BASE_URL + alexa_xz_archive_name
@@ -78,28 +85,48 @@ class FixAlexaRanks(object):
         self.db_conn.execute("""UPDATE site_visits
              SET alexa_rank = crawled_alexa_rank;""")
 
+    def get_stored_ranks(self):
+        """Return the RankList of the crawl date, adding the top list to
+        the store first if it's not there."""
+        if not self.rank_store.has_date(self.crawl_date_ymd):
+            alexa_csv_name = self.get_alexa_csv_name()
+            if isfile(alexa_csv_name):
+                self.rank_store.ingest(alexa_csv_name, self.crawl_date_ymd)
+            else:
+                # the store keeps the ranks, not the archive
+                download_dir = tempfile.mkdtemp(
+                    dir=self.rank_store.store_dir)
+                try:
+                    alexa_xz_archive_name = "%s.xz" % alexa_csv_name
+                    call(["wget", ALEXA_ARCHIVE_BASE_URL +
+                          alexa_xz_archive_name], cwd=download_dir)
+                    self.rank_store.ingest(
+                        join(download_dir, alexa_xz_archive_name),
+                        self.crawl_date_ymd)
+                finally:
+                    shutil.rmtree(download_dir)
+        return self.rank_store.get_ranks(self.crawl_date_ymd)
+
     def add_real_alexa_rank_to_site_visits(self):
-        real_visit_ranks = {}
-        alexa_csv_name = self.download_alexa_ranks()
-        real_alexa_ranks = read_alexa_csv(alexa_csv_name)
-        num_null_ranks = 0
-        for visit_id, site_url in self.db_conn.execute(
-             "SELECT visit_id, site_url FROM site_visits"):
-            site_address = site_url.replace("http://", "")
-            real_visit_ranks[visit_id] = real_alexa_ranks.get(site_address,
-                                                              None)
-
-        for visit_id, alexa_rank in real_visit_ranks.iteritems():
-            if alexa_rank is None:
-                num_null_ranks += 1
-            self.db_conn.execute("UPDATE site_visits SET alexa_rank=? "
-                                 "WHERE visit_id=?",
-                                 (alexa_rank, visit_id))
+        if self.rank_store is None:
+            alexa_csv_name = self.download_alexa_ranks()
+            num_null_ranks = attach_ranks_to_site_visits(
+                self.db_conn, iter_alexa_ranks(alexa_csv_name), "alexa_rank")
+        else:
+            with self.get_stored_ranks() as rank_list:
+                num_null_ranks = attach_ranks_to_site_visits(
+                    self.db_conn, rank_list.iteritems(), "alexa_rank")
         print "NULL ranks", self.crawl_name, num_null_ranks
 
 
 if __name__ == '__main__':
     t0 = time()
-    fix_ranks = FixAlexaRanks(sys.argv[1])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("crawl_dir")
+    parser.add_argument("--rank-store",
+                        help="read the top lists from this rank_store.py "
+                        "dir, adding the missing ones")
+    args = parser.parse_args()
+    fix_ranks = FixAlexaRanks(args.crawl_dir, args.rank_store)
     fix_ranks.fix_alexa_ranks()
     print "Ranks were updated in %0.1f mins" % ((time() - t0) / 60)
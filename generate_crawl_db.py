@@ -0,0 +1,419 @@
+"""Generate synthetic, OpenWPM-shaped crawl databases for benchmarking.
+
+The tables are created from db_schema.TABLE_SCHEMAS, plus site_visits,
+crawl, task, crawl_history and http_redirects. Legacy crawls are generated with top_url
+(or page_url) columns instead of visit_id, a CrawlHistory table and no
+site_visits table, as they were before normalize_db, and without
+redirects.
+"""
+from __future__ import division
+import os
+import json
+import random
+import sqlite3
+import argparse
+from bisect import bisect
+from time import time
+from os.path import join, isdir, isfile, basename, sep
+from db_schema import (TABLE_SCHEMAS, HTTP_REQUESTS_TABLE,
+                       HTTP_RESPONSES_TABLE, JAVASCRIPT_TABLE,
+                       JAVASCRIPT_COOKIES_TABLE, HTTP_REDIRECTS_TABLE,
+                       DB_SCHEMA_HTTP_REDIRECTS)
+from normalize_db import create_site_visits_table
+from process_crawl_data import (OPENWPM_LOG_FILENAME,
+                                ALEXA_TOP1M_CSV_FILENAME)
+
+DEFAULT_NUM_SITES = 1000
+DEFAULT_REQUESTS_PER_SITE = 20
+DEFAULT_JAVASCRIPT_PER_SITE = 10
+DEFAULT_COOKIES_PER_SITE = 2
+DEFAULT_NUM_THIRD_PARTIES = 1000
+# third parties are picked with a Zipf distribution with this exponent
+DEFAULT_TP_ZIPF_EXPONENT = 1.0
+# fraction of the requests that go to a third party
+DEFAULT_TP_REQUEST_RATE = 0.5
+DEFAULT_MISSING_VISIT_ID_RATE = 0.01
+# fraction of the requests that a visit's previous request redirected to
+DEFAULT_REDIRECT_RATE = 0.05
+# fraction of the redirects that are HTTP to HTTPS upgrades
+STS_UPGRADE_RATE = 0.1
+DEFAULT_FAILURE_RATE = 0.03
+DEFAULT_TIMEOUT_RATE = 0.02
+DEFAULT_NUM_CRAWLERS = 2
+DEFAULT_CRAWL_DATE = "2018-06-01"
+DEFAULT_SEED = 0
+# insert this many rows at once
+INSERT_BATCH_SIZE = 10**4
+GENERATOR_PARAMS_FILENAME = "generator_params.json"
+
+DB_SCHEMA_TASK = """
+    CREATE TABLE IF NOT EXISTS task (
+        task_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        start_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+        manager_params TEXT NOT NULL,
+        openwpm_version TEXT NOT NULL,
+        browser_version TEXT NOT NULL);
+    """
+
+DB_SCHEMA_CRAWL = """
+    CREATE TABLE IF NOT EXISTS crawl (
+        crawl_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        task_id INTEGER NOT NULL,
+        browser_params TEXT NOT NULL,
+        screen_res TEXT,
+        ua_string TEXT,
+        finished BOOLEAN NOT NULL DEFAULT 0,
+        start_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+        FOREIGN KEY(task_id) REFERENCES task(task_id));
+    """
+
+DB_SCHEMA_CRAWL_HISTORY = """
+    CREATE TABLE IF NOT EXISTS %s (
+        crawl_id INTEGER,
+        command TEXT,
+        arguments TEXT,
+        bool_success INTEGER,
+        dtg DATETIME DEFAULT (CURRENT_TIMESTAMP),
+        FOREIGN KEY(crawl_id) REFERENCES crawl(id));
+    """
+
+# tables whose visit_id column was page_url in the legacy schema
+LEGACY_PAGE_URL_TABLES = ["flash_cookies", "profile_cookies"]
+
+JAVASCRIPT_CALLS = [
+    ("window.navigator.userAgent", "get", "", ""),
+    ("window.navigator.plugins", "get", "", ""),
+    ("window.screen.colorDepth", "get", "", "24"),
+    ("window.document.cookie", "get", "", ""),
+    ("window.document.cookie", "set", "", "_ga=GA1.2.1"),
+    ("window.localStorage", "get", "", ""),
+    ("HTMLCanvasElement.toDataURL", "call", "", ""),
+    ("CanvasRenderingContext2D.fillText", "call",
+     '{"0":"Cwm fjordbank glyphs vext quiz","1":2,"2":15}', ""),
+    ("CanvasRenderingContext2D.fillStyle", "set", "", "#f60"),
+]
+THIRD_PARTY_SUFFIXES = ["com", "net", "co.uk", "com.br", "io"]
+FIRST_PARTY_PATHS = ["/", "/main.css", "/app.js", "/logo.png",
+                     "/api/data?id=1"]
+THIRD_PARTY_PATHS = ["/analytics.js", "/pixel.gif?u=1", "/ads/slot",
+                     "/sync?partner=2", "/widget.js"]
+
+
+def get_legacy_schema(create_query, table_name):
+    """Turn a table schema into its pre-normalization version."""
+    url_column = "page_url" if table_name in LEGACY_PAGE_URL_TABLES \
+        else "top_url"
+    lines = []
+    for line in create_query.split("\n"):
+        if "REFERENCES site_visits" in line:
+            continue
+        if line.strip().startswith("visit_id "):
+            line = line.split("visit_id ")[0] + "%s TEXT," % url_column
+        lines.append(line)
+    # drop the comma of the last column if it was followed by the key
+    query = "\n".join(lines)
+    return query.replace(",\n    );", "\n    );").replace(
+        "),\n    );", ")\n    );")
+
+
+class CrawlDBGenerator(object):
+
+    def __init__(self, crawl_dir, num_sites=DEFAULT_NUM_SITES,
+                 requests_per_site=DEFAULT_REQUESTS_PER_SITE,
+                 javascript_per_site=DEFAULT_JAVASCRIPT_PER_SITE,
+                 cookies_per_site=DEFAULT_COOKIES_PER_SITE,
+                 num_third_parties=DEFAULT_NUM_THIRD_PARTIES,
+                 tp_zipf_exponent=DEFAULT_TP_ZIPF_EXPONENT,
+                 tp_request_rate=DEFAULT_TP_REQUEST_RATE,
+                 missing_visit_id_rate=DEFAULT_MISSING_VISIT_ID_RATE,
+                 redirect_rate=DEFAULT_REDIRECT_RATE,
+                 failure_rate=DEFAULT_FAILURE_RATE,
+                 timeout_rate=DEFAULT_TIMEOUT_RATE,
+                 num_crawlers=DEFAULT_NUM_CRAWLERS,
+                 crawl_date=DEFAULT_CRAWL_DATE, legacy=False,
+                 seed=DEFAULT_SEED):
+        self.crawl_dir = crawl_dir
+        self.crawl_name = basename(crawl_dir.rstrip(sep))
+        self.crawl_db_path = join(crawl_dir, self.crawl_name + ".sqlite")
+        self.params = {"num_sites": num_sites,
+                       "requests_per_site": requests_per_site,
+                       "javascript_per_site": javascript_per_site,
+                       "cookies_per_site": cookies_per_site,
+                       "num_third_parties": num_third_parties,
+                       "tp_zipf_exponent": tp_zipf_exponent,
+                       "tp_request_rate": tp_request_rate,
+                       "missing_visit_id_rate": missing_visit_id_rate,
+                       "redirect_rate": redirect_rate,
+                       "failure_rate": failure_rate,
+                       "timeout_rate": timeout_rate,
+                       "num_crawlers": num_crawlers,
+                       "crawl_date": crawl_date,
+                       "legacy": legacy,
+                       "seed": seed}
+        self.rng = random.Random(seed)
+        # the redirects have their own generator, so the other tables don't
+        # change with the redirect rate
+        self.redirect_rng = random.Random(seed + 1)
+        self.third_parties = ["tracker%d.%s" % (i, THIRD_PARTY_SUFFIXES[
+            i % len(THIRD_PARTY_SUFFIXES)]) for i in xrange(num_third_parties)]
+        # cumulative Zipf weights of the third parties
+        self.tp_cum_weights = []
+        total = 0
+        for rank in xrange(1, num_third_parties + 1):
+            total += 1 / rank ** tp_zipf_exponent
+            self.tp_cum_weights.append(total)
+
+    def is_up_to_date(self):
+        """Return True if the DB was generated with the same parameters."""
+        params_path = join(self.crawl_dir, GENERATOR_PARAMS_FILENAME)
+        if not isfile(params_path) or not isfile(self.crawl_db_path):
+            return False
+        with open(params_path) as f:
+            return json.load(f) == self.params
+
+    def generate(self):
+        t0 = time()
+        if not isdir(self.crawl_dir):
+            os.makedirs(self.crawl_dir)
+        if isfile(self.crawl_db_path):
+            os.remove(self.crawl_db_path)
+        self.db_conn = sqlite3.connect(self.crawl_db_path)
+        self.db_conn.execute("PRAGMA synchronous = OFF;")
+        self.db_conn.execute("PRAGMA journal_mode = OFF;")
+        self.create_tables()
+        self.insert_crawls()
+        self.insert_visits()
+        self.db_conn.commit()
+        self.db_conn.close()
+        self.write_crawl_files()
+        with open(join(self.crawl_dir, GENERATOR_PARAMS_FILENAME), "w") as f:
+            json.dump(self.params, f, indent=2, sort_keys=True)
+        print "Generated %s in %0.1f s (%0.1f MB)" % (
+            self.crawl_db_path, time() - t0,
+            os.path.getsize(self.crawl_db_path) / 10**6)
+
+    def create_tables(self):
+        legacy = self.params["legacy"]
+        for table_name, create_query in TABLE_SCHEMAS.iteritems():
+            if legacy:
+                create_query = get_legacy_schema(create_query, table_name)
+            self.db_conn.execute(create_query)
+        self.db_conn.execute(DB_SCHEMA_TASK)
+        self.db_conn.execute(DB_SCHEMA_CRAWL)
+        if legacy:
+            self.db_conn.execute(DB_SCHEMA_CRAWL_HISTORY % "CrawlHistory")
+        else:
+            self.db_conn.execute(DB_SCHEMA_CRAWL_HISTORY % "crawl_history")
+            self.db_conn.execute(DB_SCHEMA_HTTP_REDIRECTS)
+            create_site_visits_table(self.db_conn)
+
+    def insert_crawls(self):
+        start_time = "%s 09:00:00" % self.params["crawl_date"]
+        self.db_conn.execute(
+            "INSERT INTO task (task_id, start_time, manager_params, "
+            "openwpm_version, browser_version) VALUES (1, ?, '{}', "
+            "'synthetic', 'Firefox 52.0')", (start_time,))
+        for crawl_id in xrange(1, self.params["num_crawlers"] + 1):
+            self.db_conn.execute(
+                "INSERT INTO crawl (crawl_id, task_id, browser_params, "
+                "finished, start_time) VALUES (?, 1, '{}', 1, ?)",
+                (crawl_id, start_time))
+
+    def get_site_url(self, site_rank):
+        return "http://site%d.com" % site_rank
+
+    def pick_third_party(self):
+        index = bisect(self.tp_cum_weights,
+                       self.rng.random() * self.tp_cum_weights[-1])
+        return self.third_parties[min(index, len(self.third_parties) - 1)]
+
+    def pick_count(self, mean):
+        """Return a count between 0 and 2 * mean, with the given mean."""
+        return self.rng.randint(0, 2 * mean) if mean else 0
+
+    def insert_visits(self):
+        legacy = self.params["legacy"]
+        # the url column that links the rows to visits in legacy crawls
+        visit_column = "top_url" if legacy else "visit_id"
+        crawl_history_table = "CrawlHistory" if legacy else "crawl_history"
+        queries = {
+            HTTP_REQUESTS_TABLE: "INSERT INTO http_requests (crawl_id, %s, "
+            "url, top_level_url, method, referrer, headers, channel_id, "
+            "is_XHR, is_frame_load, is_full_page, is_third_party_channel, "
+            "is_third_party_window, content_policy_type, time_stamp) "
+            "VALUES (?,?,?,?,'GET','','[]',?,0,0,0,?,?,?,?)" % visit_column,
+            HTTP_RESPONSES_TABLE: "INSERT INTO http_responses (crawl_id, %s,"
+            " url, method, referrer, response_status, response_status_text,"
+            " is_cached, headers, channel_id, location, time_stamp) VALUES "
+            "(?,?,?,'GET','',200,'OK',0,'[]',?,'',?)" % visit_column,
+            JAVASCRIPT_TABLE: "INSERT INTO javascript (crawl_id, %s, "
+            "script_url, script_line, script_col, document_url, "
+            "top_level_url, symbol, operation, value, arguments, time_stamp)"
+            " VALUES (?,?,?,'1','100',?,?,?,?,?,?,?)" % visit_column,
+            JAVASCRIPT_COOKIES_TABLE: "INSERT INTO javascript_cookies ("
+            "crawl_id, %s, change, creationTime, expiry, is_http_only, "
+            "is_session, host, is_domain, is_secure, name, path, value) "
+            "VALUES (?,?,'added',?,?,0,0,?,1,0,?,'/',?)" % visit_column,
+            crawl_history_table: "INSERT INTO %s (crawl_id, command, "
+            "arguments, bool_success, dtg) VALUES (?,'GET',?,?,?)" %
+            crawl_history_table,
+        }
+        if not legacy:
+            queries["site_visits"] = "INSERT INTO site_visits (visit_id, " \
+                "crawl_id, site_url) VALUES (?,?,?)"
+            queries[HTTP_REDIRECTS_TABLE] = "INSERT INTO http_redirects (" \
+                "crawl_id, old_channel_id, new_channel_id, is_temporary, " \
+                "is_permanent, is_internal, is_sts_upgrade, time_stamp, " \
+                "visit_id) VALUES (?,?,?,1,0,0,?,?,?)"
+        rows = {table_name: [] for table_name in queries}
+        channel_id = 0
+        rng = self.rng
+        redirect_rng = self.redirect_rng
+        params = self.params
+        for visit_id in xrange(1, params["num_sites"] + 1):
+            site_url = self.get_site_url(visit_id)
+            crawl_id = 1 + visit_id % params["num_crawlers"]
+            time_stamp = "%sT09:%02d:%02d.000Z" % (
+                params["crawl_date"], visit_id // 60 % 60, visit_id % 60)
+            if legacy:
+                visit_key = site_url
+            else:
+                rows["site_visits"].append((visit_id, crawl_id, site_url))
+            outcome = rng.random()
+            if outcome < params["failure_rate"]:
+                bool_success = 0
+            elif outcome < params["failure_rate"] + params["timeout_rate"]:
+                bool_success = -1
+            else:
+                bool_success = 1
+            rows[crawl_history_table].append(
+                (crawl_id, json.dumps([site_url]), bool_success, time_stamp))
+
+            num_requests = max(1, self.pick_count(
+                params["requests_per_site"]))
+            for request_index in xrange(num_requests):
+                channel_id += 1
+                is_tp = request_index and \
+                    rng.random() < params["tp_request_rate"]
+                if is_tp:
+                    url = "https://%s%s" % (self.pick_third_party(),
+                                            rng.choice(THIRD_PARTY_PATHS))
+                else:
+                    url = site_url + rng.choice(FIRST_PARTY_PATHS)
+                if not legacy:
+                    visit_key = visit_id
+                    if rng.random() < params["missing_visit_id_rate"]:
+                        visit_key = -1
+                rows[HTTP_REQUESTS_TABLE].append(
+                    (crawl_id, visit_key, url, site_url,
+                     "%d-%d" % (crawl_id, channel_id), int(is_tp),
+                     int(is_tp), 2 if is_tp else 6, time_stamp))
+                rows[HTTP_RESPONSES_TABLE].append(
+                    (crawl_id, visit_key, url,
+                     "%d-%d" % (crawl_id, channel_id), time_stamp))
+                # consecutive redirects make chains
+                if not legacy and request_index and \
+                        redirect_rng.random() < params["redirect_rate"]:
+                    is_sts_upgrade = redirect_rng.random() < STS_UPGRADE_RATE
+                    rows[HTTP_REDIRECTS_TABLE].append(
+                        (crawl_id, "%d-%d" % (crawl_id, channel_id - 1),
+                         "%d-%d" % (crawl_id, channel_id),
+                         int(is_sts_upgrade), time_stamp, visit_id))
+
+            for _ in xrange(self.pick_count(params["javascript_per_site"])):
+                symbol, operation, arguments, value = rng.choice(
+                    JAVASCRIPT_CALLS)
+                script_url = "https://%s/analytics.js" % (
+                    self.pick_third_party())
+                if not legacy:
+                    visit_key = visit_id
+                    if rng.random() < params["missing_visit_id_rate"]:
+                        visit_key = -1
+                rows[JAVASCRIPT_TABLE].append(
+                    (crawl_id, visit_key, script_url, site_url, site_url,
+                     symbol, operation, value, arguments, time_stamp))
+
+            for cookie_index in xrange(self.pick_count(
+                    params["cookies_per_site"])):
+                host = "." + self.pick_third_party()
+                if not legacy:
+                    visit_key = visit_id
+                rows[JAVASCRIPT_COOKIES_TABLE].append(
+                    (crawl_id, visit_key, time_stamp, "2019-06-01T09:00:00Z",
+                     host, "uid%d" % cookie_index, "%016x" % rng.getrandbits(
+                         64)))
+
+            if visit_id % INSERT_BATCH_SIZE == 0:
+                self.insert_rows(queries, rows)
+        self.insert_rows(queries, rows)
+
+    def insert_rows(self, queries, rows):
+        for table_name, table_rows in rows.iteritems():
+            if table_rows:
+                self.db_conn.executemany(queries[table_name], table_rows)
+                del table_rows[:]
+
+    def write_crawl_files(self):
+        """Write the top list and the log file that come with a crawl."""
+        with open(join(self.crawl_dir, ALEXA_TOP1M_CSV_FILENAME), "w") as f:
+            for site_rank in xrange(1, self.params["num_sites"] + 1):
+                f.write("%d,%s\n" % (site_rank, self.get_site_url(
+                    site_rank).replace("http://", "")))
+        with open(join(self.crawl_dir, OPENWPM_LOG_FILENAME), "w") as f:
+            f.write("Synthetic crawl %s\n" % json.dumps(self.params,
+                                                       sort_keys=True))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("crawl_dir",
+                        help="output dir, its name is used as the crawl "
+                        "name, e.g. /tmp/2018-06_synthetic")
+    parser.add_argument("--num-sites", type=int, default=DEFAULT_NUM_SITES)
+    parser.add_argument("--requests-per-site", type=int,
+                        default=DEFAULT_REQUESTS_PER_SITE)
+    parser.add_argument("--javascript-per-site", type=int,
+                        default=DEFAULT_JAVASCRIPT_PER_SITE)
+    parser.add_argument("--cookies-per-site", type=int,
+                        default=DEFAULT_COOKIES_PER_SITE)
+    parser.add_argument("--num-third-parties", type=int,
+                        default=DEFAULT_NUM_THIRD_PARTIES)
+    parser.add_argument("--tp-zipf-exponent", type=float,
+                        default=DEFAULT_TP_ZIPF_EXPONENT,
+                        help="skew of the third party popularity")
+    parser.add_argument("--tp-request-rate", type=float,
+                        default=DEFAULT_TP_REQUEST_RATE,
+                        help="fraction of requests to third parties")
+    parser.add_argument("--missing-visit-id-rate", type=float,
+                        default=DEFAULT_MISSING_VISIT_ID_RATE,
+                        help="fraction of rows with visit_id = -1")
+    parser.add_argument("--redirect-rate", type=float,
+                        default=DEFAULT_REDIRECT_RATE,
+                        help="fraction of requests that are redirects of "
+                        "the previous request")
+    parser.add_argument("--failure-rate", type=float,
+                        default=DEFAULT_FAILURE_RATE)
+    parser.add_argument("--timeout-rate", type=float,
+                        default=DEFAULT_TIMEOUT_RATE)
+    parser.add_argument("--num-crawlers", type=int,
+                        default=DEFAULT_NUM_CRAWLERS)
+    parser.add_argument("--crawl-date", default=DEFAULT_CRAWL_DATE)
+    parser.add_argument("--legacy", action="store_true",
+                        help="use top_url columns and a CrawlHistory "
+                        "table, without site_visits")
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    args = parser.parse_args()
+    generator = CrawlDBGenerator(
+        args.crawl_dir, num_sites=args.num_sites,
+        requests_per_site=args.requests_per_site,
+        javascript_per_site=args.javascript_per_site,
+        cookies_per_site=args.cookies_per_site,
+        num_third_parties=args.num_third_parties,
+        tp_zipf_exponent=args.tp_zipf_exponent,
+        tp_request_rate=args.tp_request_rate,
+        missing_visit_id_rate=args.missing_visit_id_rate,
+        redirect_rate=args.redirect_rate,
+        failure_rate=args.failure_rate, timeout_rate=args.timeout_rate,
+        num_crawlers=args.num_crawlers, crawl_date=args.crawl_date,
+        legacy=args.legacy, seed=args.seed)
+    generator.generate()
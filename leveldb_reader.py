@@ -0,0 +1,375 @@
+"""Read the files of a LevelDB store (e.g. content.ldb) without LevelDB.
+
+OpenWPM saves the response bodies in LevelDB, keyed by their content
+hash. This reads the table files (.ldb, .sst) and the write-ahead logs
+(.log) of the store directly, so they can be processed in parallel and
+on machines without LevelDB. Only the live files listed in the MANIFEST
+are read: a stopped or crashed crawl can leave unfinished compaction
+outputs, which LevelDB deletes on the next open. The entry with the
+highest sequence number of a key wins, see iter_live_entries.
+
+Formats: https://github.com/google/leveldb/blob/master/doc/table_format.md
+https://github.com/google/leveldb/blob/master/doc/log_format.md
+and https://github.com/google/leveldb/blob/master/db/version_edit.cc
+"""
+import mmap
+import struct
+from glob import glob
+from os.path import join, getsize, isfile, basename, splitext
+try:
+    import snappy
+except ImportError:
+    snappy = None
+
+TABLE_EXTS = [".ldb", ".sst"]
+LOG_EXT = ".log"
+TABLE_MAGIC = 0xdb4775248b80fb57
+FOOTER_SIZE = 48
+NO_COMPRESSION = 0
+SNAPPY_COMPRESSION = 1
+LOG_BLOCK_SIZE = 32768
+LOG_HEADER_SIZE = 7
+# log record types
+FULL_RECORD = 1
+FIRST_RECORD = 2
+MIDDLE_RECORD = 3
+LAST_RECORD = 4
+# entry types
+TYPE_DELETION = 0
+TYPE_VALUE = 1
+CURRENT_FILENAME = "CURRENT"
+# tags of the version edits in the MANIFEST
+COMPARATOR_TAG = 1
+LOG_NUMBER_TAG = 2
+NEXT_FILE_NUMBER_TAG = 3
+LAST_SEQUENCE_TAG = 4
+COMPACT_POINTER_TAG = 5
+DELETED_FILE_TAG = 6
+NEW_FILE_TAG = 7
+PREV_LOG_NUMBER_TAG = 9
+
+UINT32 = struct.Struct("<I")
+UINT64 = struct.Struct("<Q")
+LOG_HEADER = struct.Struct("<IHB")
+WRITE_BATCH_HEADER = struct.Struct("<QI")
+
+
+class CorruptionError(Exception):
+    pass
+
+
+def decode_varint(data, pos):
+    """Return the varint at pos and the position after it."""
+    result = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+        if shift > 63:
+            raise CorruptionError("Varint too long")
+
+
+def decode_length_prefixed(data, pos):
+    length, pos = decode_varint(data, pos)
+    return data[pos:pos + length], pos + length
+
+
+def snappy_uncompress(data):
+    """Decompress a raw (unframed) snappy block, in pure Python if the
+    snappy module isn't installed."""
+    if snappy is not None:
+        return snappy.uncompress(data)
+    length, pos = decode_varint(data, 0)
+    out = bytearray()
+    data_len = len(data)
+    while pos < data_len:
+        tag = ord(data[pos])
+        pos += 1
+        element_type = tag & 3
+        if element_type == 0:  # literal
+            literal_len = tag >> 2
+            if literal_len >= 60:
+                num_bytes = literal_len - 59
+                literal_len = 0
+                for i in xrange(num_bytes):
+                    literal_len |= ord(data[pos + i]) << (8 * i)
+                pos += num_bytes
+            literal_len += 1
+            out += data[pos:pos + literal_len]
+            pos += literal_len
+            continue
+        if element_type == 1:
+            copy_len = ((tag >> 2) & 7) + 4
+            offset = ((tag >> 5) << 8) | ord(data[pos])
+            pos += 1
+        elif element_type == 2:
+            copy_len = (tag >> 2) + 1
+            offset = ord(data[pos]) | (ord(data[pos + 1]) << 8)
+            pos += 2
+        else:
+            copy_len = (tag >> 2) + 1
+            offset = UINT32.unpack_from(data, pos)[0]
+            pos += 4
+        if not 0 < offset <= len(out):
+            raise CorruptionError("Bad snappy copy offset %d" % offset)
+        start = len(out) - offset
+        if offset >= copy_len:
+            out += out[start:start + copy_len]
+        else:
+            # the copy overlaps what it writes, i.e. repeats a pattern
+            for i in xrange(copy_len):
+                out.append(out[start + i])
+    if len(out) != length:
+        raise CorruptionError("Snappy length mismatch: %d != %d" % (
+            len(out), length))
+    return str(out)
+
+
+def parse_internal_key(internal_key):
+    """Split a table key into the user key, sequence number and type."""
+    tag = UINT64.unpack_from(internal_key, len(internal_key) - 8)[0]
+    return internal_key[:-8], tag >> 8, tag & 0xff
+
+
+def iter_block_entries(block):
+    """Yield the (key, value) pairs of a table block."""
+    num_restarts = UINT32.unpack_from(block, len(block) - 4)[0]
+    limit = len(block) - 4 - 4 * num_restarts
+    pos = 0
+    key = ""
+    while pos < limit:
+        shared, pos = decode_varint(block, pos)
+        non_shared, pos = decode_varint(block, pos)
+        value_len, pos = decode_varint(block, pos)
+        key = key[:shared] + block[pos:pos + non_shared]
+        pos += non_shared
+        yield key, block[pos:pos + value_len]
+        pos += value_len
+
+
+class TableReader(object):
+    """Read the entries of a LevelDB table file in key order."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0,
+                               access=mmap.ACCESS_READ)
+        if len(self._mmap) < FOOTER_SIZE or UINT64.unpack_from(
+                self._mmap, len(self._mmap) - 8)[0] != TABLE_MAGIC:
+            raise CorruptionError("Not a LevelDB table: %s" % path)
+        footer = self._mmap[len(self._mmap) - FOOTER_SIZE:]
+        _, pos = decode_varint(footer, 0)  # metaindex offset
+        _, pos = decode_varint(footer, pos)  # metaindex size
+        index_offset, pos = decode_varint(footer, pos)
+        index_size, _ = decode_varint(footer, pos)
+        self.index_block = self.read_block(index_offset, index_size)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def read_block(self, offset, size):
+        compression = ord(self._mmap[offset + size])
+        block = self._mmap[offset:offset + size]
+        if compression == SNAPPY_COMPRESSION:
+            return snappy_uncompress(block)
+        if compression != NO_COMPRESSION:
+            raise CorruptionError("Unknown block compression %d in %s" % (
+                compression, self.path))
+        return block
+
+    def iter_entries(self):
+        """Yield (user key, sequence number, type, value) tuples."""
+        for _, block_handle in iter_block_entries(self.index_block):
+            offset, pos = decode_varint(block_handle, 0)
+            size, _ = decode_varint(block_handle, pos)
+            for internal_key, value in iter_block_entries(
+                    self.read_block(offset, size)):
+                key, seq, entry_type = parse_internal_key(internal_key)
+                yield key, seq, entry_type, value
+
+
+def iter_log_records(path):
+    """Yield the records of a LevelDB log file, joining fragmented ones.
+
+    A truncated record at the end, e.g. of a crawl that crashed, is
+    skipped.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    fragments = []
+    while pos + LOG_HEADER_SIZE <= len(data):
+        block_left = LOG_BLOCK_SIZE - pos % LOG_BLOCK_SIZE
+        if block_left < LOG_HEADER_SIZE:
+            # zero padding at the end of the block
+            pos += block_left
+            continue
+        _, length, record_type = LOG_HEADER.unpack_from(data, pos)
+        pos += LOG_HEADER_SIZE
+        if record_type == 0 and length == 0:
+            # preallocated space
+            pos += block_left - LOG_HEADER_SIZE
+            continue
+        fragment = data[pos:pos + length]
+        pos += length
+        if len(fragment) < length:
+            break
+        if record_type == FULL_RECORD:
+            fragments = []
+            yield fragment
+        elif record_type == FIRST_RECORD:
+            fragments = [fragment]
+        elif record_type == MIDDLE_RECORD:
+            fragments.append(fragment)
+        elif record_type == LAST_RECORD:
+            fragments.append(fragment)
+            yield "".join(fragments)
+            fragments = []
+
+
+def iter_log_entries(path):
+    """Yield the (user key, sequence number, type, value) tuples of the
+    write batches in a log file. Deletions have a None value."""
+    for record in iter_log_records(path):
+        seq, count = WRITE_BATCH_HEADER.unpack_from(record, 0)
+        pos = WRITE_BATCH_HEADER.size
+        for i in xrange(count):
+            entry_type = ord(record[pos])
+            key, pos = decode_length_prefixed(record, pos + 1)
+            if entry_type == TYPE_VALUE:
+                value, pos = decode_length_prefixed(record, pos)
+            elif entry_type == TYPE_DELETION:
+                value = None
+            else:
+                raise CorruptionError("Unknown entry type %d in %s" % (
+                    entry_type, path))
+            yield key, seq + i, entry_type, value
+
+
+def iter_file_entries(path):
+    """Yield the entries of a table or log file."""
+    if path.endswith(LOG_EXT):
+        for entry in iter_log_entries(path):
+            yield entry
+        return
+    table = TableReader(path)
+    try:
+        for entry in table.iter_entries():
+            yield entry
+    finally:
+        table.close()
+
+
+def read_manifest(ldb_dir):
+    """Return the numbers of the live table files, the log number and the
+    previous log number from the MANIFEST that CURRENT names. Returns None
+    if the store has no CURRENT file."""
+    current_path = join(ldb_dir, CURRENT_FILENAME)
+    if not isfile(current_path):
+        return None
+    with open(current_path) as f:
+        manifest_path = join(ldb_dir, f.read().strip())
+    tables = set()
+    log_number = 0
+    prev_log_number = 0
+    for record in iter_log_records(manifest_path):
+        pos = 0
+        while pos < len(record):
+            tag, pos = decode_varint(record, pos)
+            if tag == COMPARATOR_TAG:
+                _, pos = decode_length_prefixed(record, pos)
+            elif tag == LOG_NUMBER_TAG:
+                log_number, pos = decode_varint(record, pos)
+            elif tag == PREV_LOG_NUMBER_TAG:
+                prev_log_number, pos = decode_varint(record, pos)
+            elif tag in (NEXT_FILE_NUMBER_TAG, LAST_SEQUENCE_TAG):
+                _, pos = decode_varint(record, pos)
+            elif tag == COMPACT_POINTER_TAG:
+                _, pos = decode_varint(record, pos)  # level
+                _, pos = decode_length_prefixed(record, pos)
+            elif tag == DELETED_FILE_TAG:
+                _, pos = decode_varint(record, pos)  # level
+                number, pos = decode_varint(record, pos)
+                tables.discard(number)
+            elif tag == NEW_FILE_TAG:
+                _, pos = decode_varint(record, pos)  # level
+                number, pos = decode_varint(record, pos)
+                _, pos = decode_varint(record, pos)  # file size
+                _, pos = decode_length_prefixed(record, pos)  # smallest
+                _, pos = decode_length_prefixed(record, pos)  # largest
+                tables.add(number)
+            else:
+                raise CorruptionError("Unknown tag %d in %s" % (
+                    tag, manifest_path))
+    return tables, log_number, prev_log_number
+
+
+def get_file_number(path):
+    return int(splitext(basename(path))[0])
+
+
+def is_complete_table(path):
+    """Check the magic number at the end of a table file, which is
+    written last."""
+    with open(path, "rb") as f:
+        if getsize(path) < FOOTER_SIZE:
+            return False
+        f.seek(-8, 2)
+        return UINT64.unpack(f.read(8))[0] == TABLE_MAGIC
+
+
+def get_data_files(ldb_dir):
+    """Return the live table and log files of a store, largest first so
+    they are spread well over a pool of workers.
+
+    Without a MANIFEST all files are read, except the tables that weren't
+    finished.
+    """
+    log_paths = glob(join(ldb_dir, "*" + LOG_EXT))
+    table_paths = []
+    for ext in TABLE_EXTS:
+        table_paths += glob(join(ldb_dir, "*" + ext))
+    manifest = read_manifest(ldb_dir)
+    if manifest is None:
+        print "Warning: no MANIFEST in %s, will read all files" % ldb_dir
+        paths = log_paths
+        for path in table_paths:
+            if is_complete_table(path):
+                paths.append(path)
+            else:
+                print "Warning: skipping the unfinished table", path
+    else:
+        tables, log_number, prev_log_number = manifest
+        # LevelDB replays the logs from log_number on, as on its next open
+        paths = [path for path in log_paths
+                 if get_file_number(path) >= log_number or
+                 get_file_number(path) == prev_log_number]
+        table_numbers = set()
+        for path in table_paths:
+            number = get_file_number(path)
+            if number in tables:
+                paths.append(path)
+                table_numbers.add(number)
+        for number in tables - table_numbers:
+            print "Warning: missing table %06d in %s" % (number, ldb_dir)
+    return sorted(paths, key=lambda path: -getsize(path))
+
+
+def iter_live_entries(ldb_dir):
+    """Yield the (key, value) pairs of a store, i.e. the last value of
+    each key that isn't deleted. Keeps all values in memory."""
+    latest = {}
+    for path in get_data_files(ldb_dir):
+        for key, seq, entry_type, value in iter_file_entries(path):
+            if key not in latest or seq > latest[key][0]:
+                latest[key] = (seq, entry_type, value)
+    for key in sorted(latest):
+        _, entry_type, value = latest[key]
+        if entry_type == TYPE_VALUE:
+            yield key, value
@@ -1,15 +1,32 @@
 from __future__ import division
 from time import time
 import sqlite3
-from util import print_progress
+import argparse
+import hashlib
+from array import array
 from db_schema import (TABLE_SCHEMAS, HTTP_REQUESTS_TABLE,
-                       HTTP_RESPONSES_TABLE,
+                       HTTP_RESPONSES_TABLE, SITE_VISITS_TABLE,
                        JAVASCRIPT_TABLE, JAVASCRIPT_COOKIES_TABLE)
 
 
 TABLES_WITH_TOP_URL = [HTTP_REQUESTS_TABLE, HTTP_RESPONSES_TABLE,
                        JAVASCRIPT_TABLE, JAVASCRIPT_COOKIES_TABLE]
 
+# strategies to build the site_visits table of legacy crawls:
+# one pass over http_requests in id order with a hash aggregate,
+SITE_VISITS_HASH = "hash"
+# GROUP BY top_url with a temporary covering index,
+SITE_VISITS_INDEX = "index"
+# or GROUP BY top_url with a temp B-tree (the original query)
+SITE_VISITS_GROUP_BY = "group_by"
+SITE_VISITS_STRATEGIES = [SITE_VISITS_HASH, SITE_VISITS_INDEX,
+                          SITE_VISITS_GROUP_BY]
+# insert the new site visits in batches of this size
+SITE_VISITS_BATCH_SIZE = 10**4
+TMP_TOP_URL_INDEX = "_tmp_http_requests_top_url"
+# UPDATE ... FROM was added in SQLite 3.33
+UPDATE_FROM_MIN_SQLITE_VERSION = (3, 33, 0)
+
 
 def rename_crawl_history_table(con):
     try:
@@ -27,18 +44,40 @@ def add_visit_id_col_to_tables(con):
             pass
 
 
-def create_site_visits_table(con):
-    con.execute("""CREATE TABLE IF NOT EXISTS site_visits (
+def create_site_visits_table(con, table_name=SITE_VISITS_TABLE):
+    con.execute("""CREATE TABLE IF NOT EXISTS %s (
                 visit_id INTEGER PRIMARY KEY,
                 crawl_id INTEGER NOT NULL,
                 site_url VARCHAR(500) NOT NULL,
-                FOREIGN KEY(crawl_id) REFERENCES crawl(id));""")
+                FOREIGN KEY(crawl_id) REFERENCES crawl(id));""" % table_name)
+
+
+def add_site_visits_table(con, strategy=SITE_VISITS_HASH,
+                          table_name=SITE_VISITS_TABLE):
+    """Add a visit for each distinct top_url of http_requests.
+
+    Visit ids follow the order of the first request of each site, and
+    the crawl id is the largest one the site was crawled with.
+    """
+    create_site_visits_table(con, table_name)
+    if strategy == SITE_VISITS_HASH:
+        add_site_visits_with_hash_aggregate(con, table_name)
+    elif strategy == SITE_VISITS_INDEX:
+        con.execute("CREATE INDEX IF NOT EXISTS %s ON http_requests "
+                    "(top_url, crawl_id, id)" % TMP_TOP_URL_INDEX)
+        try:
+            add_site_visits_with_group_by(con, table_name)
+        finally:
+            con.execute("DROP INDEX IF EXISTS %s" % TMP_TOP_URL_INDEX)
+    elif strategy == SITE_VISITS_GROUP_BY:
+        add_site_visits_with_group_by(con, table_name)
+    else:
+        raise ValueError("Unknown site_visits strategy: %s" % strategy)
 
 
-def add_site_visits_table(con):
+def add_site_visits_with_group_by(con, table_name=SITE_VISITS_TABLE):
     site_visits = []
-    cur = con.cursor()
-    create_site_visits_table(cur)
+    insert_qry = "INSERT INTO %s VALUES (?,?,?)" % table_name
     # TODO: file an issue for that
     # we have duplicate visits for some sites
     # this is due to restarted crawls
@@ -47,41 +86,162 @@ def add_site_visits_table(con):
     # query = "select DISTINCT top_url, MAX(crawl_id) from http_requests"
     query = """SELECT top_url, MAX(crawl_id), MIN(id) as min_id FROM
      http_requests GROUP BY top_url ORDER by min_id ASC"""
-    for visit_id, (top_url, crawl_id, _) in enumerate(cur.execute(query), 1):
+    for visit_id, (top_url, crawl_id, _) in enumerate(con.execute(query), 1):
         if not top_url:
             print "Warning: Empty top-url", top_url, crawl_id
         site_visits.append((visit_id, crawl_id, top_url))
-    cur.executemany('INSERT INTO site_visits VALUES (?,?,?)', site_visits)
+        if len(site_visits) == SITE_VISITS_BATCH_SIZE:
+            con.executemany(insert_qry, site_visits)
+            del site_visits[:]
+    con.executemany(insert_qry, site_visits)
+
+
+def add_site_visits_with_hash_aggregate(con, table_name=SITE_VISITS_TABLE):
+    """Build site_visits in a single pass over http_requests in id order.
+
+    The sites are numbered in the order they are first seen, which is the
+    order of their smallest request id, and written in batches. The rare
+    sites that show up again with a larger crawl id (restarted crawls)
+    are updated at the end.
+
+    Requests of a visit are mostly consecutive, so SQLite skips the rows
+    that have the same top_url and crawl_id as the previous row by
+    looking it up by its primary key. This avoids a sort, and Python only
+    sees about one row per visit.
+    """
+    visit_ids = {}
+    # the largest crawl id of each site and the one it was inserted with,
+    # indexed by visit_id
+    crawl_ids = array('l', [0])
+    inserted_crawl_ids = array('l', [0])
+    new_site_urls = []
+    insert_qry = "INSERT INTO %s VALUES (?,?,?)" % table_name
+    query = """SELECT r.top_url, r.crawl_id FROM http_requests r
+        LEFT JOIN http_requests p ON p.id = r.id - 1
+        WHERE p.top_url IS NOT r.top_url OR p.crawl_id IS NOT r.crawl_id
+        ORDER BY r.id"""
+    for top_url, crawl_id in con.execute(query):
+        visit_id = visit_ids.get(top_url)
+        if visit_id is None:
+            visit_id = visit_ids[top_url] = len(crawl_ids)
+            crawl_ids.append(crawl_id)
+            new_site_urls.append(top_url)
+            if len(new_site_urls) == SITE_VISITS_BATCH_SIZE:
+                insert_new_site_visits(con, insert_qry, new_site_urls,
+                                       crawl_ids, inserted_crawl_ids)
+        elif crawl_id > crawl_ids[visit_id]:
+            crawl_ids[visit_id] = crawl_id
+    insert_new_site_visits(con, insert_qry, new_site_urls, crawl_ids,
+                           inserted_crawl_ids)
+    updates = [(crawl_ids[visit_id], visit_id) for visit_id
+               in xrange(1, len(crawl_ids))
+               if crawl_ids[visit_id] != inserted_crawl_ids[visit_id]]
+    con.executemany("UPDATE %s SET crawl_id=? WHERE visit_id=?" % table_name,
+                    updates)
+    print "Added %d site visits, updated the crawl id of %d" % (
+        len(visit_ids), len(updates))
+
+
+def insert_new_site_visits(con, insert_qry, new_site_urls, crawl_ids,
+                           inserted_crawl_ids):
+    site_visits = []
+    for top_url in new_site_urls:
+        visit_id = len(inserted_crawl_ids)
+        if not top_url:
+            print "Warning: Empty top-url", top_url, crawl_ids[visit_id]
+        site_visits.append((visit_id, crawl_ids[visit_id], top_url))
+        inserted_crawl_ids.append(crawl_ids[visit_id])
+    con.executemany(insert_qry, site_visits)
+    del new_site_urls[:]
+
 
+def get_table_checksum(con, table_name):
+    md5 = hashlib.md5()
+    for row in con.execute("SELECT * FROM %s ORDER BY rowid" % table_name):
+        md5.update(repr(tuple(row)))
+    return md5.hexdigest()
 
-def get_site_url_visit_id_mapping(con):
-    site_url_visit_ids = {}
-    for visit_id, site_url in con.execute(
-            "SELECT visit_id, site_url FROM site_visits"):
-        site_url_visit_ids[site_url] = visit_id
-    print len(site_url_visit_ids), "Mappings"
-    return site_url_visit_ids
+
+def time_site_visits_strategies(con, strategies=SITE_VISITS_STRATEGIES):
+    """Build site_visits with each strategy into a scratch table, print
+    the durations and check that the tables match.
+
+    The scratch tables and the temporary index are dropped afterwards, but
+    run this on a copy of the crawl DB all the same.
+    """
+    durations = {}
+    checksums = {}
+    for strategy in strategies:
+        table_name = "_site_visits_%s" % strategy
+        con.execute("DROP TABLE IF EXISTS %s" % table_name)
+        t0 = time()
+        add_site_visits_table(con, strategy, table_name)
+        con.commit()
+        durations[strategy] = time() - t0
+        checksums[strategy] = get_table_checksum(con, table_name)
+        con.execute("DROP TABLE %s" % table_name)
+        con.commit()
+        print "Strategy %s took %0.1f s" % (strategy, durations[strategy])
+    for strategy in strategies[1:]:
+        if checksums[strategy] != checksums[strategies[0]]:
+            print "site_visits of %s and %s differ" % (strategies[0],
+                                                       strategy)
+    return durations
 
 
 def add_alexa_rank_to_site_visits(con, site_ranks):
-    visit_ranks = {}
-    for visit_id, site_url in con.execute(
-            "SELECT visit_id, site_url FROM site_visits"):
-        site_address = site_url.replace("http://", "")
-        try:
-            visit_ranks[visit_id] = site_ranks[site_address]
-        except Exception:
-            print "Exception while adding Alexa ranks", site_address
+    """Add the site_rank column from a site address -> rank dict or
+    (site address, rank) pairs."""
     con.execute("ALTER TABLE site_visits ADD COLUMN site_rank INTEGER")
-    for visit_id, site_rank in visit_ranks.iteritems():
-        con.execute("UPDATE site_visits SET site_rank=? WHERE visit_id=?",
-                    (site_rank, visit_id))
+    if isinstance(site_ranks, dict):
+        site_ranks = site_ranks.iteritems()
+    num_null_ranks = attach_ranks_to_site_visits(con, site_ranks,
+                                                 "site_rank")
+    print "Missing Alexa ranks for %d site visits" % num_null_ranks
+
+
+def attach_ranks_to_site_visits(con, site_ranks, rank_column):
+    """Set `rank_column` of site_visits from (site address, rank) pairs.
+
+    The ranks are loaded into a temp table and applied with a single
+    UPDATE that joins them to the site URLs without the http:// prefix.
+    Visits without a rank are left as they are. Returns their number,
+    computed from the row count of the UPDATE.
+    """
+    con.execute("DROP TABLE IF EXISTS temp.site_ranks")
+    con.execute("""CREATE TEMP TABLE site_ranks (
+        site_address TEXT PRIMARY KEY, site_rank INTEGER)""")
+    # the last rank of a site wins, as with a dict
+    con.executemany("INSERT OR REPLACE INTO temp.site_ranks VALUES (?,?)",
+                    site_ranks)
+    if sqlite3.sqlite_version_info >= UPDATE_FROM_MIN_SQLITE_VERSION:
+        query = """UPDATE site_visits SET %s = r.site_rank
+            FROM temp.site_ranks r
+            WHERE r.site_address = REPLACE(site_visits.site_url,
+                                           'http://', '')""" % rank_column
+    else:
+        query = """UPDATE site_visits SET %s = (
+                SELECT r.site_rank FROM temp.site_ranks r
+                WHERE r.site_address = REPLACE(site_visits.site_url,
+                                               'http://', ''))
+            WHERE REPLACE(site_url, 'http://', '') IN (
+                SELECT site_address FROM temp.site_ranks)""" % rank_column
+    num_ranked_visits = con.execute(query).rowcount
+    num_visits = con.execute("SELECT COUNT(*) FROM site_visits").fetchone()[0]
+    con.execute("DROP TABLE temp.site_ranks")
+    return num_visits - num_ranked_visits
+
 
+def add_missing_columns(con, table_name, existing_columns):
+    """Migrate a table to its up to date schema inside SQLite.
 
-def add_missing_columns(con, table_name, db_schema_str, site_url_visit_id_map):
+    The rows are copied with a single INSERT ... SELECT. If the table
+    links its rows to visits by top_url or page_url, that column is
+    replaced with the visit_id of the site_visits row with the same
+    site_url. Rows without a matching visit are dropped and counted.
+    Doesn't commit, see add_missing_columns_to_all_tables.
+    """
     col_to_replace = None
-    existing_columns = get_column_names_from_db_schema_str(
-        table_name, db_schema_str)
     if "top_url" in existing_columns:
         col_to_replace = "top_url"
     elif "page_url" in existing_columns:
@@ -96,13 +256,13 @@ def add_missing_columns(con, table_name, db_schema_str, site_url_visit_id_map):
     print "Will add missing columns to %s: %s" % (table_name, set(
         new_columns).difference(set(existing_columns)))
 
-    processed = 0
-    data_to_insert = []
-    num_rows = con.execute(
-        "SELECT MAX(id) FROM %s" % table_name).fetchone()[0]
     # Copy the existing table to a temp table
     tmp_table_name = "_%s_old" % table_name
     con.execute("ALTER TABLE %s RENAME TO %s;" % (table_name, tmp_table_name))
+    # MAX(rowid) is a single b-tree lookup, unlike COUNT(*). It's the
+    # number of rows unless rows were deleted from the crawl DB.
+    num_rows = con.execute(
+        "SELECT MAX(rowid) FROM %s" % tmp_table_name).fetchone()[0] or 0
 
     # create table with the most recent schema
     con.execute(TABLE_SCHEMAS[table_name])
@@ -118,57 +278,33 @@ def add_missing_columns(con, table_name, db_schema_str, site_url_visit_id_map):
         assert "visit_id" not in existing_columns
         # select from columns that are common to old and new table schemas
         # col_to_replace is either top_url or page_url
-        # we use is to get the visit_id
-        cols_to_select = common_columns + [col_to_replace, ]
+        # we use is to get the visit_id. If a site has more than one
+        # visit, the last one wins.
         cols_to_insert = common_columns + ["visit_id", ]
-        stream_qry = "SELECT %s FROM %s " % (",".join(cols_to_select),
-                                             tmp_table_name)
-        # print "Will iterate over", stream_qry
-        insert_qry = "INSERT INTO %s (%s) VALUES (%s)" % (
+        insert_qry = """INSERT INTO %s (%s)
+            SELECT %s, v.visit_id FROM %s t
+            JOIN (SELECT site_url, MAX(visit_id) AS visit_id
+                  FROM site_visits GROUP BY site_url) v
+            ON v.site_url = t.%s
+            ORDER BY t.rowid""" % (
             table_name, ",".join(cols_to_insert),
-            ",".join("?" * len(cols_to_insert)))
-
-        for row in con.execute(stream_qry):
-            try:
-                visit_id = site_url_visit_id_map[row[col_to_replace]]
-            except Exception:
-                print "Warning: Missing visit id", col_to_replace, row
-                continue
-            row = list(row)
-            row.pop()  # remove col_to_replace, we don't need it anymore
-            row.append(visit_id)  # add visit_id
-            data_to_insert.append(row)
-            # print "Will execute %s" % qry
-            # con.execute(qry, row)
-            processed += 1
-            if processed % 100000 == 0:
-                con.executemany(insert_qry, data_to_insert)
-                del data_to_insert[:]
-            print_progress(t0, processed, num_rows)
-        con.executemany(insert_qry, data_to_insert)
+            ",".join("t.%s" % column for column in common_columns),
+            tmp_table_name, col_to_replace)
     else:
         # read from the temp table and write into the new table
-        stream_qry = "SELECT %s FROM %s " % (",".join(common_columns),
-                                             tmp_table_name)
-        # print "Will iterate over", stream_qry
-        insert_qry = "INSERT INTO %s (%s) VALUES (%s)" % (
-                    table_name, ",".join(common_columns),
-                    ",".join("?" * len(common_columns)))
-        for row in con.execute(stream_qry):
-            data_to_insert.append(row)
-            # print "Will execute %s" % qry
-            # con.execute(insert_qry, row)
-            processed += 1
-            if processed % 100000 == 0:
-                con.executemany(insert_qry, data_to_insert)
-                del data_to_insert[:]
-            print_progress(t0, processed, num_rows)
-        con.executemany(insert_qry, data_to_insert)
+        insert_qry = "INSERT INTO %s (%s) SELECT %s FROM %s" % (
+            table_name, ",".join(common_columns), ",".join(common_columns),
+            tmp_table_name)
+    num_inserted = con.execute(insert_qry).rowcount
+    print "Copied %d rows to %s in %0.1f s" % (num_inserted, table_name,
+                                               time() - t0)
+    if num_inserted < num_rows:
+        print "Warning: Missing visit id for up to %d rows of %s (%s)" % (
+            num_rows - num_inserted, table_name, col_to_replace)
     t0 = time()
     print "Will drop the temp table",
     con.execute("DROP TABLE %s" % tmp_table_name)
     print "(took", time() - t0, "s)"
-    con.commit()
     return True
 
 
@@ -183,27 +319,39 @@ def get_column_names_from_create_query(create_table_query):
     return col_names
 
 
-def get_column_names_from_db_schema_str(table_name, db_schema_str):
-    for l in db_schema_str.split("\n"):
-        db_table_name = l.split()[0]
-        if db_table_name == table_name:
-            return l.split()[1:]
-    else:
-        raise Exception("Cannot find table %s in the DB" % table_name)
+def add_missing_columns_to_all_tables(con, db_catalog):
+    """Migrate all tables in a single transaction.
 
-
-def add_missing_columns_to_all_tables(con, db_schema_str):
-    site_url_visit_id_map = get_site_url_visit_id_mapping(con)
-    for table_name in TABLE_SCHEMAS.keys():
-        # TODO: search in table names instead of the db schema
-        if table_name in db_schema_str:
-            t0 = time()
-            if add_missing_columns(con, table_name, db_schema_str,
-                                   site_url_visit_id_map):
-                duration = time() - t0
-                print "Took %s s to add missing columns to %s" % (duration,
-                                                                  table_name)
+    Python 2's sqlite3 module commits before each DDL statement, so we
+    manage the transaction ourselves.
+    """
+    con.commit()
+    isolation_level = con.isolation_level
+    con.isolation_level = None
+    con.execute("BEGIN")
+    try:
+        for table_name in TABLE_SCHEMAS.keys():
+            if db_catalog.has_table(table_name):
+                t0 = time()
+                if add_missing_columns(con, table_name,
+                                       db_catalog.get_columns(table_name)):
+                    duration = time() - t0
+                    print "Took %s s to add missing columns to %s" % (
+                        duration, table_name)
+        con.execute("COMMIT")
+    except Exception:
+        con.execute("ROLLBACK")
+        raise
+    finally:
+        con.isolation_level = isolation_level
 
 
 if __name__ == '__main__':
-    pass
+    parser = argparse.ArgumentParser()
+    parser.add_argument("crawl_db_path")
+    parser.add_argument("--time-site-visits", action="store_true",
+                        help="time the strategies to build site_visits "
+                        "(modifies the DB temporarily, use a copy)")
+    args = parser.parse_args()
+    if args.time_site_visits:
+        time_site_visits_strategies(sqlite3.connect(args.crawl_db_path))
@@ -1,14 +1,17 @@
-import sys
 import sqlite3
 import os
+import argparse
 from time import time
-from util import get_table_and_column_names, load_alexa_ranks,\
-    copy_if_not_exists, get_crawl_dir, get_crawl_db_path
-from os.path import join, isfile, basename, isdir, sep
+from util import iter_alexa_ranks, copy_if_not_exists, get_crawl_dir,\
+    get_crawl_db_path, read_json
+from db_catalog import get_db_catalog
+from os.path import join, isfile, basename, isdir, sep, dirname, getsize,\
+    realpath
 from normalize_db import add_site_visits_table, add_alexa_rank_to_site_visits,\
     add_missing_columns_to_all_tables, rename_crawl_history_table
 from db_schema import SITE_VISITS_TABLE, CRAWL_HISTORY_TABLE
 from fix_alexa_ranks import FixAlexaRanks
+from telemetry import Telemetry, get_report_path
 
 ROOT_OUT_DIR = "/mnt/10tb4/census-release"
 if not isdir(ROOT_OUT_DIR):
@@ -18,7 +21,18 @@ OPENWPM_LOG_FILENAME = "openwpm.log"
 CRONTAB_LOG_FILENAME = "crontab.log"
 ALEXA_TOP1M_CSV_FILENAME = "top-1m.csv"
 JAVASCRIPT_SRC_DIRNAME = "content.ldb"
+# written by crawl_archive.py when it extracts a subset of the archive
+ARCHIVE_MANIFEST_FILENAME = "archive_manifest.json"
+DB_SCHEMAS_DIRNAME = "db-schemas"
+LOG_FILES_DIRNAME = "log-files"
+ALEXA_RANKS_DIRNAME = "alexa-ranks"
 DEFAULT_SQLITE_CACHE_SIZE_GB = 20
+# page size and auto_vacuum mode (0 is NONE) of the compacted crawl DB
+COMPACT_DB_PAGE_SIZE = 32768
+COMPACT_DB_AUTO_VACUUM = 0
+COMPACT_DB_SUFFIX = ".compact"
+# VACUUM INTO was added in SQLite 3.27
+VACUUM_INTO_MIN_SQLITE_VERSION = (3, 27, 0)
 
 # We won't be adding missing columns after the public release in Nov 2018.
 # Instead crawl databases will reflect the changes in OpenWPM schema
@@ -26,9 +40,22 @@ DEFAULT_SQLITE_CACHE_SIZE_GB = 20
 ADD_MISSING_COLUMNS = False
 
 
+def get_backup_paths(out_dir, crawl_name):
+    """Return where the crawl files are backed up, by their filename."""
+    log_prefix = crawl_name + "-"
+    return {
+        OPENWPM_LOG_FILENAME: join(out_dir, LOG_FILES_DIRNAME,
+                                   log_prefix + OPENWPM_LOG_FILENAME),
+        CRONTAB_LOG_FILENAME: join(out_dir, LOG_FILES_DIRNAME,
+                                   log_prefix + CRONTAB_LOG_FILENAME),
+        ALEXA_TOP1M_CSV_FILENAME: join(out_dir, ALEXA_RANKS_DIRNAME,
+                                       log_prefix + ALEXA_TOP1M_CSV_FILENAME)}
+
+
 class CrawlData(object):
 
-    def __init__(self, crawl_dir, out_dir):
+    def __init__(self, crawl_dir, out_dir, profile_interval=None,
+                 compact=True, compact_dir=None, rank_store_dir=None):
         self.openwpm_log_path = ""
         self.crontab_log_path = ""
         self.alexa_csv_path = ""
@@ -36,18 +63,24 @@ class CrawlData(object):
         print "Crawl dir", self.crawl_dir
         self.crawl_name = basename(crawl_dir.rstrip(sep))
         self.init_out_dirs(out_dir)
+        self.backup_paths = get_backup_paths(out_dir, self.crawl_name)
         self.crawl_db_path = get_crawl_db_path(self.crawl_dir)
         print "Crawl DB path", self.crawl_db_path
         self.set_crawl_file_paths()
         self.check_js_src_code()
-        self.db_conn = sqlite3.connect(self.crawl_db_path)
-        self.db_conn.row_factory = sqlite3.Row
-        self.optimize_db()
+        self.compact = compact
+        self.compact_dir = compact_dir
+        self.rank_store_dir = rank_store_dir
+        self.init_db()
+        self.telemetry = Telemetry(
+            self.crawl_name,
+            get_report_path(out_dir, self.crawl_name, "pre_process"),
+            self.db_conn, profile_interval)
 
     def init_out_dirs(self, out_dir):
-        self.db_schema_dir = join(out_dir, "db-schemas")
-        self.log_files_dir = join(out_dir, "log-files")
-        self.alexa_ranks_dir = join(out_dir, "alexa-ranks")
+        self.db_schema_dir = join(out_dir, DB_SCHEMAS_DIRNAME)
+        self.log_files_dir = join(out_dir, LOG_FILES_DIRNAME)
+        self.alexa_ranks_dir = join(out_dir, ALEXA_RANKS_DIRNAME)
 
         for _dir in [self.db_schema_dir,
                      self.log_files_dir,
@@ -55,6 +88,11 @@ class CrawlData(object):
             if not isdir(_dir):
                 os.makedirs(_dir)
 
+    def init_db(self):
+        self.db_conn = sqlite3.connect(self.crawl_db_path)
+        self.db_conn.row_factory = sqlite3.Row
+        self.optimize_db()
+
     def optimize_db(self, size_in_gb=DEFAULT_SQLITE_CACHE_SIZE_GB):
         """ Runs PRAGMA queries to make sqlite better """
         self.db_conn.execute("PRAGMA cache_size = -%i" % (size_in_gb * 10**6))
@@ -65,29 +103,87 @@ class CrawlData(object):
         # self.db_conn.execute("PRAGMA journal_mode = WAL;")
         self.db_conn.execute("PRAGMA journal_mode = OFF;")
 
-    def vacuum_db(self):
-        """."""
-        print "Will vacuum the DB",
+    def compact_db(self, stage_info):
+        """Rewrite the DB once with VACUUM INTO and replace the crawl DB
+        with the copy.
+
+        The copy gets the page size and auto_vacuum mode we want, and can
+        be written to a faster scratch disk (`compact_dir`). If that is on
+        another file system, the copy stays there and the crawl DB is
+        replaced with a symlink to it, so it's not written a second time.
+        Sizes and times are added to `stage_info`.
+        """
+        self.db_conn.commit()
+        size_before = getsize(self.crawl_db_path)
+        # these only take effect when the DB is rewritten
+        self.db_conn.execute("PRAGMA page_size = %d" % COMPACT_DB_PAGE_SIZE)
+        self.db_conn.execute("PRAGMA auto_vacuum = %d" %
+                             COMPACT_DB_AUTO_VACUUM)
         t0 = time()
-        self.db_conn.execute("VACUUM;")
-        print "finished in", float(time() - t0) / 60, "mins"
+        if sqlite3.sqlite_version_info < VACUUM_INTO_MIN_SQLITE_VERSION:
+            print "SQLite %s has no VACUUM INTO, will vacuum in place" % (
+                sqlite3.sqlite_version)
+            self.db_conn.execute("VACUUM;")
+            vacuum_time = time() - t0
+            move_time = 0
+        else:
+            # the DB is already a symlink if it was compacted before
+            db_path = realpath(self.crawl_db_path)
+            compact_dir = self.compact_dir or dirname(db_path)
+            compact_path = join(compact_dir, basename(self.crawl_db_path) +
+                                COMPACT_DB_SUFFIX)
+            # don't overwrite compact_path, it may be the DB itself
+            tmp_path = compact_path + ".tmp"
+            if isfile(tmp_path):
+                os.remove(tmp_path)
+            print "Will compact the DB into", tmp_path
+            self.db_conn.execute("VACUUM INTO ?", (tmp_path,))
+            vacuum_time = time() - t0
+            self.db_conn.close()
+            t0 = time()
+            if os.stat(compact_dir).st_dev == \
+                    os.stat(dirname(db_path)).st_dev:
+                os.rename(tmp_path, db_path)
+            else:
+                os.rename(tmp_path, compact_path)
+                os.remove(db_path)
+                os.symlink(compact_path, self.crawl_db_path)
+                print "Linked %s to the compacted DB" % self.crawl_db_path
+            move_time = time() - t0
+            self.init_db()
+            self.telemetry.db_conn = self.db_conn
+        size_after = getsize(self.crawl_db_path)
+        print "Compacted the DB from %0.1f MB to %0.1f MB in %0.1f s" % (
+            size_before / 1e6, size_after / 1e6, vacuum_time + move_time)
+        stage_info.update({"size_before_mb": size_before / 1e6,
+                           "size_after_mb": size_after / 1e6,
+                           "vacuum_time": vacuum_time,
+                           "move_time": move_time,
+                           "compact_dir": self.compact_dir})
 
     def check_js_src_code(self):
         js_sources_dir = join(self.crawl_dir, JAVASCRIPT_SRC_DIRNAME)
         self.has_js_src = isdir(js_sources_dir)
+        # content.ldb is left in the archive by a selective extraction
+        manifest_path = join(self.crawl_dir, ARCHIVE_MANIFEST_FILENAME)
+        if not self.has_js_src and isfile(manifest_path):
+            self.has_js_src = read_json(manifest_path)["content_ldb"][
+                "present"]
 
-    def set_crawl_file_paths(self):
-        openwpm_log_path = join(self.crawl_dir, OPENWPM_LOG_FILENAME)
-        if isfile(openwpm_log_path):
-            self.openwpm_log_path = openwpm_log_path
-
-        crontab_log_path = join(self.crawl_dir, CRONTAB_LOG_FILENAME)
-        if isfile(crontab_log_path):
-            self.crontab_log_path = crontab_log_path
+    def get_crawl_file_path(self, filename):
+        """Return the path of a crawl file, or its backup if crawl_archive.py
+        streamed it straight to the backup dir. "" if there's neither."""
+        for path in [join(self.crawl_dir, filename),
+                     self.backup_paths[filename]]:
+            if isfile(path):
+                return path
+        return ""
 
-        alexa_csv_path = join(self.crawl_dir, ALEXA_TOP1M_CSV_FILENAME)
-        if isfile(alexa_csv_path):
-            self.alexa_csv_path = alexa_csv_path
+    def set_crawl_file_paths(self):
+        self.openwpm_log_path = self.get_crawl_file_path(OPENWPM_LOG_FILENAME)
+        self.crontab_log_path = self.get_crawl_file_path(CRONTAB_LOG_FILENAME)
+        self.alexa_csv_path = self.get_crawl_file_path(
+            ALEXA_TOP1M_CSV_FILENAME)
 
         print "OpenWPM log", self.openwpm_log_path
         print "Crontab log", self.crontab_log_path
@@ -95,41 +191,55 @@ class CrawlData(object):
 
     def pre_process(self):
         print "Will pre_process", self.crawl_dir
-        self.backup_crawl_files()
-        self.dump_db_schema()
-        self.normalize_db()
-        self.fix_alexa_ranks()
-        # self.vacuum_db()
+        with self.telemetry.stage("backup_crawl_files"):
+            self.backup_crawl_files()
+        with self.telemetry.stage("dump_db_schema"):
+            self.dump_db_schema()
+        with self.telemetry.stage("normalize_db") as stage:
+            self.normalize_db()
+            stage.add_rows(self.get_num_site_visits())
+        with self.telemetry.stage("fix_alexa_ranks") as stage:
+            self.fix_alexa_ranks()
+            stage.add_rows(self.get_num_site_visits())
+        # compact last, so all the changes above are rewritten only once
+        if self.compact:
+            with self.telemetry.stage("compact_db") as stage:
+                self.compact_db(stage.info)
+        self.telemetry.close()
+
+    def get_num_site_visits(self):
+        return self.db_conn.execute(
+            "SELECT COUNT(*) FROM site_visits").fetchone()[0]
 
     def fix_alexa_ranks(self):
-        fix_ranks = FixAlexaRanks(self.crawl_dir)
+        fix_ranks = FixAlexaRanks(self.crawl_dir, self.rank_store_dir)
         fix_ranks.fix_alexa_ranks()
 
     def normalize_db(self):
-        db_schema_str = get_table_and_column_names(self.crawl_db_path)
+        # cached by dump_db_schema
+        db_catalog = get_db_catalog(self.crawl_db_path)
         # Add site_visits table
-        if SITE_VISITS_TABLE not in db_schema_str:
+        if not db_catalog.has_table(SITE_VISITS_TABLE):
             print "Adding site_visits table"
             add_site_visits_table(self.db_conn)
-        if CRAWL_HISTORY_TABLE not in db_schema_str:
+        if not db_catalog.has_table(CRAWL_HISTORY_TABLE):
             print "Renaming CrawlHistory table to crawl_history"
             rename_crawl_history_table(self.db_conn)
         # Add site ranks to site_visits table
-        if "site_rank" not in db_schema_str:
+        if not db_catalog.has_column(SITE_VISITS_TABLE, "site_rank"):
             if self.alexa_csv_path:
                 print "Adding Alexa ranks to the site_visits table"
-                site_ranks = load_alexa_ranks(self.alexa_csv_path)
-                add_alexa_rank_to_site_visits(self.db_conn, site_ranks)
+                add_alexa_rank_to_site_visits(
+                    self.db_conn, iter_alexa_ranks(self.alexa_csv_path))
             else:
                 print "Missing Alexa ranks CSV, can't add ranks to site_visits"
         if ADD_MISSING_COLUMNS:
-            add_missing_columns_to_all_tables(self.db_conn, db_schema_str)
+            add_missing_columns_to_all_tables(self.db_conn, db_catalog)
         print "Will commit the changes"
         self.db_conn.commit()
 
     def dump_db_schema(self):
-        self.db_schema_str = get_table_and_column_names(self.crawl_db_path)
-        out_str = self.db_schema_str
+        out_str = get_db_catalog(self.crawl_db_path).get_schema_str()
         out_str += "\nJavascript-source %s\n" % int(self.has_js_src)
         out_fname = self.crawl_name + "-db_schema.txt"
         db_schema_path = join(self.db_schema_dir, out_fname)
@@ -138,25 +248,41 @@ class CrawlData(object):
             out.write(out_str)
 
     def backup_crawl_files(self):
-        log_prefix = self.crawl_name + "-"
         if self.openwpm_log_path:
-            openwpm_log_dst = join(self.log_files_dir,
-                                   log_prefix + OPENWPM_LOG_FILENAME)
-            copy_if_not_exists(self.openwpm_log_path, openwpm_log_dst)
+            copy_if_not_exists(self.openwpm_log_path,
+                               self.backup_paths[OPENWPM_LOG_FILENAME])
 
         if self.crontab_log_path:
-            crontab_log_dst = join(self.log_files_dir,
-                                   log_prefix + CRONTAB_LOG_FILENAME)
-            copy_if_not_exists(self.crontab_log_path, crontab_log_dst)
+            copy_if_not_exists(self.crontab_log_path,
+                               self.backup_paths[CRONTAB_LOG_FILENAME])
 
         if self.alexa_csv_path:
-            alexa_csv_dst = join(self.alexa_ranks_dir,
-                                 log_prefix + ALEXA_TOP1M_CSV_FILENAME)
-            copy_if_not_exists(self.alexa_csv_path, alexa_csv_dst)
+            copy_if_not_exists(self.alexa_csv_path,
+                               self.backup_paths[ALEXA_TOP1M_CSV_FILENAME])
 
 
 if __name__ == '__main__':
     t0 = time()
-    crawl_data = CrawlData(sys.argv[1], sys.argv[2])
+    parser = argparse.ArgumentParser()
+    parser.add_argument("crawl_dir")
+    parser.add_argument("out_dir")
+    parser.add_argument("--profile-interval", type=float,
+                        help="sample the stack every this many seconds of "
+                        "CPU time and add the profile to the telemetry")
+    parser.add_argument("--compact-dir",
+                        help="write the compacted DB here, e.g. on a "
+                        "faster scratch disk. On another file system, the "
+                        "crawl DB becomes a symlink to it.")
+    parser.add_argument("--no-compaction", action="store_true",
+                        help="don't rewrite the DB with VACUUM INTO")
+    parser.add_argument("--rank-store",
+                        help="read the top list of the crawl date from this "
+                        "rank_store.py dir instead of the working dir")
+    args = parser.parse_args()
+    crawl_data = CrawlData(args.crawl_dir, args.out_dir,
+                           profile_interval=args.profile_interval,
+                           compact=not args.no_compaction,
+                           compact_dir=args.compact_dir,
+                           rank_store_dir=args.rank_store)
     crawl_data.pre_process()
     print "Preprocess finished in %0.1f mins" % ((time() - t0) / 60)
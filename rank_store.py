@@ -0,0 +1,313 @@
+"""Offline store of the daily Alexa top lists.
+
+Each top list CSV (or its .xz archive) is parsed once, when it's ingested
+into the store. The lists of different days mostly have the same sites,
+so the site addresses are stored once for all days:
+
+    strings.dat        site addresses, one per line
+    strings.off        offset of each address in strings.dat (uint64),
+                       the index in this array is the id of the address
+    strings.sorted     the ids, ordered by their address (uint32)
+    ranks/<date>.bin   (id, rank) pairs of a day's list, ordered by address
+                       (2 x uint32)
+
+All files are memory mapped for reading. The ranks of a day are looked up
+with a binary search (RankList.get), or read in address order
+(RankList.iteritems). Ingesting a list merges its sorted addresses with
+strings.sorted, so the addresses that are already stored are never
+loaded into a dict.
+"""
+import os
+import re
+import sys
+import mmap
+import fcntl
+import struct
+import argparse
+from array import array
+from glob import glob
+from os.path import join, isdir, isfile, basename, getsize
+from util import iter_alexa_ranks
+
+STRINGS_FILENAME = "strings.dat"
+OFFSETS_FILENAME = "strings.off"
+SORTED_IDS_FILENAME = "strings.sorted"
+RANKS_DIRNAME = "ranks"
+RANKS_EXT = ".bin"
+LOCK_FILENAME = ".lock"
+DATE_RE = re.compile(r"(\d{4}-\d{2}-\d{2})")
+
+OFFSET = struct.Struct("<Q")
+RANK_RECORD = struct.Struct("<II")
+
+
+def get_list_date(path):
+    """Return the YYYY-MM-DD date in the name of a top list file."""
+    match = DATE_RE.search(basename(path))
+    if match is None:
+        raise ValueError("No date in the top list name %s" % path)
+    return match.group(1)
+
+
+def map_file(path):
+    """Memory map a file for reading, None if it's empty."""
+    if not isfile(path) or getsize(path) == 0:
+        return None
+    with open(path, "rb") as f:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def read_uint32_array(path):
+    ids = array("I")
+    if isfile(path):
+        with open(path, "rb") as f:
+            ids.fromfile(f, getsize(path) // ids.itemsize)
+        if sys.byteorder == "big":
+            ids.byteswap()
+    return ids
+
+
+def uint32_array_to_string(values):
+    """Return the little endian bytes of an array("I")."""
+    if sys.byteorder == "big":
+        values = array("I", values)
+        values.byteswap()
+    return values.tostring()
+
+
+def write_file_atomically(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+
+
+class StringTable(object):
+    """The stored site addresses, read through memory maps."""
+
+    def __init__(self, store_dir):
+        # map the offsets first: strings.dat is written before them
+        self.offsets = map_file(join(store_dir, OFFSETS_FILENAME))
+        self.strings = map_file(join(store_dir, STRINGS_FILENAME))
+
+    def __len__(self):
+        return 0 if self.offsets is None else len(self.offsets) // OFFSET.size
+
+    def get(self, string_id):
+        start = OFFSET.unpack_from(self.offsets, string_id * OFFSET.size)[0]
+        return self.strings[start:self.strings.find("\n", start)]
+
+    def read_offsets(self):
+        """Return all offsets, and the end of the last string."""
+        num_strings = len(self)
+        if not num_strings:
+            return [0]
+        if array("L").itemsize == OFFSET.size and sys.byteorder == "little":
+            offsets = array("L")
+            offsets.fromstring(self.offsets[:])
+        else:
+            offsets = list(struct.unpack("<%dQ" % num_strings,
+                                         self.offsets[:]))
+        offsets.append(self.strings.find("\n", offsets[-1]) + 1)
+        return offsets
+
+    def close(self):
+        for mapped in (self.offsets, self.strings):
+            if mapped is not None:
+                mapped.close()
+
+
+class RankList(object):
+    """The ranks of a day's top list."""
+
+    def __init__(self, store_dir, date):
+        self.date = date
+        # the ranks refer to strings written before them
+        self.records = map_file(join(store_dir, RANKS_DIRNAME,
+                                     date + RANKS_EXT))
+        self.strings = StringTable(store_dir)
+
+    def __len__(self):
+        return 0 if self.records is None else \
+            len(self.records) // RANK_RECORD.size
+
+    def get_record(self, i):
+        return RANK_RECORD.unpack_from(self.records, i * RANK_RECORD.size)
+
+    def get(self, site_address, default=None):
+        """Return the rank of a site address."""
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            string_id, rank = self.get_record(mid)
+            mid_address = self.strings.get(string_id)
+            if mid_address < site_address:
+                lo = mid + 1
+            elif mid_address > site_address:
+                hi = mid
+            else:
+                return rank
+        return default
+
+    def __contains__(self, site_address):
+        return self.get(site_address) is not None
+
+    def iteritems(self):
+        """Yield the (site address, rank) pairs, ordered by address."""
+        if not len(self):
+            return
+        # reading the arrays at once is much faster than get_record
+        records = array("I")
+        records.fromstring(self.records[:])
+        if sys.byteorder == "big":
+            records.byteswap()
+        offsets = self.strings.read_offsets()
+        strings = self.strings.strings
+        for i in xrange(0, len(records), 2):
+            string_id = records[i]
+            yield strings[offsets[string_id]:offsets[string_id + 1] - 1], \
+                records[i + 1]
+
+    def close(self):
+        if self.records is not None:
+            self.records.close()
+        self.strings.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class RankStore(object):
+
+    def __init__(self, store_dir):
+        self.store_dir = store_dir
+        self.ranks_dir = join(store_dir, RANKS_DIRNAME)
+        if not isdir(self.ranks_dir):
+            os.makedirs(self.ranks_dir)
+
+    def get_ranks_path(self, date):
+        return join(self.ranks_dir, date + RANKS_EXT)
+
+    def dates(self):
+        return sorted(basename(path)[:-len(RANKS_EXT)] for path in
+                      glob(join(self.ranks_dir, "*" + RANKS_EXT)))
+
+    def has_date(self, date):
+        return isfile(self.get_ranks_path(date))
+
+    def get_ranks(self, date):
+        """Return the RankList of a date, None if it's not in the store."""
+        if not self.has_date(date):
+            return None
+        return RankList(self.store_dir, date)
+
+    def ingest(self, top_list_path, date=None, replace=False):
+        """Add a top list CSV or .csv.xz file. Returns the date.
+
+        A site listed twice gets its last rank, as with iter_alexa_ranks
+        into a dict.
+        """
+        if date is None:
+            date = get_list_date(top_list_path)
+        with open(join(self.store_dir, LOCK_FILENAME), "a") as lock:
+            # another process may be ingesting the same list
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if self.has_date(date) and not replace:
+                print "The top list of %s is already stored" % date
+                return date
+            site_ranks = sorted(dict(iter_alexa_ranks(top_list_path))
+                                .iteritems())
+            num_new = self.add_ranks(date, site_ranks)
+        print "Stored %d ranks of %s, %d new site addresses" % (
+            len(site_ranks), date, num_new)
+        return date
+
+    def add_ranks(self, date, site_ranks):
+        """Store (site address, rank) pairs ordered by address. Returns
+        the number of new addresses."""
+        sorted_ids_path = join(self.store_dir, SORTED_IDS_FILENAME)
+        strings_path = join(self.store_dir, STRINGS_FILENAME)
+        old_ids = read_uint32_array(sorted_ids_path)
+        strings = StringTable(self.store_dir)
+        next_id = len(strings)
+        next_offset = getsize(strings_path) if isfile(strings_path) else 0
+        new_strings = []
+        new_offsets = []
+        sorted_ids = array("I")
+        records = array("I")
+        # merge the addresses of the list with the stored ones
+        i = 0
+        num_old = len(old_ids)
+        old_address = strings.get(old_ids[0]) if num_old else None
+        for site_address, rank in site_ranks:
+            while i < num_old and old_address < site_address:
+                sorted_ids.append(old_ids[i])
+                i += 1
+                old_address = strings.get(old_ids[i]) if i < num_old \
+                    else None
+            if i < num_old and old_address == site_address:
+                string_id = old_ids[i]
+                sorted_ids.append(string_id)
+                i += 1
+                old_address = strings.get(old_ids[i]) if i < num_old \
+                    else None
+            else:
+                string_id = next_id
+                next_id += 1
+                new_strings.append(site_address + "\n")
+                new_offsets.append(next_offset)
+                next_offset += len(site_address) + 1
+                sorted_ids.append(string_id)
+            records.append(string_id)
+            records.append(rank)
+        sorted_ids.extend(old_ids[i:])
+        strings.close()
+        # the strings must be on disk before the files that refer to them
+        for path, data in ((strings_path, "".join(new_strings)),
+                           (join(self.store_dir, OFFSETS_FILENAME),
+                            struct.pack("<%dQ" % len(new_offsets),
+                                        *new_offsets))):
+            with open(path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        write_file_atomically(sorted_ids_path,
+                              uint32_array_to_string(sorted_ids))
+        write_file_atomically(self.get_ranks_path(date),
+                              uint32_array_to_string(records))
+        return len(new_strings)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("store_dir")
+    subparsers = parser.add_subparsers(dest="command")
+    ingest_parser = subparsers.add_parser(
+        "ingest", help="add top list CSV or .csv.xz files")
+    ingest_parser.add_argument("top_list_paths", nargs="+")
+    ingest_parser.add_argument("--replace", action="store_true",
+                               help="replace the lists of the same dates")
+    subparsers.add_parser("dates", help="list the stored dates")
+    get_parser = subparsers.add_parser("get", help="print the rank of sites")
+    get_parser.add_argument("date")
+    get_parser.add_argument("site_addresses", nargs="+")
+    args = parser.parse_args()
+    rank_store = RankStore(args.store_dir)
+    if args.command == "ingest":
+        for top_list_path in args.top_list_paths:
+            rank_store.ingest(top_list_path, replace=args.replace)
+    elif args.command == "dates":
+        for date in rank_store.dates():
+            print date
+    else:
+        rank_list = rank_store.get_ranks(args.date)
+        if rank_list is None:
+            parser.exit(1, "No top list of %s in the store\n" % args.date)
+        with rank_list:
+            for site_address in args.site_addresses:
+                print site_address, rank_list.get(site_address)
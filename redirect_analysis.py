@@ -0,0 +1,209 @@
+"""Resolve the HTTP redirect chains of a crawl in one pass.
+
+http_redirects only has the channel ids of the redirected requests, their
+URLs are in http_requests. Neither table is indexed, and channel ids are
+only unique within a visit, so we stream both tables in id order, side by
+side, and keep the channel id -> URL map and the redirects of a visit only
+until both streams are past it. The rows of each table are ordered by
+visit, give or take the visits that run in parallel, so a visit is
+resolved once both streams have reached visits `slack` visit ids later.
+Memory is bounded by the visits in this window, not by the crawl.
+
+For each visit the redirects are joined into chains, and we count the
+chain lengths, the sites with a redirect from one PS+1 to another (per
+hop, as in the HTTP-Redirection-Analysis notebook) and the sites whose
+redirect chains start and end on different PS+1s.
+"""
+import heapq
+from time import time
+from collections import defaultdict
+import util
+from db_schema import HTTP_REQUESTS_TABLE, HTTP_REDIRECTS_TABLE
+
+# rows of visits this many visit ids apart can be out of order
+DEFAULT_VISIT_ID_SLACK = 100
+FETCH_BATCH_SIZE = 10**4
+PS1_PAIR_SEPARATOR = "\t"
+STAT_NAMES = ["num_redirects", "num_unresolved_redirects", "num_chains",
+              "num_visits_with_redirects", "num_late_redirects",
+              "num_late_requests", "max_pending_visits"]
+
+
+def iter_rows(cursor):
+    while True:
+        rows = cursor.fetchmany(FETCH_BATCH_SIZE)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+def get_redirect_chains(redirects):
+    """Join (old channel id, new channel id) pairs into chains of channel
+    ids, in the order of the redirects. Cycles are left out."""
+    next_channel = {}
+    for old_channel_id, new_channel_id in redirects:
+        next_channel[old_channel_id] = new_channel_id
+    targets = set(next_channel.itervalues())
+    chains = []
+    for old_channel_id, _ in redirects:
+        if old_channel_id in targets or old_channel_id not in next_channel:
+            continue
+        chain = [old_channel_id]
+        seen = set(chain)
+        while chain[-1] in next_channel and \
+                next_channel[chain[-1]] not in seen:
+            chain.append(next_channel[chain[-1]])
+            seen.add(chain[-1])
+        # a channel that is redirected twice starts a single chain
+        del next_channel[old_channel_id]
+        chains.append(chain)
+    return chains
+
+
+class RedirectAnalysis(object):
+
+    def __init__(self, db_conn, db_catalog, get_site_id,
+                 visit_id_slack=DEFAULT_VISIT_ID_SLACK):
+        self.db_conn = db_conn
+        self.db_catalog = db_catalog
+        self.get_site_id = get_site_id
+        self.visit_id_slack = visit_id_slack
+        # visit id -> (channel id -> URL, list of redirects)
+        self.pending_visits = {}
+        self.pending_visit_ids = []
+        # rows of visits up to this id were resolved
+        self.resolved_up_to = 0
+        self.chain_lengths = defaultdict(int)
+        # (old PS+1, new PS+1) -> site ids
+        self.ps1_pair_sites = defaultdict(set)
+        self.chain_ps1_pair_sites = defaultdict(set)
+        self.stats = dict.fromkeys(STAT_NAMES, 0)
+        self.ps1_time = 0.0
+
+    def get_ps1(self, url):
+        t0 = time()
+        ps1 = util.get_tld_or_host(url)
+        self.ps1_time += time() - t0
+        return ps1
+
+    def get_pending_visit(self, visit_id):
+        try:
+            return self.pending_visits[visit_id]
+        except KeyError:
+            visit = self.pending_visits[visit_id] = ({}, [])
+            heapq.heappush(self.pending_visit_ids, visit_id)
+            self.stats["max_pending_visits"] = max(
+                self.stats["max_pending_visits"], len(self.pending_visits))
+            return visit
+
+    def iter_requests(self):
+        cursor = self.db_conn.cursor()
+        # plain tuples are much cheaper to build than sqlite3.Row objects
+        cursor.row_factory = None
+        cursor.execute("""SELECT visit_id, channel_id, url FROM %s
+            WHERE visit_id != -1 AND channel_id IS NOT NULL
+            ORDER BY id""" % HTTP_REQUESTS_TABLE)
+        return iter_rows(cursor)
+
+    def iter_redirects(self):
+        query = """SELECT visit_id, old_channel_id, new_channel_id FROM %s
+            WHERE visit_id != -1 AND old_channel_id IS NOT NULL""" % \
+            HTTP_REDIRECTS_TABLE
+        # HTTP to HTTPS upgrades don't change the PS+1
+        if self.db_catalog.has_column(HTTP_REDIRECTS_TABLE, "is_sts_upgrade"):
+            query += " AND IFNULL(is_sts_upgrade, 0) = 0"
+        cursor = self.db_conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(query + " ORDER BY id")
+        return iter_rows(cursor)
+
+    def run(self):
+        """Stream both tables, reading from the one that is behind."""
+        requests = self.iter_requests()
+        redirects = self.iter_redirects()
+        request = next(requests, None)
+        redirect = next(redirects, None)
+        # the largest visit id read from each table, inf once it's read
+        requests_max = 0 if request is not None else float("inf")
+        redirects_max = 0 if redirect is not None else float("inf")
+        while request is not None or redirect is not None:
+            if redirect is not None and redirects_max <= requests_max:
+                visit_id, old_channel_id, new_channel_id = redirect
+                self.stats["num_redirects"] += 1
+                if visit_id <= self.resolved_up_to:
+                    self.stats["num_late_redirects"] += 1
+                else:
+                    self.get_pending_visit(visit_id)[1].append(
+                        (old_channel_id, new_channel_id))
+                redirects_max = max(redirects_max, visit_id)
+                redirect = next(redirects, None)
+                if redirect is None:
+                    redirects_max = float("inf")
+            else:
+                visit_id, channel_id, url = request
+                if visit_id <= self.resolved_up_to:
+                    self.stats["num_late_requests"] += 1
+                else:
+                    self.get_pending_visit(visit_id)[0][channel_id] = url
+                requests_max = max(requests_max, visit_id)
+                request = next(requests, None)
+                if request is None:
+                    requests_max = float("inf")
+            resolved_up_to = min(requests_max, redirects_max) - \
+                self.visit_id_slack
+            if resolved_up_to > self.resolved_up_to:
+                self.resolve_visits(resolved_up_to)
+        self.resolve_visits(float("inf"))
+
+    def resolve_visits(self, resolved_up_to):
+        """Resolve the pending visits with ids up to resolved_up_to."""
+        self.resolved_up_to = resolved_up_to
+        while self.pending_visit_ids and \
+                self.pending_visit_ids[0] <= resolved_up_to:
+            visit_id = heapq.heappop(self.pending_visit_ids)
+            channel_urls, redirects = self.pending_visits.pop(visit_id)
+            if redirects:
+                self.resolve_visit(visit_id, channel_urls, redirects)
+
+    def resolve_visit(self, visit_id, channel_urls, redirects):
+        site_id = self.get_site_id(visit_id)
+        self.stats["num_visits_with_redirects"] += 1
+        # PS+1s of the channels, computed when a redirect refers to them
+        ps1s = {}
+        ps1_pairs = set()
+        for old_channel_id, new_channel_id in redirects:
+            old_ps1 = self.get_channel_ps1(channel_urls, ps1s, old_channel_id)
+            new_ps1 = self.get_channel_ps1(channel_urls, ps1s, new_channel_id)
+            if old_channel_id not in channel_urls or \
+                    new_channel_id not in channel_urls:
+                self.stats["num_unresolved_redirects"] += 1
+            elif old_ps1 != new_ps1 and old_ps1 and new_ps1:
+                ps1_pairs.add((old_ps1, new_ps1))
+        for ps1_pair in ps1_pairs:
+            self.ps1_pair_sites[ps1_pair].add(site_id)
+        for chain in get_redirect_chains(redirects):
+            self.stats["num_chains"] += 1
+            self.chain_lengths[len(chain) - 1] += 1
+            first_ps1 = self.get_channel_ps1(channel_urls, ps1s, chain[0])
+            last_ps1 = self.get_channel_ps1(channel_urls, ps1s, chain[-1])
+            if first_ps1 != last_ps1 and first_ps1 and last_ps1:
+                self.chain_ps1_pair_sites[(first_ps1, last_ps1)].add(site_id)
+
+    def get_channel_ps1(self, channel_urls, ps1s, channel_id):
+        """Return the PS+1 of a channel's URL, None if it's unknown."""
+        ps1 = ps1s.get(channel_id)
+        if ps1 is None and channel_id in channel_urls:
+            ps1 = ps1s[channel_id] = self.get_ps1(channel_urls[channel_id])
+        return ps1
+
+    def get_ps1_pair_site_counts(self, chains=False):
+        """Return the number of sites of each "old PS+1<TAB>new PS+1"."""
+        pair_sites = self.chain_ps1_pair_sites if chains \
+            else self.ps1_pair_sites
+        return {PS1_PAIR_SEPARATOR.join(ps1_pair): len(site_ids)
+                for ps1_pair, site_ids in pair_sites.iteritems()}
+
+    def get_chain_lengths(self):
+        """Return the number of redirect chains of each number of hops."""
+        return dict(self.chain_lengths)
@@ -0,0 +1,250 @@
+"""Stage level performance telemetry for the crawl processing scripts.
+
+Each stage records its wall and CPU time, the number of rows it processed,
+the peak RSS, the I/O of the process, the SQLite page cache settings and
+DB size, and optionally how its time was split between fetching rows,
+PS+1 parsing and aggregation. The stages of a run are written to a JSON
+report per crawl, which is rewritten after each stage so an interrupted
+run leaves a partial report.
+"""
+import os
+import sys
+import json
+import signal
+import socket
+import resource
+from time import time
+from datetime import datetime
+from collections import defaultdict
+from contextlib import contextmanager
+from os.path import join, isdir, dirname
+from util import get_peak_rss_mb
+
+TELEMETRY_DIRNAME = "telemetry"
+# categories of the time split, see Stage.add_time
+FETCH_TIME = "fetch"
+PS1_TIME = "ps1"
+AGGREGATE_TIME = "aggregate"
+CHECKPOINT_TIME = "checkpoint"
+SQLITE_PRAGMAS = ["page_size", "page_count", "freelist_count", "cache_size"]
+PROC_IO_PATH = "/proc/self/io"
+# number of functions to keep in the profile of each stage
+PROFILE_TOP_N = 30
+
+
+def get_report_path(out_dir, crawl_name, command):
+    return join(out_dir, TELEMETRY_DIRNAME, "%s_%s_telemetry.json" % (
+        crawl_name, command))
+
+
+def read_proc_io():
+    """Return the I/O counters of the process (Linux only)."""
+    io_counters = {}
+    try:
+        with open(PROC_IO_PATH) as f:
+            for line in f:
+                name, value = line.split(":")
+                io_counters[name] = int(value)
+    except (IOError, ValueError):
+        pass
+    return io_counters
+
+
+def get_sqlite_stats(db_conn):
+    """Return the page cache settings and the size of a SQLite DB.
+
+    Python's sqlite3 module doesn't expose the page cache hit and miss
+    counters, the I/O counters of the stage are the closest proxy.
+    """
+    stats = {}
+    for pragma in SQLITE_PRAGMAS:
+        stats[pragma] = db_conn.execute("PRAGMA %s" % pragma).fetchone()[0]
+    page_size = stats["page_size"]
+    # negative cache sizes are in KiB, positive ones in pages
+    if stats["cache_size"] < 0:
+        cache_bytes = -stats["cache_size"] * 1024
+    else:
+        cache_bytes = stats["cache_size"] * page_size
+    stats["cache_size_mb"] = cache_bytes / 1e6
+    stats["db_size_mb"] = stats["page_count"] * page_size / 1e6
+    return stats
+
+
+class Stage(object):
+    """Measurements of a single stage."""
+
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.time_split = defaultdict(float)
+        self.info = {}
+        self.report = {}
+
+    def add_rows(self, num_rows):
+        self.rows += num_rows
+
+    def add_time(self, category, seconds):
+        self.time_split[category] += seconds
+
+    def merge_time_split(self, time_split):
+        for category, seconds in time_split.iteritems():
+            self.time_split[category] += seconds
+
+
+class SamplingProfiler(object):
+    """Statistical profiler based on SIGPROF.
+
+    Every `interval` seconds of CPU time, count the innermost function and
+    all the distinct functions on the stack. Samples are attributed to the
+    stage that is running. Time spent in C calls (e.g. SQLite) is counted
+    when the call returns to Python, i.e. on the calling line.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stage_name = None
+        self.num_samples = defaultdict(int)
+        self.self_samples = defaultdict(lambda: defaultdict(int))
+        self.total_samples = defaultdict(lambda: defaultdict(int))
+
+    def start(self):
+        signal.signal(signal.SIGPROF, self.sample)
+        # restart the system calls interrupted by the samples
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        signal.setitimer(signal.ITIMER_PROF, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+
+    def sample(self, signum, frame):
+        stage_name = self.stage_name
+        self.num_samples[stage_name] += 1
+        seen = set()
+        innermost = True
+        while frame is not None:
+            code = frame.f_code
+            function = "%s:%s:%d" % (os.path.basename(code.co_filename),
+                                     code.co_name, code.co_firstlineno)
+            if innermost:
+                self.self_samples[stage_name][function] += 1
+                innermost = False
+            if function not in seen:
+                seen.add(function)
+                self.total_samples[stage_name][function] += 1
+            frame = frame.f_back
+
+    def get_report(self, stage_name, top_n=PROFILE_TOP_N):
+        def top(samples):
+            return sorted(samples.iteritems(), key=lambda x: -x[1])[:top_n]
+        return {"interval": self.interval,
+                "samples": self.num_samples[stage_name],
+                "self": top(self.self_samples[stage_name]),
+                "total": top(self.total_samples[stage_name])}
+
+
+class Telemetry(object):
+    """Collect the stages of a run and write them to a JSON report."""
+
+    def __init__(self, crawl_name, report_path, db_conn=None,
+                 profile_interval=None):
+        self.crawl_name = crawl_name
+        self.report_path = report_path
+        self.db_conn = db_conn
+        self.stages = []
+        self.current_stage = None
+        self.started = datetime.now().isoformat()
+        self.t0 = time()
+        self.profiler = None
+        if profile_interval:
+            self.profiler = SamplingProfiler(profile_interval)
+            self.profiler.start()
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the code in the with block as a stage.
+
+        The stage object is yielded, so the code can add its row count,
+        time split and any other info.
+        """
+        stage = Stage(name)
+        parent_stage = self.current_stage
+        self.current_stage = stage
+        if self.profiler is not None:
+            self.profiler.stage_name = name
+        io_counters = read_proc_io()
+        cpu_times = os.times()
+        t0 = time()
+        status = "failed"
+        try:
+            yield stage
+            status = "finished"
+        finally:
+            wall_time = time() - t0
+            self.current_stage = parent_stage
+            if self.profiler is not None:
+                self.profiler.stage_name = parent_stage and parent_stage.name
+            self.finish_stage(stage, status, wall_time, cpu_times,
+                              io_counters)
+
+    def finish_stage(self, stage, status, wall_time, cpu_times, io_counters):
+        end_cpu_times = os.times()
+        end_io_counters = read_proc_io()
+        report = {"name": stage.name,
+                  "status": status,
+                  "wall_time": wall_time,
+                  "cpu_time": (end_cpu_times[0] + end_cpu_times[1] -
+                               cpu_times[0] - cpu_times[1]),
+                  "children_cpu_time": (end_cpu_times[2] + end_cpu_times[3] -
+                                        cpu_times[2] - cpu_times[3]),
+                  "rows": stage.rows,
+                  "rows_per_s": stage.rows / wall_time if wall_time else 0,
+                  "peak_rss_mb": get_peak_rss_mb(),
+                  "peak_rss_children_mb": get_peak_rss_mb(
+                      resource.RUSAGE_CHILDREN),
+                  "io": {name: end_io_counters[name] - io_counters[name]
+                         for name in end_io_counters if name in io_counters},
+                  "time_split": dict(stage.time_split)}
+        if self.db_conn is not None:
+            try:
+                report["sqlite"] = get_sqlite_stats(self.db_conn)
+            except Exception as e:
+                report["sqlite"] = {"error": str(e)}
+        if self.profiler is not None:
+            report["profile"] = self.profiler.get_report(stage.name)
+        report.update(stage.info)
+        stage.report = report
+        self.stages.append(stage)
+        print "Stage %s %s in %0.1f s, %d rows (%d rows/s), peak RSS "\
+            "%0.1f MB" % (stage.name, status, wall_time, stage.rows,
+                          report["rows_per_s"], report["peak_rss_mb"])
+        self.save()
+
+    def add_time(self, category, seconds):
+        """Add to the time split of the running stage, if any."""
+        if self.current_stage is not None:
+            self.current_stage.add_time(category, seconds)
+
+    def get_report(self):
+        return {"crawl_name": self.crawl_name,
+                "command": " ".join(sys.argv),
+                "hostname": socket.gethostname(),
+                "started": self.started,
+                "wall_time": time() - self.t0,
+                "peak_rss_mb": get_peak_rss_mb(),
+                "stages": [stage.report for stage in self.stages]}
+
+    def save(self):
+        report_dir = dirname(self.report_path)
+        if not isdir(report_dir):
+            os.makedirs(report_dir)
+        tmp_path = self.report_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.get_report(), f, indent=2, sort_keys=True)
+        os.rename(tmp_path, self.report_path)
+
+    def close(self):
+        if self.profiler is not None:
+            self.profiler.stop()
+        self.save()
+        print "Wrote telemetry report to %s" % self.report_path
@@ -1,55 +1,87 @@
 import sqlite3
 import json
+import resource
+import subprocess
 from time import time
 from multiprocessing import Process
 from tld import get_tld
 import ipaddress
-from os.path import join, isfile,  isdir, dirname
+from os.path import join, isfile,  isdir, dirname, abspath
 import glob
 from shutil import copyfile
+from collections import OrderedDict
 try:
-    from urlparse import urlparse
+    from urlparse import urlparse, scheme_chars
+    from urllib import pathname2url
 except ImportError:
-    from urllib.parse import urlparse
+    from urllib.parse import urlparse, scheme_chars
+    from urllib.request import pathname2url
 
 
 CRAWL_DB_EXT = ".sqlite"
+XZ_EXT = ".xz"
 DB_SCHEMA_SUFFIX = "_db_schema.txt"
 # print progress every million rows
 PRINT_PROGRESS_EVERY = 10**6
+# max. number of hosts to keep in the PS+1 cache
+PS1_CACHE_SIZE = 10**5
+# read-only connections memory map up to this much of the DB. SQLite caps
+# it at its compile time limit (2 GB by default).
+READ_ONLY_MMAP_SIZE = 2**40
+# pages are read from the OS page cache through the mmap, so read-only
+# connections need a much smaller page cache of their own
+READ_ONLY_CACHE_SIZE_MB = 256
 
 
-def load_alexa_ranks(alexa_csv_path):
-    site_ranks = dict()
-    for line in open(alexa_csv_path):
-        parts = line.strip().split(',')
-        site_ranks[parts[1]] = int(parts[0])
-    return site_ranks
-
+def iter_alexa_ranks(alexa_csv_path):
+    """Yield the (site address, rank) pairs of a top list CSV, or of its
+    .xz archive, which is decompressed on the fly with `xz -dc`."""
+    if not alexa_csv_path.endswith(XZ_EXT):
+        with open(alexa_csv_path) as f:
+            for line in f:
+                parts = line.strip().split(',')
+                yield parts[1], int(parts[0])
+        return
+    proc = subprocess.Popen(["xz", "-dc", alexa_csv_path],
+                            stdout=subprocess.PIPE, bufsize=-1)
+    try:
+        for line in proc.stdout:
+            parts = line.strip().split(',')
+            yield parts[1], int(parts[0])
+    finally:
+        proc.stdout.close()
+        returncode = proc.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode,
+                                            "xz -dc %s" % alexa_csv_path)
 
-def get_column_names(table_name, cursor):
-    """Return the column names for a table.
 
-    Modified from https://stackoverflow.com/a/38854129
-    """
-    cursor.execute("SELECT * FROM %s" % table_name)
-    return " ".join([member[0] for member in cursor.description])
+def load_alexa_ranks(alexa_csv_path):
+    return dict(iter_alexa_ranks(alexa_csv_path))
 
 
-def get_table_and_column_names(db_path):
-    """Return the table and column names for a database.
+def connect_read_only(db_path, immutable=False,
+                      mmap_size=READ_ONLY_MMAP_SIZE,
+                      cache_size_mb=READ_ONLY_CACHE_SIZE_MB):
+    """Open a SQLite DB for reading only, through a mode=ro URI filename.
 
-    Modified from: https://stackoverflow.com/a/33100538
+    With `immutable`, SQLite also skips locking and change detection, which
+    is only safe if no other process writes to the DB, e.g. for archived
+    crawls or DBs on read-only filesystems. Unlike optimize_db, this
+    doesn't change the journal mode or any other setting stored in the DB,
+    so other connections can keep using it.
     """
-    db_schema_str = ""
-    db = sqlite3.connect(db_path)
-    cursor = db.cursor()
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    for table_name in cursor.fetchall():
-        table_name = table_name[0]
-        db_schema_str += "%s %s\n" % (table_name, get_column_names(table_name,
-                                                                   cursor))
-    return db_schema_str
+    if not isfile(db_path):
+        raise Exception("Cannot find the DB: %s" % db_path)
+    uri = "file:%s?mode=ro" % pathname2url(abspath(db_path))
+    if immutable:
+        uri += "&immutable=1"
+    db_conn = sqlite3.connect(uri)
+    db_conn.execute("PRAGMA mmap_size = %d" % mmap_size)
+    db_conn.execute("PRAGMA cache_size = -%d" % (cache_size_mb * 1000))
+    # Store temp tables, indices in memory
+    db_conn.execute("PRAGMA temp_store = 2")
+    return db_conn
 
 
 def start_worker_processes(worker_function, queue, num_workers=1):
@@ -61,7 +93,93 @@ def start_worker_processes(worker_function, queue, num_workers=1):
     return workers
 
 
-def get_tld_or_host(url):
+class LRUCache(object):
+    """Bounded mapping that evicts the least recently used key."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        try:
+            value = self._items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        # re-insert to mark the key as the most recently used
+        self._items[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def resize(self, max_size):
+        self.max_size = max_size
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {"size": len(self._items),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": float(self.hits) / lookups if lookups else 0.0}
+
+
+_ps1_cache = LRUCache(PS1_CACHE_SIZE)
+_MISSING = object()
+
+
+def set_ps1_cache_size(max_size):
+    _ps1_cache.resize(max_size)
+
+
+def get_ps1_cache_stats():
+    return _ps1_cache.stats()
+
+
+def print_ps1_cache_stats():
+    stats = get_ps1_cache_stats()
+    print "PS+1 cache: %d/%d hosts, %d hits, %d misses (%0.2f%% hit rate)" % (
+        stats["size"], stats["max_size"], stats["hits"], stats["misses"],
+        100 * stats["hit_rate"])
+
+
+def get_netloc(url):
+    """Return the lowercased netloc of a `scheme://netloc/...` URL.
+
+    Returns None for URLs that don't have this form (e.g. data: URLs), so
+    the callers can skip the cache for them.
+    """
+    parts = url.split("/", 3)
+    if len(parts) < 3 or parts[1] or not parts[0].endswith(":"):
+        return None
+    scheme = parts[0][:-1]
+    if not scheme or not scheme[0].isalpha() or \
+            scheme.strip(scheme_chars):
+        return None
+    netloc = parts[2]
+    for delim in "?#":
+        netloc = netloc.split(delim, 1)[0]
+    return netloc.lower()
+
+
+def _get_tld_or_host(url):
     try:
         return get_tld(url, fail_silently=False)
     except Exception:
@@ -73,6 +191,37 @@ def get_tld_or_host(url):
             return None
 
 
+def get_tld_or_host(url):
+    """Return the PS+1 (or the IP address) of a URL.
+
+    The result only depends on the host, so we memoize it by netloc.
+    """
+    netloc = get_netloc(url)
+    if netloc is None:
+        return _get_tld_or_host(url)
+    ps1 = _ps1_cache.get(netloc, _MISSING)
+    if ps1 is _MISSING:
+        ps1 = _get_tld_or_host(url)
+        _ps1_cache.put(netloc, ps1)
+    return ps1
+
+
+def get_tlds_or_hosts(urls):
+    """Return the PS+1s of a batch of URLs, looking up each host once."""
+    batch_ps1s = {}
+    ps1s = []
+    for url in urls:
+        netloc = get_netloc(url)
+        if netloc is None:
+            ps1s.append(_get_tld_or_host(url))
+            continue
+        ps1 = batch_ps1s.get(netloc, _MISSING)
+        if ps1 is _MISSING:
+            ps1 = batch_ps1s[netloc] = get_tld_or_host(url)
+        ps1s.append(ps1)
+    return ps1s
+
+
 def is_third_party(req_url, top_level_url):
     # TODO: when we have missing information we return False
     # meaning we think this is a first-party
@@ -127,6 +276,17 @@ def get_crawl_dir(crawl_dir):
         return crawl_dir[0]
 
 
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Return the peak resident set size in MB."""
+    # ru_maxrss is in KB on Linux
+    return resource.getrusage(who).ru_maxrss / 1024.0
+
+
+def print_peak_memory(label):
+    print "Peak RSS %s: %0.1f MB (children: %0.1f MB)" % (
+        label, get_peak_rss_mb(), get_peak_rss_mb(resource.RUSAGE_CHILDREN))
+
+
 def print_progress(t0, processed, num_rows):
     if processed % PRINT_PROGRESS_EVERY == 0:
         elapsed = time() - t0